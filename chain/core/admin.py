@@ -1,6 +1,7 @@
 from django.contrib import admin
 from chain.core.models import (Site, Device, Unit, Metric, Sensor,
-                                 ScalarData, Person, GeoLocation)
+                                 ScalarData, Person, GeoLocation,
+                                 IngestPolicy, RetentionPolicy)
 
 
 admin.site.register(GeoLocation)
@@ -11,3 +12,5 @@ admin.site.register(Sensor)
 admin.site.register(Unit)
 admin.site.register(Metric)
 admin.site.register(Person)
+admin.site.register(IngestPolicy)
+admin.site.register(RetentionPolicy)
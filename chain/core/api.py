@@ -7,12 +7,14 @@ import json
 from django.http import HttpResponse
 from django.core.urlresolvers import reverse
 from django.views.decorators.csrf import csrf_exempt
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.core.exceptions import ValidationError
 from datetime import datetime
 from jinja2 import Environment, PackageLoader
 from urlparse import urlparse, urlunparse, parse_qs
 from urllib import urlencode
 from chain.core.models import GeoLocation
+from chain.core.cache import get_cached, clear_on_error, clear_metadata_cache
 from chain.settings import ZMQ_PUB_URL, WEBSOCKET_PATH, WEBSOCKET_HOST
 import zmq
 
@@ -44,9 +46,24 @@ CHAIN_CURIES = [{
 
 HTTP_STATUS_SUCCESS = 200
 HTTP_STATUS_CREATED = 201
+HTTP_STATUS_ACCEPTED = 202
+HTTP_STATUS_MULTI_STATUS = 207
 HTTP_STATUS_NOT_FOUND = 404
+HTTP_STATUS_METHOD_NOT_ALLOWED = 405
 HTTP_STATUS_NOT_ACCEPTABLE = 406
+HTTP_STATUS_UNSUPPORTED_MEDIA_TYPE = 415
 HTTP_STATUS_BAD_REQUEST = 400
+HTTP_STATUS_TOO_MANY_REQUESTS = 429
+HTTP_STATUS_SERVICE_UNAVAILABLE = 503
+
+# how a list of new resources is stored, given by the "mode" query parameter.
+# Atomic lists are stored all or nothing, best-effort lists store every item
+# that they can and report the status of each item
+BATCH_MODE_ATOMIC = 'atomic'
+BATCH_MODE_BEST_EFFORT = 'best-effort'
+
+STORE_ERROR_MESSAGE = ('Error storing object. Either required fields are '
+                       'missing data or a matching object already exists')
 
 jinja_env = Environment(loader=PackageLoader('chain.core', 'templates'))
 
@@ -421,7 +438,7 @@ class Resource(object):
 
         query_args = {stub_field: field_value}
         try:
-            matching_related_obj = related_class.objects.get(**query_args)
+            matching_related_obj = get_cached(related_class, **query_args)
         except related_class.DoesNotExist:
             # a matching object doesn't exist, so we'll create it
             # TODO: this will crash if we can't build up an object based on the
@@ -641,9 +658,16 @@ class Resource(object):
             }
         return schema
 
+    @classmethod
+    def get_object(cls, request, id):
+        '''Returns the object with the given ID for a single or edit view.
+        Subclasses can override this if the ID alone doesn't say where the
+        object is stored'''
+        return cls.queryset.get(id=id)
+
     @classmethod
     def single_view(cls, request, id):
-        response_data = cls(obj=cls.queryset.get(id=id),
+        response_data = cls(obj=cls.get_object(request, id),
                             request=request).serialize()
         return cls.render_response(response_data, request)
 
@@ -651,14 +675,14 @@ class Resource(object):
     @csrf_exempt
     def edit_view(cls, request, id):
         if request.method == 'GET':
-            resource = cls(obj=cls.queryset.get(id=id), request=request)
+            resource = cls(obj=cls.get_object(request, id), request=request)
             schema = resource.get_filled_schema()
             return cls.render_response(schema, request)
 
         elif request.method == 'POST':
             #if not request.user.is_authenticated():
             #    return render_401(request)
-            resource = cls(obj=cls.queryset.get(id=id), request=request)
+            resource = cls(obj=cls.get_object(request, id), request=request)
             try:
                 data = json.loads(request.body)
             except ValueError:
@@ -670,6 +694,9 @@ class Resource(object):
                     400, 'Error storing object. Either required fields are '
                     'missing data or a matching object already exists',
                     request)
+            except ValidationError as e:
+                return render_error(HTTP_STATUS_BAD_REQUEST,
+                                    ' '.join(e.messages), request)
             response_data = resource.serialize()
             # push to the appropriate streams
             tags = resource.get_tags()
@@ -699,16 +726,25 @@ class Resource(object):
                 return cls.create_single(data, request)
 
     @classmethod
-    def create_single(cls, data, request):
+    def get_obj_params(cls, request):
+        '''Returns the query parameters of a create request, which give more
+        object data (for instance if we're posting to a child collection),
+        leaving out the ones that control how the request is handled'''
         obj_params = request.GET.dict()
+        obj_params.pop('mode', None)
+        return obj_params
+
+    @classmethod
+    def create_single(cls, data, request):
+        obj_params = cls.get_obj_params(request)
         new_resource = cls(data=data, request=request, filters=obj_params)
         try:
             new_resource.save()
         except IntegrityError:
-            return render_error(
-                400, 'Error storing object. Either required fields are '
-                'missing data or a matching object already exists',
-                request)
+            return render_error(400, STORE_ERROR_MESSAGE, request)
+        except ValidationError as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST,
+                                ' '.join(e.messages), request)
         response_data = new_resource.serialize()
         tags = new_resource.get_tags()
         if tags:
@@ -720,25 +756,61 @@ class Resource(object):
 
     @classmethod
     def create_list(cls, data, request):
+        '''Stores the whole list in a single transaction. By default the list
+        is atomic, so if any item can't be stored then none of them are. In
+        best-effort mode each item gets a savepoint, so the ones that can be
+        stored are, and the response gives the status of every item'''
+        try:
+            best_effort = get_batch_mode(request) == BATCH_MODE_BEST_EFFORT
+        except BadRequestException as e:
+            return render_error(e.status, e.message, request)
+        obj_params = cls.get_obj_params(request)
+        results = []
+        try:
+            # anything cached while storing an item that's rolled back no
+            # longer exists
+            with clear_on_error(), transaction.atomic():
+                for i, item in enumerate(data):
+                    new_resource = cls(data=item, request=request,
+                                       filters=obj_params)
+                    try:
+                        if best_effort:
+                            with transaction.atomic():
+                                new_resource.save()
+                        else:
+                            new_resource.save()
+                    except (IntegrityError, ValidationError) as e:
+                        if not best_effort:
+                            raise BatchItemError(i, e)
+                        clear_metadata_cache()
+                        results.append(BatchItemError(i, e))
+                    else:
+                        results.append(new_resource)
+        except BatchItemError as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST, e.message, request)
+
+        # the streams only hear about the new resources once they've been
+        # committed
         response_data = []
-        for item in data:
-            obj_params = request.GET.dict()
-            new_resource = cls(data=item, request=request, filters=obj_params)
-            try:
-                new_resource.save()
-            except IntegrityError:
-                return render_error(
-                    400, 'Error storing object. Either required fields are '
-                    'missing data or a matching object already exists',
-                    request)
-            response_data.append(new_resource.serialize())
-            tags = new_resource.get_tags()
+        for result in results:
+            if isinstance(result, BatchItemError):
+                response_data.append({'status': HTTP_STATUS_BAD_REQUEST,
+                                      'message': result.message})
+                continue
+            serialized = result.serialize()
+            response_data.append(
+                {'status': HTTP_STATUS_CREATED, 'resource': serialized}
+                if best_effort else serialized)
+            tags = result.get_tags()
             if tags:
-                stream_data = json.dumps(new_resource.serialize_stream())
+                stream_data = json.dumps(result.serialize_stream())
             for tag in tags:
                 zmq_socket.send_string(tag + ' ' + stream_data)
-        return cls.render_response(response_data, request,
-                                   status=HTTP_STATUS_CREATED)
+        if any(isinstance(r, BatchItemError) for r in results):
+            status = HTTP_STATUS_MULTI_STATUS
+        else:
+            status = HTTP_STATUS_CREATED
+        return cls.render_response(response_data, request, status=status)
 
     @classmethod
     def urls(cls):
@@ -755,11 +827,36 @@ class Resource(object):
 
 
 class BadRequestException(Exception):
-    def __init__(self, message):
+    def __init__(self, message, status=HTTP_STATUS_BAD_REQUEST):
         self.message = message
+        self.status = status
     def __str__(self):
         return "[Bad Request: " + repr(self.message) + "]"
 
+class BatchItemError(Exception):
+    '''Raised when an item of a posted list can't be stored'''
+    def __init__(self, index, cause):
+        if isinstance(cause, ValidationError):
+            detail = ' '.join(cause.messages)
+        else:
+            detail = STORE_ERROR_MESSAGE
+        self.index = index
+        self.message = 'Item %d: %s' % (index, detail)
+
+    def __str__(self):
+        return self.message
+
+
+def get_batch_mode(request):
+    '''Returns the mode a posted list should be stored in'''
+    mode = request.GET.get('mode', BATCH_MODE_ATOMIC)
+    if mode not in (BATCH_MODE_ATOMIC, BATCH_MODE_BEST_EFFORT):
+        raise BadRequestException('Unknown batch mode "%s", must be "%s" or '
+                                  '"%s"' % (mode, BATCH_MODE_ATOMIC,
+                                            BATCH_MODE_BEST_EFFORT))
+    return mode
+
+
 def render_error(status, msg, request):
     err_data = {
         'status': status,
@@ -0,0 +1,199 @@
+'''Archiving of old sensor data to files. Sites and sensors can have
+a RetentionPolicy giving how many days of data to keep in the database, and
+the archive_history management command moves anything older, whether it's in
+raw rows or compressed chunks, into files under ARCHIVE_ROOT. Each sensor's
+data is written a month at a time, laid out as
+
+    ARCHIVE_ROOT/sensor_id=<id>/month=<YYYY-MM>/<random>.<format>
+
+ARCHIVE_FORMAT says how new files are written. By default ("chunks") each
+file holds the same encoding as a compressed chunk (see chain.core.chunks),
+which needs nothing else installed. "parquet" writes Parquet files instead,
+which can also be read directly by tools that understand Hive-style
+partitioned datasets, and needs the optional pyarrow package. Files are read
+according to their extension, so the format can be changed at any time.
+Data that arrives late for an archived month
+goes in another file for that month next time. Each file is recorded in the
+ArchiveFile table, so reads only open the files for the time range they need,
+and chain.core.history merges them with the data still in the database.'''
+
+import heapq
+import os
+import uuid
+from datetime import timedelta
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+from django.utils.timezone import utc
+from chain.core.models import ScalarData, ScalarDataChunk, Sensor
+from chain.core.models import RetentionPolicy, ArchiveFile
+from chain.core.chunks import chunk_start, chunk_points, from_micros
+from chain.core.chunks import encode_points, decode_points, delete_rows
+from chain.core.partitions import month_start, add_months
+from chain.core.routers import get_data_db
+from chain.settings import ARCHIVE_ROOT, ARCHIVE_FORMAT
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ARCHIVE_FORMATS = ('chunks', 'parquet')
+
+
+def check_archive():
+    if not ARCHIVE_ROOT:
+        raise ImproperlyConfigured('ARCHIVE_ROOT is not set')
+    if ARCHIVE_FORMAT not in ARCHIVE_FORMATS:
+        raise ImproperlyConfigured(
+            'ARCHIVE_FORMAT must be one of: %s' % ', '.join(ARCHIVE_FORMATS))
+    if ARCHIVE_FORMAT == 'parquet':
+        check_pyarrow()
+
+
+def check_pyarrow():
+    if pyarrow is None:
+        raise ImproperlyConfigured(
+            'Parquet archive files need the pyarrow package to be installed')
+
+
+def get_retention(sensor_ids=None):
+    '''Returns a dictionary mapping the ID of each sensor with a retention
+    policy (out of the given ones, or all of them) to the number of days of
+    data to keep'''
+    keep_days = {}
+    for site_id, days in RetentionPolicy.objects.filter(
+            site__isnull=False).values_list('site_id', 'keep_days'):
+        for sensor_id in Sensor.objects.filter(
+                device__site_id=site_id).values_list('id', flat=True):
+            keep_days[sensor_id] = days
+    # sensors' own policies take precedence
+    keep_days.update(RetentionPolicy.objects.filter(
+        sensor__isnull=False).values_list('sensor_id', 'keep_days'))
+    if sensor_ids is not None:
+        keep_days = dict((sensor_id, keep_days[sensor_id])
+                         for sensor_id in sensor_ids if sensor_id in keep_days)
+    return keep_days
+
+
+def archive_path(sensor_id, month):
+    return os.path.join('sensor_id=%d' % sensor_id,
+                        'month=%04d-%02d' % (month.year, month.month),
+                        '%s.%s' % (uuid.uuid4().hex, ARCHIVE_FORMAT))
+
+
+def write_archive(path, points):
+    '''Writes a list of (timestamp, value) pairs to a file at the given path
+    under ARCHIVE_ROOT, in the format its extension gives'''
+    full_path = os.path.join(ARCHIVE_ROOT, path)
+    if not os.path.isdir(os.path.dirname(full_path)):
+        os.makedirs(os.path.dirname(full_path))
+    if not path.endswith('.parquet'):
+        with open(full_path, 'wb') as f:
+            f.write(encode_points(points))
+        return
+    # naive UTC times, as older versions of pyarrow don't convert aware ones
+    table = pyarrow.Table.from_arrays([
+        pyarrow.array([t.astimezone(utc).replace(tzinfo=None)
+                       for t, _ in points],
+                      type=pyarrow.timestamp('us', tz='UTC')),
+        pyarrow.array([value for _, value in points],
+                      type=pyarrow.float64()),
+    ], names=['timestamp', 'value'])
+    pyarrow.parquet.write_table(table, full_path)
+
+
+def read_archive(path, start=None, end=None):
+    '''Returns the (timestamp, value) pairs from start up to end in a file
+    in the archive'''
+    if not ARCHIVE_ROOT:
+        raise ImproperlyConfigured('ARCHIVE_ROOT is not set')
+    full_path = os.path.join(ARCHIVE_ROOT, path)
+    if path.endswith('.parquet'):
+        check_pyarrow()
+        table = pyarrow.parquet.read_table(full_path,
+                                           columns=['timestamp', 'value'])
+        # read the times as microseconds, as pyarrow needs pytz to convert
+        # them to datetimes
+        times = table.column('timestamp').cast(pyarrow.int64())
+        stored = [(from_micros(micros), value) for micros, value in zip(
+            times.to_pylist(), table.column('value').to_pylist())]
+    else:
+        with open(full_path, 'rb') as f:
+            stored = decode_points(f.read())
+    return [(timestamp, value) for timestamp, value in stored
+            if (start is None or timestamp >= start) and
+            (end is None or timestamp < end)]
+
+
+def archive_points(files, start=None, end=None):
+    '''Returns an iterator over the (timestamp, value) pairs from start up to
+    end in the given archive files, in time order'''
+    return heapq.merge(*[read_archive(archive_file.path, start, end)
+                         for archive_file in files])
+
+
+def archive_history(now=None, sensor_ids=None, moved=None):
+    '''Moves the data that's older than its retention policy allows into the
+    archive, for the given sensors (or all of them). Data is moved whole days
+    at a time, with each month of each sensor's data written to a file in its
+    own transaction. Returns the number of points archived. If moved is
+    given, the IDs of the sensors whose data was archived are added to it'''
+    check_archive()
+    now = now or timezone.now()
+    count = 0
+    for sensor_id, keep_days in get_retention(sensor_ids).items():
+        before = chunk_start(now - timedelta(days=keep_days))
+        while True:
+            first = first_timestamp(sensor_id, before)
+            if first is None:
+                break
+            month = month_start(first)
+            with transaction.atomic(using=get_data_db(sensor_id)):
+                count += archive_month(sensor_id, month,
+                                       min(add_months(month, 1), before))
+            if moved is not None:
+                moved.add(sensor_id)
+    return count
+
+
+def first_timestamp(sensor_id, before):
+    '''Returns the time of the sensor's first data still in the database, if
+    it's before the given time'''
+    using = get_data_db(sensor_id)
+    raw = ScalarData.objects.using(using).filter(
+        sensor_id=sensor_id, timestamp__lt=before).order_by(
+            'timestamp').values_list('timestamp', flat=True)[:1]
+    chunk = ScalarDataChunk.objects.using(using).filter(
+        sensor_id=sensor_id, start__lt=before).order_by(
+            'start').values_list('start', flat=True)[:1]
+    firsts = list(raw) + list(chunk)
+    return min(firsts) if firsts else None
+
+
+def archive_month(sensor_id, month, end):
+    '''Moves the sensor's data from the given month up to end into a new
+    archive file. end must be the start of a chunk. Returns the number of
+    points moved'''
+    using = get_data_db(sensor_id)
+    rows = list(ScalarData.objects.using(using).filter(
+        sensor_id=sensor_id, timestamp__gte=month,
+        timestamp__lt=end).order_by('timestamp').values_list(
+            'id', 'timestamp', 'value'))
+    chunks = list(ScalarDataChunk.objects.using(using).select_for_update(
+        ).filter(sensor_id=sensor_id, start__gte=month,
+                 start__lt=end).order_by('start'))
+    points = list(heapq.merge(
+        [(timestamp, value) for _, timestamp, value in rows],
+        chunk_points(chunks)))
+    path = archive_path(sensor_id, month)
+    write_archive(path, points)
+    ArchiveFile.objects.using(using).create(
+        sensor_id=sensor_id, start=month, end=end, count=len(points),
+        path=path)
+    # only delete the rows that went into the file, in case more arrived
+    delete_rows([row[0] for row in rows], using)
+    ScalarDataChunk.objects.using(using).filter(
+        id__in=[chunk.id for chunk in chunks]).delete()
+    return len(points)
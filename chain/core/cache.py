@@ -0,0 +1,144 @@
+'''An in-process cache of the metadata that's looked up on the data ingest
+path, such as which device and site a sensor belongs to, a device's sensors by
+metric, Metrics and Units by name, and sensors' ingest policies. With a warm
+cache, storing data doesn't need any queries besides the INSERT itself.
+
+Metadata rarely changes, so rather than tracking exactly what depends on what,
+the whole cache is cleared whenever a Site, Device, Sensor, Metric, Unit or
+IngestPolicy is saved or deleted in this process. Changes made by other
+processes (e.g. other gunicorn workers) are picked up once entries expire,
+after METADATA_CACHE_TTL seconds.'''
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from chain.core.models import Site, Device, Sensor, Metric, Unit
+from chain.core.models import IngestPolicy
+from chain.settings import METADATA_CACHE_SIZE, METADATA_CACHE_TTL
+
+
+class LRUCache(object):
+    '''A thread-safe dictionary that holds at most max_size entries,
+    discarding the least recently used when it's full. Entries also expire
+    ttl seconds after they're set, unless ttl is None'''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # re-inserting moves it to the most recently used end
+            self._entries[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            expires = None if self.ttl is None else time.time() + self.ttl
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_objects = LRUCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+_device_sensors = LRUCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+_ingest_policies = LRUCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+
+def get_cached(model, **lookup):
+    '''Does model.objects.get(**lookup), unless the same lookup has been done
+    recently. Raises model.DoesNotExist if there's no match. The returned
+    object is shared, so it must not be modified'''
+    key = (model, tuple(sorted(lookup.items())))
+    obj = _objects.get(key)
+    if obj is None:
+        obj = model.objects.get(**lookup)
+        _objects.set(key, obj)
+    return obj
+
+
+def get_sensor_tags(sensor_id):
+    '''Returns the stream tags for data from the given sensor. Raises
+    Sensor.DoesNotExist if there's no such sensor'''
+    sensor = get_cached(Sensor, id=sensor_id)
+    device = get_cached(Device, id=sensor.device_id)
+    return ['sensor-%d' % sensor.id,
+            'device-%d' % device.id,
+            'site-%d' % device.site_id]
+
+
+def get_device_sensors(device_id):
+    '''Returns a dictionary mapping metric names to the given device's
+    sensors. The dictionary is a copy, but the sensors are shared'''
+    sensors = _device_sensors.get(device_id)
+    if sensors is None:
+        sensors = {sensor.metric.name: sensor for sensor in
+                   Sensor.objects.filter(device_id=device_id).select_related(
+                       'metric')}
+        _device_sensors.set(device_id, sensors)
+    return dict(sensors)
+
+
+def get_ingest_policy(sensor_id):
+    '''Returns the IngestPolicy for the given sensor ID, or None if it
+    doesn't have one'''
+    try:
+        sensor_id = int(sensor_id)
+    except (TypeError, ValueError):
+        return None
+    # most sensors don't have a policy, so that needs caching too
+    policy = _ingest_policies.get(sensor_id)
+    if policy is None:
+        try:
+            policy = IngestPolicy.objects.get(sensor_id=sensor_id)
+        except IngestPolicy.DoesNotExist:
+            policy = False
+        _ingest_policies.set(sensor_id, policy)
+    return policy or None
+
+
+def clear_metadata_cache():
+    _objects.clear()
+    _device_sensors.clear()
+    _ingest_policies.clear()
+
+
+@contextmanager
+def clear_on_error():
+    '''Clears the cache if the wrapped block raises an exception. Use this
+    around transactions that might create metadata, as anything that was
+    cached in a transaction that's rolled back no longer exists'''
+    try:
+        yield
+    except Exception:
+        clear_metadata_cache()
+        raise
+
+
+@receiver([post_save, post_delete], sender=Site)
+@receiver([post_save, post_delete], sender=Device)
+@receiver([post_save, post_delete], sender=Sensor)
+@receiver([post_save, post_delete], sender=Metric)
+@receiver([post_save, post_delete], sender=Unit)
+@receiver([post_save, post_delete], sender=IngestPolicy)
+def metadata_changed(sender, **kwargs):
+    clear_metadata_cache()
@@ -0,0 +1,210 @@
+'''Compressed storage for old sensor data. Once a span of a sensor's history
+is old enough that it's unlikely to change, the compress_history management
+command packs each sensor's data for each UTC day into one ScalarDataChunk
+row and deletes the raw ScalarData rows. A raw row costs over 100 bytes once
+its indexes are counted, where a chunk usually takes a few bytes per point:
+
+* timestamps are stored as the difference between successive gaps between
+  points (delta-of-delta), which is zero for regularly sampled data
+* values are stored XORed with the previous value, which leaves only the
+  bits that changed, so repeated values take a single byte
+* both are written as variable-length integers and then compressed with zlib
+
+Reads go through chain.core.history, which merges the chunks with any raw
+rows in the same time range, so nothing above that needs to know where the
+data is stored. Data that arrives late for a day that's already been
+compressed is stored as raw rows as usual, and merged into the chunk the
+next time compress_history runs.
+
+Rollups aren't touched by compression, and rebuilding them reads the chunks
+too.'''
+
+import calendar
+import heapq
+import struct
+import zlib
+from datetime import datetime, timedelta
+from django.db import transaction
+from django.db.models.sql import DeleteQuery
+from django.utils.timezone import utc
+from chain.core.models import ScalarData, ScalarDataChunk, Sensor
+from chain.core.routers import get_data_db
+
+CHUNK_DURATION = timedelta(days=1)
+FORMAT_VERSION = 1
+# how many raw rows to delete per query once they're stored in a chunk
+DELETE_BATCH_SIZE = 1000
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+
+def to_micros(timestamp):
+    return calendar.timegm(timestamp.utctimetuple()) * 1000000 + \
+        timestamp.microsecond
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def float_bits(value):
+    return struct.unpack('<Q', struct.pack('<d', value))[0]
+
+
+def bits_float(bits):
+    return struct.unpack('<d', struct.pack('<Q', bits))[0]
+
+
+def write_varint(out, number):
+    '''Appends a non-negative integer to a bytearray, 7 bits per byte with
+    the high bit set on every byte but the last'''
+    while number >= 0x80:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def read_varint(data, pos):
+    '''Reads a varint from a bytearray, returning it and the position after
+    it'''
+    number = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+
+def zigzag(number):
+    '''Maps signed integers to non-negative ones so that small negative
+    numbers stay small: 0, -1, 1, -2... become 0, 1, 2, 3...'''
+    return number * 2 if number >= 0 else -number * 2 - 1
+
+
+def unzigzag(number):
+    return number // 2 if not number & 1 else -(number + 1) // 2
+
+
+def encode_points(points):
+    '''Encodes a time-ordered list of (timestamp, value) pairs into a
+    compressed string'''
+    out = bytearray([FORMAT_VERSION])
+    write_varint(out, len(points))
+    last_time = last_delta = 0
+    for timestamp, _ in points:
+        micros = to_micros(timestamp)
+        delta = micros - last_time
+        write_varint(out, zigzag(delta - last_delta))
+        last_time, last_delta = micros, delta
+    last_bits = 0
+    for _, value in points:
+        bits = float_bits(value)
+        write_varint(out, bits ^ last_bits)
+        last_bits = bits
+    return zlib.compress(bytes(out))
+
+
+def decode_points(data):
+    '''Decodes a string from encode_points back into a list of (timestamp,
+    value) pairs'''
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    data = bytearray(zlib.decompress(data))
+    if data[0] != FORMAT_VERSION:
+        raise ValueError('Unknown chunk format %d' % data[0])
+    count, pos = read_varint(data, 1)
+    times = []
+    last_time = last_delta = 0
+    for _ in range(count):
+        delta_delta, pos = read_varint(data, pos)
+        last_delta += unzigzag(delta_delta)
+        last_time += last_delta
+        times.append(from_micros(last_time))
+    values = []
+    last_bits = 0
+    for _ in range(count):
+        xored, pos = read_varint(data, pos)
+        last_bits ^= xored
+        values.append(bits_float(last_bits))
+    return zip(times, values)
+
+
+def chunk_start(timestamp):
+    '''Returns the start of the chunk that an aware datetime falls in'''
+    seconds = calendar.timegm(timestamp.utctimetuple())
+    return datetime.utcfromtimestamp(
+        seconds - seconds % int(CHUNK_DURATION.total_seconds())).replace(
+            tzinfo=utc)
+
+
+def chunk_points(chunks, start=None, end=None):
+    '''Yields the (timestamp, value) pairs stored in the given time-ordered
+    chunks, from start up to end'''
+    for chunk in chunks:
+        for timestamp, value in decode_points(chunk.data):
+            if (start is None or timestamp >= start) and \
+                    (end is None or timestamp < end):
+                yield timestamp, value
+
+
+def delete_rows(ids, using):
+    '''Deletes the raw rows with the given IDs once their points are stored
+    somewhere else. This skips the post_delete signal, as the points haven't
+    gone, and Django would have to load every row to send it'''
+    for i in range(0, len(ids), DELETE_BATCH_SIZE):
+        DeleteQuery(ScalarData).delete_batch(ids[i:i + DELETE_BATCH_SIZE],
+                                             using)
+
+
+def compress_history(before, sensor_ids=None, moved=None):
+    '''Moves raw data from before the given time into chunks, for the given
+    sensors (or all of them). before is rounded down to the start of a chunk,
+    so only whole chunks are written. Each chunk is written in its own
+    transaction. Returns the number of points compressed. If moved is given,
+    the IDs of the sensors whose data was compressed are added to it'''
+    before = chunk_start(before)
+    if sensor_ids is None:
+        sensor_ids = Sensor.objects.values_list('id', flat=True)
+    count = 0
+    for sensor_id in sensor_ids:
+        using = get_data_db(sensor_id)
+        while True:
+            first = ScalarData.objects.using(using).filter(
+                sensor_id=sensor_id, timestamp__lt=before).order_by(
+                    'timestamp').values_list('timestamp', flat=True)[:1]
+            if not first:
+                break
+            with transaction.atomic(using=using):
+                count += compress_chunk(sensor_id, chunk_start(first[0]))
+            if moved is not None:
+                moved.add(sensor_id)
+    return count
+
+
+def compress_chunk(sensor_id, start):
+    '''Moves the sensor's raw data in the chunk starting at start into the
+    chunk, merging it with the points already there. Returns the number of
+    raw points moved'''
+    end = start + CHUNK_DURATION
+    using = get_data_db(sensor_id)
+    rows = list(ScalarData.objects.using(using).filter(
+        sensor_id=sensor_id, timestamp__gte=start,
+        timestamp__lt=end).order_by('timestamp').values_list(
+            'id', 'timestamp', 'value'))
+    points = [(timestamp, value) for _, timestamp, value in rows]
+    try:
+        chunk = ScalarDataChunk.objects.using(using).select_for_update(
+            ).get(sensor_id=sensor_id, start=start)
+    except ScalarDataChunk.DoesNotExist:
+        chunk = ScalarDataChunk(sensor_id=sensor_id, start=start, end=end)
+    else:
+        points = list(heapq.merge(decode_points(chunk.data), points))
+    chunk.count = len(points)
+    chunk.data = encode_points(points)
+    chunk.save(using=using)
+    # only delete the rows that went into the chunk, in case more arrived
+    delete_rows([row[0] for row in rows], using)
+    return len(rows)
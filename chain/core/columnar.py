@@ -0,0 +1,243 @@
+'''Flat columnar files of each sensor's data, one per UTC day, for reading
+long histories quickly. Once a day is over, the materialize_days management
+command writes the day's data to
+
+    COLUMNAR_DATA_DIR/sensor-<id>/<YYYY-MM-DD>.col
+
+which is a 16-byte header (the magic string "CCOL", a uint32 version and an
+int64 count of points), then the timestamps as contiguous little-endian int64
+microseconds since the unix epoch, then the values as contiguous float64s.
+The files are memory-mapped to read them, and with numpy installed
+day_arrays gives zero-copy arrays of a day's timestamps and values.
+
+A file is only used if it holds as many points as the day's rollup says the
+sensor stored that day, so data that arrives after a day has been written is
+never missed: the day is read from the database instead until
+materialize_days rewrites it. That needs day rollups, i.e. 86400 in
+ROLLUP_RESOLUTIONS, and without them (or for days whose rollups are missing)
+the data is always read from the database.
+
+The API serves data in the packed binary format (see
+chain.core.ingest.PACKED_DATA_MIME_TYPE) from these files where it can.'''
+
+import mmap
+import os
+import struct
+from datetime import timedelta
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from chain.core.models import ScalarDataRollup, Sensor
+from chain.core.chunks import to_micros
+from chain.core.history import iter_points
+from chain.core.rollups import bucket_start
+from chain.core.routers import get_data_db, get_data_read_db
+from chain.settings import COLUMNAR_DATA_DIR, ROLLUP_RESOLUTIONS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DAY = 24 * 60 * 60
+MAGIC = 'CCOL'
+VERSION = 1
+HEADER = struct.Struct('<4sIq')
+PACKED_RECORD = [('timestamp', '<i8'), ('value', '<f8')]
+
+
+def check_columnar():
+    if not COLUMNAR_DATA_DIR:
+        raise ImproperlyConfigured('COLUMNAR_DATA_DIR is not set')
+    if DAY not in ROLLUP_RESOLUTIONS:
+        raise ImproperlyConfigured(
+            'Columnar files need day rollups, so ROLLUP_RESOLUTIONS must '
+            'include %d' % DAY)
+
+
+def day_path(sensor_id, day):
+    return os.path.join(COLUMNAR_DATA_DIR, 'sensor-%d' % sensor_id,
+                        day.strftime('%Y-%m-%d') + '.col')
+
+
+def write_day(sensor_id, day, points):
+    '''Writes a time-ordered list of (timestamp, value) pairs to the file
+    for the given sensor and day, replacing it atomically'''
+    path = day_path(sensor_id, day)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    count = len(points)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, count))
+        f.write(struct.pack('<%dq' % count,
+                            *[to_micros(t) for t, _ in points]))
+        f.write(struct.pack('<%dd' % count, *[v for _, v in points]))
+    os.rename(temp_path, path)
+
+
+def open_day(sensor_id, day):
+    '''Returns a read-only memory map of the file for the given sensor and
+    day, or None if there isn't one'''
+    try:
+        with open(day_path(sensor_id, day), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        # mmap raises ValueError for an empty file
+        return None
+    magic, version, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+    return data
+
+
+def day_count(data):
+    return HEADER.unpack_from(data)[2]
+
+
+def day_columns(data, first=0, last=None):
+    '''Returns the timestamps (in microseconds) and values of the points from
+    index first up to last in a mapped file, as zero-copy numpy arrays if
+    numpy is installed or otherwise tuples'''
+    count = day_count(data)
+    if last is None:
+        last = count
+    if numpy is not None:
+        timestamps, values = day_arrays(data)
+        return timestamps[first:last], values[first:last]
+    n = last - first
+    timestamps = struct.unpack_from('<%dq' % n, data, HEADER.size + first * 8)
+    values = struct.unpack_from('<%dd' % n, data,
+                                HEADER.size + (count + first) * 8)
+    return timestamps, values
+
+
+def day_arrays(data):
+    '''Returns numpy arrays of the timestamps (in microseconds) and values in
+    a mapped file. These are views of the file, so no data is copied'''
+    count = day_count(data)
+    timestamps = numpy.frombuffer(data, dtype='<i8', count=count,
+                                  offset=HEADER.size)
+    values = numpy.frombuffer(data, dtype='<f8', count=count,
+                              offset=HEADER.size + count * 8)
+    return timestamps, values
+
+
+def search(data, micros):
+    '''Returns the index of the first point at or after the given time in a
+    mapped file'''
+    low, high = 0, day_count(data)
+    while low < high:
+        middle = (low + high) // 2
+        if struct.unpack_from('<q', data, HEADER.size + middle * 8)[0] < \
+                micros:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def day_counts(sensor_id, start, end):
+    '''Returns a dictionary mapping the start of each day from start up to
+    end to the number of points the sensor stored that day, from the day
+    rollups. Days without data are left out'''
+    rollups = ScalarDataRollup.objects.using(get_data_read_db(sensor_id))
+    return dict(rollups.filter(
+        sensor_id=sensor_id, resolution=DAY,
+        start__gte=bucket_start(start, DAY), start__lt=end).values_list(
+            'start', 'count'))
+
+
+def iter_columns(sensor_id, start, end):
+    '''Yields tuples of the sensor's timestamps (in microseconds) and values
+    from start up to end. Days with an up to date file are read from it, a
+    day at a time, and each run of days between them from the database.
+    Without day rollups a file can't be checked, so then everything is read
+    from the database'''
+    use_files = bool(COLUMNAR_DATA_DIR) and DAY in ROLLUP_RESOLUTIONS
+    counts = day_counts(sensor_id, start, end) if use_files else {}
+    start_micros, end_micros = to_micros(start), to_micros(end)
+    # the start of the data that still needs reading from the database
+    pending = start
+    day = bucket_start(start, DAY)
+    while day < end:
+        next_day = day + timedelta(seconds=DAY)
+        data = open_day(sensor_id, day) if day in counts else None
+        if data is not None and day_count(data) == counts[day]:
+            if pending < day:
+                yield read_points(sensor_id, pending, day)
+            yield day_columns(data, search(data, start_micros),
+                              search(data, end_micros))
+            pending = min(end, next_day)
+        day = next_day
+    if pending < end:
+        yield read_points(sensor_id, pending, end)
+
+
+def read_points(sensor_id, start, end):
+    '''Returns tuples of the sensor's timestamps (in microseconds) and values
+    from start up to end, read from the database'''
+    points = list(iter_points(sensor_id, start, end))
+    return (tuple(to_micros(t) for t, _ in points),
+            tuple(v for _, v in points))
+
+
+def pack_data(sensor_id, start, end):
+    '''Returns the sensor's data from start up to end in the packed binary
+    format, a little-endian int64 timestamp in milliseconds followed by a
+    float64 value for each point'''
+    chunks = []
+    for timestamps, values in iter_columns(sensor_id, start, end):
+        if not len(timestamps):
+            continue
+        if numpy is not None:
+            records = numpy.empty(len(timestamps), dtype=PACKED_RECORD)
+            records['timestamp'] = numpy.asarray(timestamps) // 1000
+            records['value'] = values
+            chunks.append(records.tostring())
+            continue
+        flat = [None] * (2 * len(timestamps))
+        flat[0::2] = [t // 1000 for t in timestamps]
+        flat[1::2] = values
+        chunks.append(struct.pack('<' + 'qd' * len(timestamps), *flat))
+    return ''.join(chunks)
+
+
+def load_columns(sensor_id, start, end):
+    '''Returns numpy arrays of the sensor's timestamps (as numpy datetimes)
+    and values from start up to end'''
+    timestamps = []
+    values = []
+    for day_timestamps, day_values in iter_columns(sensor_id, start, end):
+        timestamps.append(numpy.asarray(day_timestamps, dtype='<i8'))
+        values.append(numpy.asarray(day_values, dtype='<f8'))
+    if not timestamps:
+        return (numpy.array([], dtype='datetime64[us]'),
+                numpy.array([], dtype='<f8'))
+    return (numpy.concatenate(timestamps).astype('datetime64[us]'),
+            numpy.concatenate(values))
+
+
+def materialize_days(before=None, sensor_ids=None):
+    '''Writes the file for every day before the given time (by default, every
+    finished day) that doesn't have an up to date one, for the given sensors
+    (or all of them). Returns the number of files written'''
+    check_columnar()
+    before = bucket_start(before or timezone.now(), DAY)
+    if sensor_ids is None:
+        sensor_ids = Sensor.objects.values_list('id', flat=True)
+    written = 0
+    for sensor_id in sensor_ids:
+        days = ScalarDataRollup.objects.using(get_data_db(sensor_id)).filter(
+            sensor_id=sensor_id, resolution=DAY,
+            start__lt=before).values_list('start', 'count')
+        for day, count in days:
+            data = open_day(sensor_id, day)
+            if data is not None:
+                current = day_count(data) == count
+                data.close()
+                if current:
+                    continue
+            write_day(sensor_id, day, list(iter_points(
+                sensor_id, day, day + timedelta(seconds=DAY))))
+            written += 1
+    return written
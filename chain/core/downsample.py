@@ -0,0 +1,73 @@
+'''Downsampling of sensor data for charts, which can't usefully draw more
+points than they have pixels. Largest-Triangle-Three-Buckets keeps the points
+that matter most to the shape of the line, such as peaks and dips, rather
+than averaging them away. See Sveinn Steinarsson, "Downsampling Time Series
+for Visual Representation" (2013).'''
+
+import calendar
+from datetime import datetime
+from django.utils.timezone import utc
+
+
+def to_epoch(timestamp):
+    '''Converts an aware datetime to seconds since the unix epoch'''
+    return calendar.timegm(timestamp.utctimetuple()) + \
+        timestamp.microsecond / 1e6
+
+
+def from_epoch(seconds):
+    return datetime.utcfromtimestamp(seconds).replace(tzinfo=utc)
+
+
+def lttb(points, threshold):
+    '''Downsamples a list of (x, y) points, sorted by x, to at most threshold
+    points using Largest-Triangle-Three-Buckets. The first and last points are
+    always kept. The points in between are split into threshold - 2 buckets,
+    and from each we keep the point that makes the largest triangle with the
+    point kept from the previous bucket and the average of the next one'''
+    if threshold >= len(points) or threshold < 3:
+        return list(points)
+    sampled = [points[0]]
+    bucket_size = (len(points) - 2) / float(threshold - 2)
+    previous = points[0]
+    for i in range(threshold - 2):
+        # the average of the next bucket, which for the last bucket is just
+        # the last point
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, len(points))
+        next_bucket = points[next_start:next_end]
+        avg_x = sum(x for x, _ in next_bucket) / len(next_bucket)
+        avg_y = sum(y for _, y in next_bucket) / len(next_bucket)
+
+        prev_x, prev_y = previous
+        best_area = -1
+        for point in points[int(i * bucket_size) + 1:next_start]:
+            # twice the area of the triangle, which is fine for comparing
+            area = abs((prev_x - avg_x) * (point[1] - prev_y) -
+                       (prev_x - point[0]) * (avg_y - prev_y))
+            if area > best_area:
+                best_area = area
+                best = point
+        sampled.append(best)
+        previous = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def rollup_points(rollups):
+    '''Turns rollups into points for downsampling, giving each bucket its min
+    and max so that peaks and dips survive. We don't know when in the bucket
+    they happened, so they're put at its start and middle, with the max first
+    if the data fell over the bucket'''
+    points = []
+    for rollup in rollups:
+        start = to_epoch(rollup.start)
+        if rollup.min == rollup.max:
+            points.append((start, rollup.min))
+            continue
+        extremes = [rollup.min, rollup.max]
+        if rollup.first > rollup.last:
+            extremes.reverse()
+        points.append((start, extremes[0]))
+        points.append((start + rollup.resolution / 2.0, extremes[1]))
+    return points
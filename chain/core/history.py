@@ -0,0 +1,79 @@
+'''Reads a sensor's data from wherever it's stored. Recent data is in the
+ScalarData table, older data may have been compressed into chunks (see
+chain.core.chunks), and the oldest may have been moved out of the database
+into the archive (see chain.core.archive). Anything that needs a sensor's
+data from before now should read it through here.'''
+
+import heapq
+from chain.core.models import ScalarData, ScalarDataChunk, ArchiveFile
+from chain.core.chunks import chunk_points
+from chain.core.archive import archive_points, read_archive
+from chain.core.routers import get_data_read_db
+
+
+def iter_points(sensor_id, start=None, end=None):
+    '''Yields the sensor's (timestamp, value) pairs from start up to end, in
+    time order'''
+    using = get_data_read_db(sensor_id)
+    data = ScalarData.objects.using(using).filter(sensor_id=sensor_id)
+    chunks = ScalarDataChunk.objects.using(using).filter(sensor_id=sensor_id)
+    files = ArchiveFile.objects.using(using).filter(sensor_id=sensor_id)
+    if start is not None:
+        data = data.filter(timestamp__gte=start)
+        chunks = chunks.filter(end__gt=start)
+        files = files.filter(end__gt=start)
+    if end is not None:
+        data = data.filter(timestamp__lt=end)
+        chunks = chunks.filter(start__lt=end)
+        files = files.filter(start__lt=end)
+    # the chunks and files are fetched up front so that the raw rows can be
+    # streamed
+    chunks = list(chunks.order_by('start'))
+    files = list(files)
+    raw = data.order_by('timestamp').values_list('timestamp', 'value')
+    if not chunks and not files:
+        return iter(raw.iterator())
+    return heapq.merge(raw.iterator(), chunk_points(chunks, start, end),
+                       archive_points(files, start, end))
+
+
+def has_cold_data(sensor_id, start, end):
+    '''Returns whether any of the sensor's data from start up to end has been
+    compressed or archived'''
+    using = get_data_read_db(sensor_id)
+    return ScalarDataChunk.objects.using(using).filter(
+        sensor_id=sensor_id, end__gt=start, start__lt=end).exists() or \
+        ArchiveFile.objects.using(using).filter(
+            sensor_id=sensor_id, end__gt=start, start__lt=end).exists()
+
+
+def last_point(sensor_id, before=None):
+    '''Returns the sensor's last (timestamp, value) pair before the given
+    time (or at all), or None if it doesn't have one'''
+    using = get_data_read_db(sensor_id)
+    data = ScalarData.objects.using(using).filter(sensor_id=sensor_id)
+    chunks = ScalarDataChunk.objects.using(using).filter(sensor_id=sensor_id)
+    if before is not None:
+        data = data.filter(timestamp__lt=before)
+        chunks = chunks.filter(start__lt=before)
+    raw = data.order_by('-timestamp').values_list('timestamp', 'value')[:1]
+    last = raw[0] if raw else None
+    chunk = chunks.order_by('-start')[:1]
+    if chunk and (last is None or last[0] < chunk[0].end):
+        points = list(chunk_points(chunk, end=before))
+        if points and (last is None or points[-1][0] >= last[0]):
+            last = points[-1]
+    if last is None:
+        # the archive only holds data older than what's in the database, so
+        # it only needs reading if there's nothing here
+        files = ArchiveFile.objects.using(using).filter(sensor_id=sensor_id)
+        if before is not None:
+            files = files.filter(start__lt=before)
+        for archive_file in files.order_by('-end'):
+            # a file only holds points before its end
+            if last is not None and last[0] >= archive_file.end:
+                break
+            points = read_archive(archive_file.path, end=before)
+            if points and (last is None or points[-1][0] > last[0]):
+                last = points[-1]
+    return last
@@ -0,0 +1,759 @@
+'''Support for getting sensor data into the database quickly. This module
+deliberately doesn't import the API layer, so it can also be used by processes
+that write data without serving HTTP requests.'''
+
+import atexit
+import json
+import logging
+import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.timezone import utc
+from django.utils.tzinfo import FixedOffset
+from chain.core.models import ScalarData, Device, Sensor, Metric, Unit
+from chain.core.models import IngestBatch, DATA_TYPE_STATE
+from chain.core.cache import get_cached, get_device_sensors
+from chain.core.cache import get_ingest_policy, LRUCache
+from chain.core.rollups import update_rollups
+from chain.core.latest import update_latest_values, get_latest_values
+from chain.core.recent import stage_recent
+from chain.core.routers import group_by_db
+from chain.settings import INGEST_WRITE_BEHIND, INGEST_BUFFER_MAX_SIZE
+from chain.settings import INGEST_FLUSH_SIZE, INGEST_FLUSH_INTERVAL
+from chain.settings import METADATA_CACHE_SIZE
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+_timestamp_field = ScalarData._meta.get_field('timestamp')
+
+
+def flatten_metrics(metrics, prefix=''):
+    '''Flattens a possibly nested dictionary of metric values, joining the
+    keys of nested dictionaries with underscores, e.g.
+
+        {"charge_flags": {"fault": false}} -> {"charge_flags_fault": false}
+    '''
+    flat = {}
+    for name, value in metrics.items():
+        if isinstance(value, dict):
+            flat.update(flatten_metrics(value, prefix + name + '_'))
+        else:
+            flat[prefix + name] = value
+    return flat
+
+
+ISO_TIMESTAMP_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6})\d*)?)?'
+    r'\s*(Z|[+-]\d\d(?::?\d\d)?)?$')
+
+# timezones for the UTC offsets we've seen, so they're only built once
+_offset_timezones = {'Z': utc}
+
+
+def _offset_timezone(offset):
+    try:
+        return _offset_timezones[offset]
+    except KeyError:
+        minutes = 60 * int(offset[1:3]) + int(offset[-2:] if len(offset) > 3
+                                              else 0)
+        tz = FixedOffset(-minutes if offset[0] == '-' else minutes)
+        _offset_timezones[offset] = tz
+        return tz
+
+
+def parse_timestamp(value):
+    '''Converts an ISO 8601 string, a number of seconds since the unix epoch
+    or a datetime to an aware datetime. Times without a UTC offset are in the
+    default timezone. This is much quicker than DateTimeField.to_python, which
+    it falls back on for other formats. Raises ValidationError if the
+    timestamp is invalid'''
+    match = None
+    if isinstance(value, basestring):
+        match = ISO_TIMESTAMP_RE.match(value)
+    if match is not None:
+        (year, month, day, hour, minute, second, fraction,
+         offset) = match.groups()
+        try:
+            timestamp = datetime(
+                int(year), int(month), int(day), int(hour), int(minute),
+                int(second) if second else 0,
+                int(fraction.ljust(6, '0')) if fraction else 0,
+                _offset_timezone(offset) if offset else None)
+        except ValueError as e:
+            raise ValidationError('Invalid timestamp %s: %s' % (value, e))
+    elif isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool):
+        try:
+            return datetime.utcfromtimestamp(value).replace(tzinfo=utc)
+        except (ValueError, OverflowError):
+            raise ValidationError('Invalid timestamp %s' % value)
+    elif isinstance(value, (basestring, datetime)):
+        timestamp = _timestamp_field.to_python(value)
+    else:
+        raise ValidationError('Invalid timestamp %r' % (value,))
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp,
+                                        timezone.get_default_timezone())
+    return timestamp
+
+
+def parse_value(value):
+    '''Converts a data value to a float, raising ValidationError if it isn't
+    a finite number'''
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValidationError('Invalid value %r' % (value,))
+    # this is only false for NaN and infinity
+    if value - value != 0.0:
+        raise ValidationError('Values must be finite, got %s' % value)
+    return value
+
+
+class DataValidator(object):
+    '''Converts lists of posted data points, e.g.
+
+        [{"value": 22.3, "timestamp": "2014-04-12T15:00:04+00:00"}, ...]
+
+    into unsaved ScalarData objects. This is equivalent to deserializing each
+    point as a resource, but skips the per-field lookups and conversions that
+    makes that slow for large batches. Errors give the index of the offending
+    point'''
+
+    def __init__(self, required_fields):
+        self.required_fields = list(required_fields)
+        # models are several times quicker to build from positional
+        # arguments in field order than from keyword arguments
+        self._attnames = [f.attname for f in ScalarData._meta.concrete_fields]
+        self._timestamp_index = self._attnames.index('timestamp')
+        self._value_index = self._attnames.index('value')
+
+    def build_item(self, i, item, fields):
+        '''Builds the ScalarData object for the i'th point. fields holds any
+        other model fields, which will usually just be the sensor_id'''
+        if not isinstance(item, dict):
+            raise ValidationError('Item %d is not a data object' % i)
+        missing = [f for f in self.required_fields if f not in item]
+        if missing:
+            raise ValidationError('Item %d is missing required fields: %s' %
+                                  (i, ', '.join(missing)))
+        args = [fields.get(name) for name in self._attnames]
+        try:
+            args[self._timestamp_index] = parse_timestamp(
+                item['timestamp']) if 'timestamp' in item else timezone.now()
+            args[self._value_index] = parse_value(item['value'])
+        except ValidationError as e:
+            raise ValidationError(
+                'Item %d is invalid: %s' % (i, ' '.join(e.messages)))
+        return ScalarData(*args)
+
+    def build(self, items, fields):
+        '''Builds the ScalarData objects for a whole list of points'''
+        build_item = self.build_item
+        return [build_item(i, item, fields) for i, item in enumerate(items)]
+
+
+def build_scalar_data(metrics, sensors, timestamp=None):
+    '''Builds unsaved ScalarData objects from a dictionary of metric values,
+    using the sensors dictionary to map each metric name to its Sensor. All
+    the points get the given timestamp, which may be a string. Raises
+    ValidationError if the timestamp or any of the values are invalid'''
+    if timestamp is None:
+        timestamp = timezone.now()
+    else:
+        timestamp = parse_timestamp(timestamp)
+    objs = []
+    for name, value in metrics.items():
+        if value is None:
+            raise ValidationError('No value given for %s' % name)
+        try:
+            value = parse_value(value)
+        except ValidationError as e:
+            raise ValidationError('%s: %s' % (name, ' '.join(e.messages)))
+        objs.append(ScalarData(sensor_id=sensors[name].id,
+                               timestamp=timestamp, value=value))
+    return objs
+
+
+# the last point stored in this process for each sensor with an ingest policy,
+# as (timestamp, value). These don't expire, as they'd only go stale if
+# another process stored a point, and that just means we store one more
+_last_points = LRUCache(METADATA_CACHE_SIZE, None)
+_local = threading.local()
+
+
+def apply_ingest_policies(objs):
+    '''Drops the points that their sensor's IngestPolicy says aren't worth
+    storing, comparing each against the last point that was kept for that
+    sensor in this process, so there's no need to read it back from the
+    database. The first point from each sensor is always kept. Returns the
+    points that should be stored.
+
+    Inside deferred_policies, the kept points only become the ones later
+    points are compared with once the block finishes without an error, so a
+    batch that fails to be stored isn't suppressed when it's retried'''
+    pending = getattr(_local, 'pending', None)
+    kept = []
+    for obj in objs:
+        policy = get_ingest_policy(obj.sensor_id)
+        if policy is None:
+            kept.append(obj)
+            continue
+        sensor_id = policy.sensor_id
+        last = pending.get(sensor_id) if pending is not None else None
+        if last is None:
+            last = _last_points.get(sensor_id)
+        if last is not None and policy.suppresses(last[0], last[1],
+                                                  obj.timestamp, obj.value):
+            continue
+        if last is None or obj.timestamp > last[0]:
+            if pending is None:
+                _last_points.set(sensor_id, (obj.timestamp, obj.value))
+            else:
+                pending[sensor_id] = (obj.timestamp, obj.value)
+        kept.append(obj)
+    return kept
+
+
+@contextmanager
+def deferred_policies():
+    '''Holds back the points kept by apply_ingest_policies in the wrapped
+    block from being compared against until the block finishes, dropping
+    them if it raises an exception. Use this around storing (or buffering)
+    the kept points, like deferred_recent'''
+    if getattr(_local, 'pending', None) is not None:
+        # the outermost block decides
+        yield
+        return
+    _local.pending = {}
+    try:
+        yield
+        pending = _local.pending
+    finally:
+        _local.pending = None
+    for sensor_id, point in pending.items():
+        _last_points.set(sensor_id, point)
+
+
+def drop_unchanged_states(objs):
+    '''Leaves out the points from state sensors that don't change the
+    sensor's state, so only the transitions are stored. Each is compared with
+    the previous point, starting from the latest one in the database, so this
+    should be called in the same transaction that stores the points. Points
+    that are no newer than the latest stored one are always kept, as there
+    may be other transitions in between. Returns the points to store'''
+    by_sensor = {}
+    for obj in objs:
+        by_sensor.setdefault(obj.sensor_id, []).append(obj)
+    kept = []
+    state_sensors = {}
+    for sensor_id, sensor_objs in by_sensor.items():
+        try:
+            sensor = get_cached(Sensor, id=sensor_id)
+        except (Sensor.DoesNotExist, ValueError):
+            # storing it will fail, which is the caller's problem
+            sensor = None
+        if sensor is None or sensor.data_type != DATA_TYPE_STATE:
+            kept.extend(sensor_objs)
+        else:
+            state_sensors[sensor.id] = sensor_objs
+    if not state_sensors:
+        return kept
+    latest_values = get_latest_values(state_sensors.keys())
+    for sensor_id, sensor_objs in state_sensors.items():
+        latest = latest_values.get(sensor_id)
+        if latest is None:
+            last_timestamp, last_value = None, None
+        else:
+            last_timestamp, last_value = latest.timestamp, latest.value
+        for obj in sorted(sensor_objs, key=lambda obj: obj.timestamp):
+            if last_timestamp is not None and \
+                    obj.timestamp <= last_timestamp:
+                kept.append(obj)
+            elif obj.value != last_value:
+                kept.append(obj)
+                last_timestamp, last_value = obj.timestamp, obj.value
+    return kept
+
+
+def store_data(objs):
+    '''Stores the given unsaved ScalarData objects in one statement, leaving
+    out points that don't change a state sensor's state, and adds them to
+    their rollups, the sensors' latest values and (once the data is
+    committed) their recent data buffers. Each database's share of the data
+    (see chain.core.routers) is stored in its own transaction. A lone point
+    is saved on its own instead, so that it gets its ID. Returns the points
+    that were stored. Raises IntegrityError if any of the points' sensors
+    doesn't exist'''
+    objs = drop_unchanged_states(objs)
+    try:
+        groups = group_by_db(objs)
+    except (Sensor.DoesNotExist, Device.DoesNotExist, ValueError):
+        # with SITE_DATABASES the sensor is looked up to find its database,
+        # so this is where data for a missing sensor fails, rather than on
+        # its foreign key
+        raise IntegrityError('Data must be stored for an existing sensor')
+    bulk_objs = []
+    for using, db_objs in sorted(groups.items()):
+        with transaction.atomic(using=using):
+            if len(db_objs) == 1:
+                # its post_save receivers do the rest
+                db_objs[0].save(using=using, force_insert=True)
+                continue
+            ScalarData.objects.using(using).bulk_create(db_objs)
+            update_rollups(db_objs, using)
+            update_latest_values(db_objs, using)
+        bulk_objs.extend(db_objs)
+    stage_recent(bulk_objs)
+    return objs
+
+
+# Each record of the packed format is a little-endian int64 timestamp in
+# milliseconds since the unix epoch, followed by a float64 value
+PACKED_DATA_MIME_TYPE = 'application/x-chain-packed'
+PACKED_RECORD_SIZE = struct.calcsize('<qd')
+
+
+def from_epoch_ms(timestamp_ms):
+    return datetime.utcfromtimestamp(timestamp_ms / 1000.0).replace(
+        tzinfo=utc)
+
+
+def build_from_pairs(timestamps_ms, values, fields):
+    '''Builds unsaved ScalarData objects from parallel sequences of epoch
+    millisecond timestamps and float values. fields holds any other model
+    fields, which will usually just be the sensor_id'''
+    try:
+        objs = [ScalarData(timestamp=from_epoch_ms(timestamp),
+                           value=float(value), **fields)
+                for timestamp, value in zip(timestamps_ms, values)]
+    except (TypeError, ValueError, OverflowError) as e:
+        raise ValidationError('Invalid data: %s' % e)
+    for i, obj in enumerate(objs):
+        # this is only true for NaN and infinity
+        if obj.value - obj.value != 0.0:
+            raise ValidationError('Item %d is invalid: values must be finite, '
+                                  'got %s' % (i, obj.value))
+    return objs
+
+
+def decode_packed_data(body, fields):
+    '''Decodes a request body in the packed binary format into unsaved
+    ScalarData objects'''
+    count, remainder = divmod(len(body), PACKED_RECORD_SIZE)
+    if remainder:
+        raise ValidationError('Packed data must be a whole number of '
+                              '%d-byte records' % PACKED_RECORD_SIZE)
+    # unpacking the whole body in one call is much faster than a record at a
+    # time, and gives us a flat sequence of alternating timestamps and values
+    flat = struct.unpack('<' + 'qd' * count, body)
+    return build_from_pairs(flat[0::2], flat[1::2], fields)
+
+
+def decode_msgpack_data(body, fields):
+    '''Decodes a request body containing a msgpack array of [timestamp,
+    value] pairs, with timestamps in milliseconds since the unix epoch'''
+    try:
+        pairs = msgpack.unpackb(body)
+    except Exception:
+        raise ValidationError('The request body is not valid msgpack')
+    if not isinstance(pairs, (list, tuple)) or \
+            not all(isinstance(p, (list, tuple)) and len(p) == 2
+                    for p in pairs):
+        raise ValidationError('msgpack data must be an array of '
+                              '[timestamp, value] pairs')
+    return build_from_pairs([p[0] for p in pairs], [p[1] for p in pairs],
+                            fields)
+
+
+# maps the binary content types that data can be POSTed in to their decoders.
+# msgpack is optional, so its decoder is None if it isn't installed
+BINARY_DECODERS = {
+    PACKED_DATA_MIME_TYPE: decode_packed_data,
+    'application/x-msgpack': decode_msgpack_data if msgpack else None,
+    'application/msgpack': decode_msgpack_data if msgpack else None,
+}
+
+
+class _JSONStreamReader(object):
+    '''Reads JSON tokens and values from a file-like stream a chunk at a
+    time'''
+    def __init__(self, stream, chunk_size):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        '''Reads another chunk into the buffer, dropping what's already been
+        consumed. Returns False at the end of the stream'''
+        if self._eof:
+            return False
+        chunk = self._stream.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        '''Returns the next non-whitespace character without consuming it, or
+        an empty string at the end of the stream'''
+        while True:
+            while self._pos < len(self._buf) and \
+                    self._buf[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def take(self, expected):
+        '''Consumes the next non-whitespace character, which must be one of
+        the expected characters'''
+        char = self.peek()
+        if not char or char not in expected:
+            raise ValidationError('Expected one of "%s" in JSON list, got '
+                                  '"%s"' % (expected, char))
+        self._pos += 1
+        return char
+
+    def decode(self):
+        '''Consumes and returns the next JSON value'''
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                end = None
+            # a value that runs right up to the end of what's been read might
+            # continue in the next chunk (e.g. a number), so read more before
+            # trusting it
+            if end is not None and (end < len(self._buf) or self._eof):
+                self._pos = end
+                return value
+            if not self._fill():
+                if end is None:
+                    raise ValidationError('Invalid JSON in list')
+                self._pos = end
+                return value
+
+
+def iter_json_list(stream, chunk_size=64 * 1024):
+    '''Yields the items of a JSON list as they're read from the given
+    file-like stream, so the whole document never has to be held in memory.
+    Raises ValidationError if the stream doesn't contain a valid JSON list'''
+    reader = _JSONStreamReader(stream, chunk_size)
+    reader.take('[')
+    if reader.peek() == ']':
+        reader.take(']')
+    else:
+        while True:
+            yield reader.decode()
+            if reader.take(',]') == ']':
+                break
+    if reader.peek():
+        raise ValidationError('Unexpected data after JSON list')
+
+
+# the fields that identify a device within a site, matching the model's
+# unique_together constraint
+DEVICE_KEY_FIELDS = ['name', 'building', 'floor', 'room']
+
+
+def resolve_device(site_id, device_info):
+    '''Finds the device in the given site matching the natural key given in
+    the device_info dictionary, creating it if it doesn't exist yet. Returns a
+    (device, created) tuple'''
+    if not isinstance(device_info, dict) or not device_info.get('name'):
+        raise ValidationError('Devices must be given as an object with at '
+                              'least a name')
+    key = {}
+    for field_name in DEVICE_KEY_FIELDS:
+        value = device_info.get(field_name)
+        # an explicit null is the same as leaving the field out
+        if value is None:
+            value = ''
+        elif isinstance(value, bool) or \
+                not isinstance(value, (basestring, int, long, float)):
+            raise ValidationError('Device %s must be a string' % field_name)
+        field = Device._meta.get_field(field_name)
+        key[field_name] = field.to_python(value)
+    try:
+        return get_cached(Device, site_id=site_id, **key), False
+    except Device.DoesNotExist:
+        pass
+    device = Device(site_id=site_id,
+                    description=device_info.get('description', ''), **key)
+    try:
+        with transaction.atomic():
+            device.save()
+    except IntegrityError:
+        # another request created it since we looked
+        return Device.objects.get(site_id=site_id, **key), False
+    return device, True
+
+
+def find_or_create_by_name(model, name):
+    '''Looks up a Metric or Unit by name, creating it if necessary. This is
+    the same as what the API does for stub fields'''
+    try:
+        return get_cached(model, name=name)
+    except model.DoesNotExist:
+        obj, _ = model.objects.get_or_create(name=name)
+        return obj
+
+
+def resolve_sensors(device, metric_names, units):
+    '''Returns a dictionary mapping each of the given metric names to the
+    device's sensor for that metric, along with a list of the sensors that
+    had to be created. New sensors get their unit from the units dictionary,
+    so it's a ValidationError for it to be missing a metric that doesn't have
+    a sensor yet'''
+    sensors = get_device_sensors(device.id)
+    created = []
+    for name in metric_names:
+        if name in sensors:
+            continue
+        try:
+            unit_name = units[name]
+        except KeyError:
+            raise ValidationError('No unit given for new metric %s' % name)
+        sensor = Sensor(device=device,
+                        metric=find_or_create_by_name(Metric, name),
+                        unit=find_or_create_by_name(Unit, unit_name))
+        try:
+            with transaction.atomic():
+                sensor.save()
+            created.append(sensor)
+        except IntegrityError:
+            sensor = device.sensors.get(metric__name=name)
+        sensors[name] = sensor
+    return sensors, created
+
+
+class DuplicateBatchError(Exception):
+    '''Raised by claim_batch when a batch has already been stored. The
+    original IngestBatch record is available as the batch attribute'''
+    def __init__(self, batch):
+        super(DuplicateBatchError, self).__init__(
+            'Batch %s has already been stored' % batch.batch_id)
+        self.batch = batch
+
+
+def claim_batch(scope, batch_id, count):
+    '''Records that the batch with the given ID is being stored in the given
+    scope, which names what it was posted to, e.g. "sensor-12". This needs
+    to be called inside the transaction that stores the batch's data, so the
+    record is only kept if the data is. Returns the new IngestBatch, or
+    raises DuplicateBatchError if the batch has already been stored'''
+    try:
+        with transaction.atomic():
+            return IngestBatch.objects.create(scope=scope, batch_id=batch_id,
+                                              count=count)
+    except IntegrityError:
+        raise DuplicateBatchError(IngestBatch.objects.get(
+            scope=scope, batch_id=batch_id))
+
+
+def expire_batches(before):
+    '''Deletes the records of batches stored before the given time, after
+    which they'd be stored again if they were resent. Returns the number of
+    records deleted'''
+    expired = IngestBatch.objects.filter(created__lt=before)
+    count = expired.count()
+    expired.delete()
+    return count
+
+
+class BufferFullError(Exception):
+    '''Raised when a write-behind buffer doesn't have room for more data. The
+    caller should tell the client to back off and retry later'''
+    pass
+
+
+class WriteBehindBuffer(object):
+    '''Holds unsaved ScalarData objects in memory and writes them to the
+    database in batches from a background thread. A batch is written when
+    flush_size objects are waiting or the oldest waiting object is
+    flush_interval seconds old, whichever comes first.
+
+    The buffer never holds more than max_size objects. If a flush fails the
+    objects are put back at the front of the buffer, so a database outage
+    eventually fills the buffer and put() starts raising BufferFullError. The
+    exception is an IntegrityError, which would just fail again. The flush is
+    then retried a sensor at a time, so only the data of sensors that can't
+    be stored (e.g. because they've been deleted) is logged and dropped.
+    Callers should check that the sensor exists before buffering its data.
+
+    flush_func stores a list of objects and returns the ones it actually
+    stored (or None if that's all of them). Objects can be put with an
+    on_stored function, which is called with the ones that were stored once
+    they've been committed, e.g. to publish them.
+
+    With background=False no thread is started and it's up to the caller to
+    call flush().'''
+
+    def __init__(self, max_size, flush_size, flush_interval,
+                 flush_func=None, background=True):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._flush_func = flush_func or store_data
+        self._items = []
+        self._oldest = None
+        # _lock protects the pending list, _flush_lock makes sure only one
+        # flush is writing to the database at a time
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._background = background
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, objs, on_stored=None):
+        '''Adds the given objects to the buffer, raising BufferFullError if
+        they don't all fit. Either all the objects are added or none are'''
+        with self._lock:
+            if len(self._items) + len(objs) > self.max_size:
+                raise BufferFullError(
+                    'Write buffer is full (%d points waiting)' %
+                    len(self._items))
+            if not self._items:
+                self._oldest = time.time()
+            self._items.extend((obj, on_stored) for obj in objs)
+            ready = len(self._items) >= self.flush_size
+        self._start_thread()
+        if ready:
+            self._wakeup.set()
+
+    def flush(self):
+        '''Writes everything currently in the buffer to the database'''
+        with self._flush_lock:
+            with self._lock:
+                items, self._items = self._items, []
+                self._oldest = None
+            if not items:
+                return
+            try:
+                try:
+                    self._store(items)
+                except IntegrityError:
+                    # one sensor's data shouldn't take everyone else's with it
+                    self._store_by_sensor(items)
+            except Exception:
+                logger.exception('Failed to write %d buffered points' %
+                                 len(items))
+                with self._lock:
+                    # put the failed items back ahead of anything that came
+                    # in while we were writing
+                    self._items = items + self._items
+                    self._oldest = time.time()
+                raise
+
+    def _store_by_sensor(self, items):
+        '''Stores each sensor's share of the given (object, on_stored) pairs
+        separately, dropping the ones that raise an IntegrityError. Other
+        errors are raised with the pairs that weren't stored removed from
+        items, so only the rest are put back'''
+        groups = {}
+        for item in items:
+            groups.setdefault(item[0].sensor_id, []).append(item)
+        for sensor_id, group in sorted(groups.items()):
+            try:
+                self._store(group)
+            except IntegrityError:
+                logger.exception('Dropping %d buffered points for sensor %s '
+                                 'that could not be stored' %
+                                 (len(group), sensor_id))
+            done = set(map(id, group))
+            items[:] = [item for item in items if id(item) not in done]
+
+    def _store(self, items):
+        '''Stores the given (object, on_stored) pairs, and then passes the
+        objects that were stored to their on_stored functions'''
+        objs = [obj for obj, _ in items]
+        stored = self._flush_func(objs)
+        stored_ids = set(map(id, objs if stored is None else stored))
+        callbacks = []
+        for obj, on_stored in items:
+            if on_stored is None or id(obj) not in stored_ids:
+                continue
+            if not callbacks or callbacks[-1][0] is not on_stored:
+                callbacks.append((on_stored, []))
+            callbacks[-1][1].append(obj)
+        for on_stored, stored_objs in callbacks:
+            try:
+                on_stored(stored_objs)
+            except Exception:
+                # the data is stored, so it mustn't go back in the buffer
+                logger.exception('Failed to handle %d stored points' %
+                                 len(stored_objs))
+
+    def _is_due(self):
+        with self._lock:
+            if not self._items:
+                return False
+            return (len(self._items) >= self.flush_size or
+                    time.time() - self._oldest >= self.flush_interval)
+
+    def _start_thread(self):
+        # the thread is started lazily so that it's created in the process
+        # that uses it, not in a parent that forks workers
+        if not self._background or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='chain-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self._is_due():
+                continue
+            try:
+                self.flush()
+            except Exception:
+                # already logged, and the items are back in the buffer. Wait
+                # for the next interval before trying again
+                time.sleep(self.flush_interval)
+
+
+_write_behind_buffer = None
+
+
+def get_write_behind_buffer():
+    '''Returns the process-wide write-behind buffer, or None if write-behind
+    ingest isn't enabled in the settings'''
+    global _write_behind_buffer
+    if not INGEST_WRITE_BEHIND:
+        return None
+    if _write_behind_buffer is None:
+        _write_behind_buffer = WriteBehindBuffer(INGEST_BUFFER_MAX_SIZE,
+                                                 INGEST_FLUSH_SIZE,
+                                                 INGEST_FLUSH_INTERVAL)
+        # gunicorn workers exit normally when they're recycled after
+        # --max-requests, so this makes sure nothing is left behind
+        atexit.register(_write_behind_buffer.flush)
+    return _write_behind_buffer
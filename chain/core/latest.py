@@ -0,0 +1,115 @@
+'''Each sensor's most recent data point is kept in the LatestValue table, so
+serializing a sensor, or a whole site's worth of them, doesn't need to search
+their data. It's updated in the same transaction as the data is stored, and
+only ever moves forward in time, so backfilled data doesn't replace a newer
+value. Data is deleted without signals, so that deleting a range of it (or
+a sensor and all its data) doesn't load every row. Code that deletes or
+moves ranges of data calls refresh_latest_values afterwards, which looks up
+each affected sensor's last point once.'''
+
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from chain.core.models import ScalarData, Sensor, LatestValue
+from chain.core.history import last_point
+from chain.core.routers import get_data_db, get_data_read_db
+
+
+def update_latest_values(objs, using=DEFAULT_DB_ALIAS):
+    '''Updates the latest values of the sensors of the given newly stored
+    ScalarData objects. This should be called in the same transaction that
+    stored them, in the database they were stored in'''
+    newest = {}
+    for obj in objs:
+        sensor_id = int(obj.sensor_id)
+        if sensor_id not in newest or \
+                obj.timestamp >= newest[sensor_id].timestamp:
+            newest[sensor_id] = obj
+    if not newest:
+        return
+    received = timezone.now()
+    with transaction.atomic(using=using):
+        # the rows are locked in a consistent order so that concurrent
+        # batches for the same sensors can't deadlock
+        existing = LatestValue.objects.using(using).select_for_update(
+            ).filter(sensor_id__in=newest.keys()).order_by('sensor')
+        for latest in existing:
+            obj = newest.pop(latest.sensor_id)
+            if obj.timestamp >= latest.timestamp:
+                latest.value = obj.value
+                latest.timestamp = obj.timestamp
+                latest.received = received
+                latest.save(using=using)
+        if not newest:
+            return
+        created = [LatestValue(sensor_id=sensor_id, value=obj.value,
+                               timestamp=obj.timestamp, received=received)
+                   for sensor_id, obj in newest.items()]
+        try:
+            with transaction.atomic(using=using):
+                LatestValue.objects.using(using).bulk_create(created)
+        except IntegrityError:
+            # someone else created some of them after we looked, so go
+            # through them one at a time
+            for latest in created:
+                add_latest_value(latest, using)
+
+
+def add_latest_value(latest, using=DEFAULT_DB_ALIAS):
+    '''Stores an unsaved latest value, unless there's already a newer one'''
+    try:
+        stored = LatestValue.objects.using(using).select_for_update().get(
+            sensor_id=latest.sensor_id)
+    except LatestValue.DoesNotExist:
+        latest.save(using=using)
+    else:
+        if latest.timestamp >= stored.timestamp:
+            latest.save(using=using)
+
+
+@receiver(post_save, sender=ScalarData)
+def data_saved(sender, instance, created, raw, using, **kwargs):
+    # bulk inserts don't send post_save, so they're added by store_data
+    if created and not raw:
+        update_latest_values([instance], using)
+
+
+@receiver(pre_delete, sender=Sensor)
+def sensor_deleted(sender, instance, using, **kwargs):
+    # its data goes with it, so there's nothing to recompute
+    LatestValue.objects.using(using).filter(sensor_id=instance.id).delete()
+
+
+def refresh_latest_values(sensor_ids):
+    '''Recomputes the latest values of the given sensors from their data,
+    wherever it's stored, once a range of it has been deleted or moved'''
+    for sensor_id in sensor_ids:
+        using = get_data_db(sensor_id)
+        latest_values = LatestValue.objects.using(using).filter(
+            sensor_id=sensor_id)
+        with transaction.atomic(using=using):
+            last = last_point(sensor_id)
+            if last is None:
+                latest_values.delete()
+                continue
+            timestamp, value = last
+            if not latest_values.update(timestamp=timestamp, value=value):
+                add_latest_value(LatestValue(sensor_id=sensor_id,
+                                             timestamp=timestamp,
+                                             value=value), using)
+
+
+def get_latest_values(sensor_ids):
+    '''Returns a dictionary mapping the IDs of the given sensors that have
+    data to their LatestValue, in one query per database'''
+    by_db = {}
+    for sensor_id in sensor_ids:
+        using = get_data_read_db(sensor_id)
+        by_db.setdefault(using, []).append(sensor_id)
+    latest_values = {}
+    for using, db_sensor_ids in by_db.items():
+        latest_values.update((latest.sensor_id, latest) for latest in
+                             LatestValue.objects.using(using).filter(
+                                 sensor_id__in=db_sensor_ids))
+    return latest_values
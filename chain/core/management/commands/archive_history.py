@@ -0,0 +1,28 @@
+from optparse import make_option
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from chain.core.archive import archive_history
+from chain.core.latest import refresh_latest_values
+
+
+class Command(BaseCommand):
+    help = ('Moves sensor data that is older than its retention policy '
+            'allows into files under ARCHIVE_ROOT. The data can still '
+            'be read through the API.')
+    option_list = BaseCommand.option_list + (
+        make_option('--sensor', type='int', action='append', dest='sensors',
+                    help='Only archive data for this sensor ID. Can be given '
+                    'more than once'),
+    )
+
+    def handle(self, *args, **options):
+        moved = set()
+        try:
+            count = archive_history(sensor_ids=options['sensors'],
+                                    moved=moved)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        # the data was moved rather than deleted, but this keeps the latest
+        # values right if any of it was deleted while it was being moved
+        refresh_latest_values(moved)
+        self.stdout.write('Archived %d data points' % count)
@@ -0,0 +1,33 @@
+from datetime import timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from chain.core.chunks import compress_history
+from chain.core.latest import refresh_latest_values
+from chain.settings import COMPRESS_DATA_AFTER_DAYS
+
+
+class Command(BaseCommand):
+    help = ('Moves old sensor data into compressed chunks, a day per sensor '
+            'at a time. The data can still be read through the API.')
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=COMPRESS_DATA_AFTER_DAYS,
+                    help='Compress data older than this many days (default: '
+                    'COMPRESS_DATA_AFTER_DAYS)'),
+        make_option('--sensor', type='int', action='append', dest='sensors',
+                    help='Only compress data for this sensor ID. Can be '
+                    'given more than once'),
+    )
+
+    def handle(self, *args, **options):
+        if options['days'] is None:
+            raise CommandError('Compression is disabled, as '
+                               'COMPRESS_DATA_AFTER_DAYS is None. Give --days '
+                               'to compress anyway')
+        before = timezone.now() - timedelta(days=options['days'])
+        moved = set()
+        count = compress_history(before, options['sensors'], moved)
+        # the data was moved rather than deleted, but this keeps the latest
+        # values right if any of it was deleted while it was being moved
+        refresh_latest_values(moved)
+        self.stdout.write('Compressed %d data points' % count)
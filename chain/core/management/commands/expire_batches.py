@@ -0,0 +1,21 @@
+from datetime import timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chain.core.ingest import expire_batches
+from chain.settings import INGEST_BATCH_MAX_AGE_DAYS
+
+
+class Command(BaseCommand):
+    help = ('Forgets the IDs of posted batches that are older than '
+            'INGEST_BATCH_MAX_AGE_DAYS, so their records don\'t pile up.')
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=INGEST_BATCH_MAX_AGE_DAYS,
+                    help='Forget batches older than this many days (default: '
+                    'INGEST_BATCH_MAX_AGE_DAYS)'),
+    )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        count = expire_batches(before)
+        self.stdout.write('Expired %d batches' % count)
@@ -0,0 +1,22 @@
+from optparse import make_option
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from chain.core.columnar import materialize_days
+
+
+class Command(BaseCommand):
+    help = ('Writes each finished day of sensor data to a columnar file '
+            'under COLUMNAR_DATA_DIR, so it can be read without the '
+            'database. Days whose file is already up to date are skipped.')
+    option_list = BaseCommand.option_list + (
+        make_option('--sensor', type='int', action='append', dest='sensors',
+                    help='Only write files for this sensor ID. Can be given '
+                    'more than once'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            count = materialize_days(sensor_ids=options['sensors'])
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        self.stdout.write('Wrote %d files' % count)
@@ -0,0 +1,24 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from chain.core.routers import mirror_metadata, get_data_dbs
+
+
+class Command(BaseCommand):
+    help = ('Copies the sites, devices, sensors, metrics and units from the '
+            'default database to the databases in SITE_DATABASES, which '
+            'need them to store data. Later changes are copied as they are '
+            'saved.')
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='append', dest='databases',
+                    help='Only copy to this database alias. Can be given '
+                    'more than once'),
+    )
+
+    def handle(self, *args, **options):
+        databases = options['databases'] or get_data_dbs()
+        if not databases:
+            raise CommandError('SITE_DATABASES doesn\'t name any databases '
+                               'besides the default one')
+        for database in databases:
+            count = mirror_metadata(database)
+            self.stdout.write('Copied %d objects to %s' % (count, database))
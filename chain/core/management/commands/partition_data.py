@@ -0,0 +1,54 @@
+from datetime import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import utc
+from chain.core.partitions import create_partitions, move_existing_rows
+from chain.core.partitions import detach_partitions, current_months
+from chain.core.partitions import partition_name, UnsupportedDatabaseError
+from chain.settings import DATA_PARTITION_MONTHS_AHEAD
+
+
+class Command(BaseCommand):
+    help = ('Creates monthly partitions of the sensor data table for the '
+            'coming months, and optionally moves unpartitioned data into '
+            'partitions or detaches old ones. PostgreSQL only.')
+    option_list = BaseCommand.option_list + (
+        make_option('--ahead', type='int',
+                    default=DATA_PARTITION_MONTHS_AHEAD,
+                    help='Number of months after this one to create '
+                    'partitions for'),
+        make_option('--move-existing', action='store_true', default=False,
+                    help='Move data stored before partitioning was set up '
+                    'into partitions'),
+        make_option('--detach-before', metavar='YYYY-MM',
+                    help='Detach the partitions for months before this one, '
+                    'leaving them as standalone tables'),
+        make_option('--drop', action='store_true', default=False,
+                    help='Drop detached partitions rather than keeping '
+                    'them'),
+    )
+
+    def handle(self, *args, **options):
+        detach_before = None
+        if options['detach_before']:
+            try:
+                detach_before = datetime.strptime(
+                    options['detach_before'], '%Y-%m').replace(tzinfo=utc)
+            except ValueError:
+                raise CommandError('--detach-before must be given as YYYY-MM')
+        elif options['drop']:
+            raise CommandError('--drop can only be used with --detach-before')
+        try:
+            for month in create_partitions(current_months(options['ahead'])):
+                self.stdout.write('Created %s' % partition_name(month))
+            if options['move_existing']:
+                self.stdout.write('Moved %d rows into partitions' %
+                                  move_existing_rows())
+            if detach_before is not None:
+                for month in detach_partitions(detach_before,
+                                               drop=options['drop']):
+                    self.stdout.write('%s %s' % (
+                        'Dropped' if options['drop'] else 'Detached',
+                        partition_name(month)))
+        except UnsupportedDatabaseError as e:
+            raise CommandError(str(e))
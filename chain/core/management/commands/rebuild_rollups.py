@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.timezone import utc
+from chain.core.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the sensor data rollups from the raw data, e.g. after '
+            'data has been edited, deleted or restored from a backup.')
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=2,
+                    help='Rebuild rollups for this many days back'),
+        make_option('--since', metavar='YYYY-MM-DD',
+                    help='Rebuild rollups for data from this date onwards'),
+        make_option('--all', action='store_true', default=False,
+                    help='Rebuild the rollups for all data'),
+        make_option('--sensor', type='int', action='append', dest='sensors',
+                    help='Only rebuild rollups for this sensor ID. Can be '
+                    'given more than once'),
+    )
+
+    def handle(self, *args, **options):
+        if options['all']:
+            since = None
+        elif options['since']:
+            try:
+                since = datetime.strptime(options['since'],
+                                          '%Y-%m-%d').replace(tzinfo=utc)
+            except ValueError:
+                raise CommandError('--since must be given as YYYY-MM-DD')
+        else:
+            since = timezone.now() - timedelta(days=options['days'])
+        count = rebuild_rollups(since, options['sensors'])
+        self.stdout.write('Stored %d rollups' % count)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'ScalarDataRollup'
+        db.create_table(u'core_scalardatarollup', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('sensor', self.gf('django.db.models.fields.related.ForeignKey')(related_name='rollups', to=orm['core.Sensor'])),
+            ('resolution', self.gf('django.db.models.fields.IntegerField')()),
+            ('start', self.gf('django.db.models.fields.DateTimeField')()),
+            ('count', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('min', self.gf('django.db.models.fields.FloatField')()),
+            ('max', self.gf('django.db.models.fields.FloatField')()),
+            ('sum', self.gf('django.db.models.fields.FloatField')()),
+            ('first', self.gf('django.db.models.fields.FloatField')()),
+            ('first_timestamp', self.gf('django.db.models.fields.DateTimeField')()),
+            ('last', self.gf('django.db.models.fields.FloatField')()),
+            ('last_timestamp', self.gf('django.db.models.fields.DateTimeField')()),
+        ))
+        db.send_create_signal(u'core', ['ScalarDataRollup'])
+
+        # Adding unique constraint on 'ScalarDataRollup', fields ['sensor', 'resolution', 'start']
+        db.create_unique(u'core_scalardatarollup', ['sensor_id', 'resolution', 'start'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'ScalarDataRollup', fields ['sensor', 'resolution', 'start']
+        db.delete_unique(u'core_scalardatarollup', ['sensor_id', 'resolution', 'start'])
+
+        # Deleting model 'ScalarDataRollup'
+        db.delete_table(u'core_scalardatarollup')
+
+
+    models = {
+        u'core.device': {
+            'Meta': {'unique_together': "(['site', 'name', 'building', 'floor', 'room'],)", 'object_name': 'Device'},
+            'building': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'floor': ('django.db.models.fields.CharField', [], {'max_length': '10', 'blank': 'True'}),
+            'geo_location': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['core.GeoLocation']", 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'room': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'devices'", 'to': u"orm['core.Site']"})
+        },
+        u'core.geolocation': {
+            'Meta': {'object_name': 'GeoLocation'},
+            'elevation': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'latitude': ('django.db.models.fields.FloatField', [], {}),
+            'longitude': ('django.db.models.fields.FloatField', [], {})
+        },
+        u'core.ingestbatch': {
+            'Meta': {'object_name': 'IngestBatch'},
+            'batch_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'count': ('django.db.models.fields.IntegerField', [], {}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'core.ingestpolicy': {
+            'Meta': {'object_name': 'IngestPolicy'},
+            'deadband_abs': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'deadband_rel': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'drop_duplicates': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'max_silence': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'sensor': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'ingest_policy'", 'unique': 'True', 'to': u"orm['core.Sensor']"})
+        },
+        u'core.metric': {
+            'Meta': {'object_name': 'Metric'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'})
+        },
+        u'core.person': {
+            'Meta': {'object_name': 'Person'},
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'geo_location': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['core.GeoLocation']", 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'picture_url': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'rfid': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'people'", 'to': u"orm['core.Site']"}),
+            'twitter_handle': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'})
+        },
+        u'core.presencedata': {
+            'Meta': {'object_name': 'PresenceData'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'person': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'presense_data'", 'to': u"orm['core.Person']"}),
+            'present': ('django.db.models.fields.BooleanField', [], {}),
+            'sensor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'presence_data'", 'to': u"orm['core.Sensor']"}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'})
+        },
+        u'core.scalardata': {
+            'Meta': {'object_name': 'ScalarData', 'index_together': "[['sensor', 'timestamp']]"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'sensor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'scalar_data'", 'to': u"orm['core.Sensor']"}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True', 'blank': 'True'}),
+            'value': ('django.db.models.fields.FloatField', [], {})
+        },
+        u'core.scalardatarollup': {
+            'Meta': {'unique_together': "(['sensor', 'resolution', 'start'],)", 'object_name': 'ScalarDataRollup'},
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'first': ('django.db.models.fields.FloatField', [], {}),
+            'first_timestamp': ('django.db.models.fields.DateTimeField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last': ('django.db.models.fields.FloatField', [], {}),
+            'last_timestamp': ('django.db.models.fields.DateTimeField', [], {}),
+            'max': ('django.db.models.fields.FloatField', [], {}),
+            'min': ('django.db.models.fields.FloatField', [], {}),
+            'resolution': ('django.db.models.fields.IntegerField', [], {}),
+            'sensor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'rollups'", 'to': u"orm['core.Sensor']"}),
+            'start': ('django.db.models.fields.DateTimeField', [], {}),
+            'sum': ('django.db.models.fields.FloatField', [], {})
+        },
+        u'core.sensor': {
+            'Meta': {'unique_together': "(['device', 'metric'],)", 'object_name': 'Sensor'},
+            'data_type': ('django.db.models.fields.CharField', [], {'default': "'float'", 'max_length': '10'}),
+            'device': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'sensors'", 'to': u"orm['core.Device']"}),
+            'geo_location': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['core.GeoLocation']", 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'metadata': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'metric': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'sensors'", 'to': u"orm['core.Metric']"}),
+            'unit': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'sensors'", 'to': u"orm['core.Unit']"})
+        },
+        u'core.site': {
+            'Meta': {'object_name': 'Site'},
+            'geo_location': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['core.GeoLocation']", 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'raw_zmq_stream': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'url': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'})
+        },
+        u'core.statusupdate': {
+            'Meta': {'object_name': 'StatusUpdate'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'person': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'status_updates'", 'to': u"orm['core.Person']"}),
+            'status': ('django.db.models.fields.TextField', [], {}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'})
+        },
+        u'core.unit': {
+            'Meta': {'object_name': 'Unit'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        }
+    }
+
+    complete_apps = ['core']
\ No newline at end of file
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'ArchiveFile'
+        db.create_table(u'core_archivefile', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('sensor', self.gf('django.db.models.fields.related.ForeignKey')(related_name='archive_files', to=orm['core.Sensor'])),
+            ('start', self.gf('django.db.models.fields.DateTimeField')()),
+            ('end', self.gf('django.db.models.fields.DateTimeField')()),
+            ('count', self.gf('django.db.models.fields.IntegerField')()),
+            ('path', self.gf('django.db.models.fields.CharField')(unique=True, max_length=255)),
+        ))
+        db.send_create_signal(u'core', ['ArchiveFile'])
+
+        # Adding index on 'ArchiveFile', fields ['sensor', 'start']
+        db.create_index(u'core_archivefile', ['sensor_id', 'start'])
+
+        # Adding model 'RetentionPolicy'
+        db.create_table(u'core_retentionpolicy', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('site', self.gf('django.db.models.fields.related.OneToOneField')(blank=True, related_name='retention_policy', unique=True, null=True, to=orm['core.Site'])),
+            ('sensor', self.gf('django.db.models.fields.related.OneToOneField')(blank=True, related_name='retention_policy', unique=True, null=True, to=orm['core.Sensor'])),
+            ('keep_days', self.gf('django.db.models.fields.IntegerField')()),
+        ))
+        db.send_create_signal(u'core', ['RetentionPolicy'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'ArchiveFile', fields ['sensor', 'start']
+        db.delete_index(u'core_archivefile', ['sensor_id', 'start'])
+
+        # Deleting model 'ArchiveFile'
+        db.delete_table(u'core_archivefile')
+
+        # Deleting model 'RetentionPolicy'
+        db.delete_table(u'core_retentionpolicy')
+
+
+    models = {
+        u'core.archivefile': {
+            'Meta': {'object_name': 'ArchiveFile', 'index_together': "[['sensor', 'start']]"},
+            'count': ('django.db.models.fields.IntegerField', [], {}),
+            'end': ('django.db.models.fields.DateTimeField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'path': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'sensor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'archive_files'", 'to': u"orm['core.Sensor']"}),
+            'start': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        u'core.device': {
+            'Meta': {'unique_together': "(['site', 'name', 'building', 'floor', 'room'],)", 'object_name': 'Device'},
+            'building': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'floor': ('django.db.models.fields.CharField', [], {'max_length': '10', 'blank': 'True'}),
+            'geo_location': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['core.GeoLocation']", 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'room': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'devices'", 'to': u"orm['core.Site']"})
+        },
+        u'core.geolocation': {
+            'Meta': {'object_name': 'GeoLocation'},
+            'elevation': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'latitude': ('django.db.models.fields.FloatField', [], {}),
+            'longitude': ('django.db.models.fields.FloatField', [], {})
+        },
+        u'core.ingestbatch': {
+            'Meta': {'object_name': 'IngestBatch'},
+            'batch_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'count': ('django.db.models.fields.IntegerField', [], {}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'core.ingestpolicy': {
+            'Meta': {'object_name': 'IngestPolicy'},
+            'deadband_abs': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'deadband_rel': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'drop_duplicates': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'max_silence': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'sensor': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'ingest_policy'", 'unique': 'True', 'to': u"orm['core.Sensor']"})
+        },
+        u'core.metric': {
+            'Meta': {'object_name': 'Metric'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'})
+        },
+        u'core.person': {
+            'Meta': {'object_name': 'Person'},
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'geo_location': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['core.GeoLocation']", 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'picture_url': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'rfid': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'people'", 'to': u"orm['core.Site']"}),
+            'twitter_handle': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'})
+        },
+        u'core.presencedata': {
+            'Meta': {'object_name': 'PresenceData'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'person': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'presense_data'", 'to': u"orm['core.Person']"}),
+            'present': ('django.db.models.fields.BooleanField', [], {}),
+            'sensor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'presence_data'", 'to': u"orm['core.Sensor']"}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'})
+        },
+        u'core.retentionpolicy': {
+            'Meta': {'object_name': 'RetentionPolicy'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'keep_days': ('django.db.models.fields.IntegerField', [], {}),
+            'sensor': ('django.db.models.fields.related.OneToOneField', [], {'blank': 'True', 'related_name': "'retention_policy'", 'unique': 'True', 'null': 'True', 'to': u"orm['core.Sensor']"}),
+            'site': ('django.db.models.fields.related.OneToOneField', [], {'blank': 'True', 'related_name': "'retention_policy'", 'unique': 'True', 'null': 'True', 'to': u"orm['core.Site']"})
+        },
+        u'core.scalardata': {
+            'Meta': {'object_name': 'ScalarData', 'index_together': "[['sensor', 'timestamp']]"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'sensor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'scalar_data'", 'to': u"orm['core.Sensor']"}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True', 'blank': 'True'}),
+            'value': ('django.db.models.fields.FloatField', [], {})
+        },
+        u'core.scalardatachunk': {
+            'Meta': {'unique_together': "(['sensor', 'start'],)", 'object_name': 'ScalarDataChunk'},
+            'count': ('django.db.models.fields.IntegerField', [], {}),
+            'data': ('django.db.models.fields.BinaryField', [], {}),
+            'end': ('django.db.models.fields.DateTimeField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'sensor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'chunks'", 'to': u"orm['core.Sensor']"}),
+            'start': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        u'core.scalardatarollup': {
+            'Meta': {'unique_together': "(['sensor', 'resolution', 'start'],)", 'object_name': 'ScalarDataRollup'},
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'first': ('django.db.models.fields.FloatField', [], {}),
+            'first_timestamp': ('django.db.models.fields.DateTimeField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last': ('django.db.models.fields.FloatField', [], {}),
+            'last_timestamp': ('django.db.models.fields.DateTimeField', [], {}),
+            'max': ('django.db.models.fields.FloatField', [], {}),
+            'min': ('django.db.models.fields.FloatField', [], {}),
+            'resolution': ('django.db.models.fields.IntegerField', [], {}),
+            'sensor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'rollups'", 'to': u"orm['core.Sensor']"}),
+            'start': ('django.db.models.fields.DateTimeField', [], {}),
+            'sum': ('django.db.models.fields.FloatField', [], {})
+        },
+        u'core.sensor': {
+            'Meta': {'unique_together': "(['device', 'metric'],)", 'object_name': 'Sensor'},
+            'data_type': ('django.db.models.fields.CharField', [], {'default': "'float'", 'max_length': '10'}),
+            'device': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'sensors'", 'to': u"orm['core.Device']"}),
+            'geo_location': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['core.GeoLocation']", 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'metadata': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'metric': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'sensors'", 'to': u"orm['core.Metric']"}),
+            'unit': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'sensors'", 'to': u"orm['core.Unit']"})
+        },
+        u'core.site': {
+            'Meta': {'object_name': 'Site'},
+            'geo_location': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['core.GeoLocation']", 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'raw_zmq_stream': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'url': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'})
+        },
+        u'core.statusupdate': {
+            'Meta': {'object_name': 'StatusUpdate'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'person': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'status_updates'", 'to': u"orm['core.Person']"}),
+            'status': ('django.db.models.fields.TextField', [], {}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'})
+        },
+        u'core.unit': {
+            'Meta': {'object_name': 'Unit'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        }
+    }
+
+    complete_apps = ['core']
\ No newline at end of file
@@ -1,4 +1,5 @@
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import connections, models, router
 from django.utils import timezone
 
 
@@ -97,6 +98,11 @@ class Metric(models.Model):
         return self.name
 
 
+DATA_TYPE_FLOAT = 'float'
+DATA_TYPE_STATE = 'state'
+SENSOR_DATA_TYPES = [(DATA_TYPE_FLOAT, 'Float'), (DATA_TYPE_STATE, 'State')]
+
+
 class Sensor(models.Model):
     '''An individual sensor. There may be multiple sensors on a single device.
     The metadata field is used to store information that might be necessary to
@@ -107,6 +113,10 @@ class Sensor(models.Model):
     unit = models.ForeignKey(Unit, related_name='sensors')
     metadata = models.CharField(max_length=255, blank=True)
     geo_location = models.OneToOneField(GeoLocation, null=True, blank=True)
+    # float sensors store every point. State sensors report discrete values
+    # such as on/off flags, and only store the points where the value changes
+    data_type = models.CharField(max_length=10, choices=SENSOR_DATA_TYPES,
+                                 default=DATA_TYPE_FLOAT)
 
     class Meta:
         unique_together = ['device', 'metric']
@@ -132,6 +142,20 @@ class ScalarData(models.Model):
         verbose_name_plural = "scalar data"
         index_together = [['sensor', 'timestamp']]
 
+    def save(self, *args, **kwargs):
+        # when the table is partitioned (see chain.core.partitions) the row is
+        # inserted into a partition by a trigger, so INSERT ... RETURNING
+        # doesn't give back the new ID. Take one from the sequence instead
+        using = kwargs.get('using') or router.db_for_write(
+            ScalarData, instance=self)
+        if self.id is None and connections[using].vendor == 'postgresql':
+            cursor = connections[using].cursor()
+            cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s))',
+                           [self._meta.db_table, 'id'])
+            self.id = cursor.fetchone()[0]
+            kwargs['force_insert'] = True
+        super(ScalarData, self).save(*args, **kwargs)
+
     def __repr__(self):
         return 'ScalarData(timestamp=%r, value=%r, sensor=%r)' % (
             self.timestamp, self.value, self.sensor)
@@ -140,6 +164,227 @@ class ScalarData(models.Model):
         return '%.3f %s' % (self.value, self.sensor.unit)
 
 
+class ScalarDataRollup(models.Model):
+    '''A summary of a sensor's data over one bucket of time, resolution
+    seconds long and starting at start (aligned to the unix epoch, so day
+    buckets are UTC days). These are kept up to date as data is stored, so
+    charts over long time ranges can read a few rollups rather than every
+    point. See chain.core.rollups'''
+    sensor = models.ForeignKey(Sensor, related_name='rollups')
+    resolution = models.IntegerField()
+    start = models.DateTimeField()
+    count = models.IntegerField(default=0)
+    min = models.FloatField()
+    max = models.FloatField()
+    sum = models.FloatField()
+    first = models.FloatField()
+    first_timestamp = models.DateTimeField()
+    last = models.FloatField()
+    last_timestamp = models.DateTimeField()
+
+    class Meta:
+        unique_together = ['sensor', 'resolution', 'start']
+
+    def __repr__(self):
+        return 'ScalarDataRollup(sensor=%r, resolution=%r, start=%r)' % (
+            self.sensor, self.resolution, self.start)
+
+    def __str__(self):
+        return '%ds from %s' % (self.resolution, self.start)
+
+    @property
+    def mean(self):
+        return self.sum / self.count
+
+    def add(self, timestamp, value):
+        '''Adds a data point to the summary'''
+        if not self.count:
+            self.min = self.max = self.sum = self.first = self.last = value
+            self.first_timestamp = self.last_timestamp = timestamp
+            self.count = 1
+            return
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sum += value
+        if timestamp < self.first_timestamp:
+            self.first, self.first_timestamp = value, timestamp
+        if timestamp >= self.last_timestamp:
+            self.last, self.last_timestamp = value, timestamp
+
+    def merge(self, other):
+        '''Adds the data summarized by another rollup of the same bucket'''
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+        if other.first_timestamp < self.first_timestamp:
+            self.first = other.first
+            self.first_timestamp = other.first_timestamp
+        if other.last_timestamp >= self.last_timestamp:
+            self.last = other.last
+            self.last_timestamp = other.last_timestamp
+
+
+class ScalarDataChunk(models.Model):
+    '''A sensor's data from one closed span of time, from start up to end,
+    compressed into a single row. Old data is moved here from ScalarData by
+    the compress_history management command, and is read back alongside the
+    raw data. See chain.core.chunks'''
+    sensor = models.ForeignKey(Sensor, related_name='chunks')
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    count = models.IntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = ['sensor', 'start']
+
+    def __repr__(self):
+        return 'ScalarDataChunk(sensor=%r, start=%r, end=%r)' % (
+            self.sensor, self.start, self.end)
+
+    def __str__(self):
+        return '%d points from %s' % (self.count, self.start)
+
+
+class RetentionPolicy(models.Model):
+    '''How many days of a sensor's data to keep in the database. Older data
+    is moved to files in the archive by the archive_history
+    management command, from where it can still be read. A policy applies to
+    either every sensor at a site or a single sensor, which takes precedence
+    over its site's policy. See chain.core.archive'''
+    site = models.OneToOneField(Site, null=True, blank=True,
+                                related_name='retention_policy')
+    sensor = models.OneToOneField(Sensor, null=True, blank=True,
+                                  related_name='retention_policy')
+    keep_days = models.IntegerField()
+
+    class Meta:
+        verbose_name_plural = "retention policies"
+
+    def __repr__(self):
+        return 'RetentionPolicy(site=%r, sensor=%r, keep_days=%r)' % (
+            self.site, self.sensor, self.keep_days)
+
+    def __str__(self):
+        return 'Keep %d days of %s' % (self.keep_days,
+                                       self.sensor or self.site)
+
+    def clean(self):
+        if (self.site is None) == (self.sensor is None):
+            raise ValidationError(
+                'A retention policy needs either a site or a sensor')
+        if self.keep_days < 1:
+            raise ValidationError('keep_days must be at least 1')
+
+
+class ArchiveFile(models.Model):
+    '''A file in the archive holding a sensor's data from start up
+    to end. path is relative to ARCHIVE_ROOT'''
+    sensor = models.ForeignKey(Sensor, related_name='archive_files')
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    count = models.IntegerField()
+    path = models.CharField(max_length=255, unique=True)
+
+    class Meta:
+        index_together = [['sensor', 'start']]
+
+    def __repr__(self):
+        return 'ArchiveFile(sensor=%r, path=%r)' % (self.sensor, self.path)
+
+    def __str__(self):
+        return self.path
+
+
+class LatestValue(models.Model):
+    '''The most recent data point from a sensor, and when it was received.
+    This is kept up to date as data is stored, so a sensor's current value
+    can be read without searching its data. See chain.core.latest'''
+    sensor = models.OneToOneField(Sensor, primary_key=True,
+                                  related_name='latest_value')
+    value = models.FloatField()
+    timestamp = models.DateTimeField()
+    received = models.DateTimeField(default=timezone.now)
+
+    def __repr__(self):
+        return 'LatestValue(sensor=%r, value=%r, timestamp=%r)' % (
+            self.sensor, self.value, self.timestamp)
+
+    def __str__(self):
+        return '%.3f at %s' % (self.value, self.timestamp)
+
+
+class IngestBatch(models.Model):
+    '''A record that a batch of data with a client-supplied ID has been
+    stored, so that if the client sends the batch again (e.g. because its
+    request timed out) it can be acknowledged without storing it twice. IDs
+    only need to be unique within the scope they were posted to, such as
+    "sensor-12" for data posted to sensor 12, so unrelated clients can't
+    collide. Records older than INGEST_BATCH_MAX_AGE_DAYS are deleted by the
+    expire_batches management command'''
+    scope = models.CharField(max_length=255, default='')
+    batch_id = models.CharField(max_length=255)
+    count = models.IntegerField()
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name_plural = "ingest batches"
+        unique_together = ['scope', 'batch_id']
+
+    def __repr__(self):
+        return 'IngestBatch(scope=%r, batch_id=%r, count=%r, created=%r)' % (
+            self.scope, self.batch_id, self.count, self.created)
+
+    def __str__(self):
+        return '%s %s' % (self.scope, self.batch_id)
+
+
+class IngestPolicy(models.Model):
+    '''Rules for dropping incoming data from a sensor that doesn't tell us
+    anything new, such as a setpoint that's reported every cycle but rarely
+    changes. A point is dropped if it's within the deadband of the last point
+    that was stored, which is the larger of deadband_abs and deadband_rel
+    times the last value. Without a deadband, exact repeats are dropped if
+    drop_duplicates is set. Even so, a point is always stored if it's been
+    max_silence seconds since the last one was'''
+    sensor = models.OneToOneField(Sensor, related_name='ingest_policy')
+    drop_duplicates = models.BooleanField(default=False)
+    deadband_abs = models.FloatField(default=0)
+    deadband_rel = models.FloatField(default=0)
+    max_silence = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = "ingest policies"
+
+    def __repr__(self):
+        return ('IngestPolicy(sensor=%r, drop_duplicates=%r, '
+                'deadband_abs=%r, deadband_rel=%r, max_silence=%r)') % (
+                    self.sensor, self.drop_duplicates, self.deadband_abs,
+                    self.deadband_rel, self.max_silence)
+
+    def __str__(self):
+        return 'Ingest policy for sensor %d' % self.sensor_id
+
+    def suppresses(self, last_timestamp, last_value, timestamp, value):
+        '''Returns whether a point should be dropped, given the timestamp and
+        value of the last point that was stored'''
+        # older points are probably a backfill, so leave them alone
+        if timestamp <= last_timestamp:
+            return False
+        if self.max_silence is not None and \
+                (timestamp - last_timestamp).total_seconds() >= \
+                self.max_silence:
+            return False
+        change = abs(value - last_value)
+        threshold = max(self.deadband_abs,
+                        self.deadband_rel * abs(last_value))
+        if threshold > 0:
+            return change <= threshold
+        return self.drop_duplicates and change == 0
+
+
 class PresenceData(models.Model):
     '''Sensor data indicating that a given Person was detected by the sensor at
     the given time, for instance using RFID or face recognition. Note that this
@@ -0,0 +1,225 @@
+'''Monthly partitioning of the ScalarData table on PostgreSQL. Each month's
+data lives in its own child table, e.g. core_scalardata_y2014m04, which
+inherits from core_scalardata and has a CHECK constraint on its time range.
+An insert trigger on the parent routes new rows to the right child, so the
+models and queries don't need to know about it. Queries on the parent with a
+time range only scan the children that can match, as long as
+constraint_exclusion is left at its default of "partition".
+
+The parent table keeps its own indexes, but once the existing rows have been
+moved out it's empty, so maintaining them costs nothing. Each child only
+indexes (sensor_id, timestamp) and timestamp, as the first of those also
+serves lookups by sensor. Old months can be removed from the table by
+detaching their child, which is instant, rather than with a huge DELETE.
+
+Partitions are created ahead of time by the partition_data management
+command. Rows that don't fall in any partition stay in the parent table.
+
+This uses table inheritance rather than declarative partitioning, so it works
+on the PostgreSQL 9.1 that ships with Ubuntu 12.04.'''
+
+import re
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.timezone import utc
+from datetime import datetime
+from chain.core.models import ScalarData, Sensor
+
+PARENT_TABLE = ScalarData._meta.db_table
+TRIGGER_FUNCTION = PARENT_TABLE + '_route_insert'
+TRIGGER_NAME = PARENT_TABLE + '_partition_insert'
+PARTITION_NAME_RE = re.compile(
+    '^' + re.escape(PARENT_TABLE) + r'_y(\d{4})m(\d\d)$')
+
+
+def month_start(timestamp):
+    '''Returns the start of the month (in UTC) that the given aware datetime
+    falls in'''
+    timestamp = timestamp.astimezone(utc)
+    return datetime(timestamp.year, timestamp.month, 1, tzinfo=utc)
+
+
+def add_months(month, count):
+    '''Returns the start of the month count months after the given month
+    start. count can be negative'''
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=utc)
+
+
+def months_between(start, end):
+    '''Returns the starts of every month from the one containing start up to
+    and including the one containing end'''
+    months = []
+    month = month_start(start)
+    while month <= end:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def partition_name(month):
+    return '%s_y%04dm%02d' % (PARENT_TABLE, month.year, month.month)
+
+
+def parse_partition_name(name):
+    '''Returns the month that the named partition holds, or None if the name
+    isn't a partition of ours'''
+    match = PARTITION_NAME_RE.match(name)
+    if match is None:
+        return None
+    return datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=utc)
+
+
+def quote_timestamp(timestamp):
+    return "'%s'" % timestamp.strftime('%Y-%m-%d %H:%M:%S+00')
+
+
+def range_condition(month, column='"timestamp"'):
+    return '%s >= %s AND %s < %s' % (
+        column, quote_timestamp(month), column,
+        quote_timestamp(add_months(month, 1)))
+
+
+def partition_ddl(month):
+    '''Returns the statements that create the partition for the given
+    month'''
+    name = partition_name(month)
+    return [
+        'CREATE TABLE "%s" (PRIMARY KEY (id), CHECK (%s)) INHERITS ("%s")' % (
+            name, range_condition(month), PARENT_TABLE),
+        # foreign keys aren't inherited
+        'ALTER TABLE "%s" ADD CONSTRAINT "%s_sensor_id_fkey" FOREIGN KEY '
+        '(sensor_id) REFERENCES "%s" (id) DEFERRABLE INITIALLY DEFERRED' % (
+            name, name, Sensor._meta.db_table),
+        'CREATE INDEX "%s_sensor_id_timestamp" ON "%s" '
+        '(sensor_id, "timestamp")' % (name, name),
+        'CREATE INDEX "%s_timestamp" ON "%s" ("timestamp")' % (name, name),
+    ]
+
+
+def trigger_function_sql(months):
+    '''Returns the statement that (re)defines the insert trigger function to
+    route rows to the partitions for the given months. The most recent months
+    are checked first, as that's where nearly all new data goes'''
+    branches = []
+    for month in sorted(months, reverse=True):
+        branches.append(
+            '%s %s THEN\n        INSERT INTO "%s" VALUES (NEW.*);' % (
+                'ELSIF' if branches else 'IF',
+                range_condition(month, 'NEW."timestamp"'),
+                partition_name(month)))
+    if branches:
+        body = '\n    '.join(branches) + '''
+    ELSE
+        RETURN NEW;
+    END IF;
+    RETURN NULL;'''
+    else:
+        body = 'RETURN NEW;'
+    return '''CREATE OR REPLACE FUNCTION "%s"() RETURNS trigger AS $$
+BEGIN
+    %s
+END;
+$$ LANGUAGE plpgsql''' % (TRIGGER_FUNCTION, body)
+
+
+class UnsupportedDatabaseError(Exception):
+    '''Raised when the database can't be partitioned, as it isn't
+    PostgreSQL'''
+    pass
+
+
+def check_database():
+    if connection.vendor != 'postgresql':
+        raise UnsupportedDatabaseError(
+            'Partitioning is only supported on PostgreSQL')
+
+
+def get_partitions(cursor):
+    '''Returns the months that currently have a partition attached'''
+    cursor.execute(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class parent ON pg_inherits.inhparent = parent.oid '
+        'JOIN pg_class child ON pg_inherits.inhrelid = child.oid '
+        'WHERE parent.relname = %s', [PARENT_TABLE])
+    months = [parse_partition_name(name) for (name,) in cursor.fetchall()]
+    return sorted(month for month in months if month is not None)
+
+
+def update_trigger(cursor, months):
+    cursor.execute(trigger_function_sql(months))
+    cursor.execute('SELECT 1 FROM pg_trigger WHERE tgname = %s',
+                   [TRIGGER_NAME])
+    if cursor.fetchone() is None:
+        cursor.execute(
+            'CREATE TRIGGER "%s" BEFORE INSERT ON "%s" FOR EACH ROW '
+            'EXECUTE PROCEDURE "%s"()' % (
+                TRIGGER_NAME, PARENT_TABLE, TRIGGER_FUNCTION))
+
+
+def create_partitions(months):
+    '''Creates partitions for any of the given months that don't have one,
+    and updates the insert trigger to use them. Returns the months that were
+    created'''
+    check_database()
+    with transaction.atomic():
+        cursor = connection.cursor()
+        existing = get_partitions(cursor)
+        created = sorted(set(months) - set(existing))
+        for month in created:
+            for statement in partition_ddl(month):
+                cursor.execute(statement)
+        update_trigger(cursor, existing + created)
+    return created
+
+
+def move_existing_rows():
+    '''Moves rows that are stored in the parent table itself, e.g. from
+    before partitioning was set up, into partitions, creating them as needed.
+    Returns the number of rows moved'''
+    check_database()
+    cursor = connection.cursor()
+    cursor.execute('SELECT min("timestamp"), max("timestamp") FROM ONLY "%s"'
+                   % PARENT_TABLE)
+    first, last = cursor.fetchone()
+    if first is None:
+        return 0
+    months = months_between(first, last)
+    create_partitions(months)
+    moved = 0
+    # one month per transaction, so a big table isn't locked all at once
+    for month in months:
+        with transaction.atomic():
+            cursor.execute(
+                'WITH moved AS (DELETE FROM ONLY "%s" WHERE %s RETURNING *) '
+                'INSERT INTO "%s" SELECT * FROM moved' % (
+                    PARENT_TABLE, range_condition(month),
+                    partition_name(month)))
+            moved += cursor.rowcount
+    return moved
+
+
+def detach_partitions(before, drop=False):
+    '''Detaches the partitions for months before the given one, so their data
+    no longer appears in the ScalarData table. Detached partitions are kept as
+    standalone tables, e.g. for archiving, unless drop is set. Returns the
+    months that were detached'''
+    check_database()
+    with transaction.atomic():
+        cursor = connection.cursor()
+        existing = get_partitions(cursor)
+        detached = [month for month in existing if month < before]
+        for month in detached:
+            cursor.execute('ALTER TABLE "%s" NO INHERIT "%s"' % (
+                partition_name(month), PARENT_TABLE))
+            if drop:
+                cursor.execute('DROP TABLE "%s"' % partition_name(month))
+        update_trigger(cursor, [month for month in existing
+                                if month not in detached])
+    return detached
+
+
+def current_months(ahead):
+    '''Returns this month and the given number of months after it'''
+    month = month_start(timezone.now())
+    return [add_months(month, i) for i in range(ahead + 1)]
@@ -0,0 +1,160 @@
+'''Rate limiting for the data ingest views, so that a single misbehaving site
+or client can't tie up the web workers and database connections that
+everyone else needs. Each site and each client gets its own limit,
+configured with INGEST_SITE_RATE_LIMIT and INGEST_CLIENT_RATE_LIMIT.
+
+Each limit allows up to burst requests in every window of burst / rate
+seconds, so over time requests average out at the rate. The count for each
+window is kept in the Django cache named by RATE_LIMIT_CACHE and only changed
+with add and incr, which are atomic in memcached, so the limits hold across
+all the gunicorn workers however many requests arrive at once. That needs a
+cache that's shared between the workers. With a per-process cache (local
+memory or dummy) the limits couldn't be enforced, so they're turned off and
+a warning is logged when the server starts, rather than failing every ingest
+request. A request is only counted against its limits once it's been checked
+against all of them, so one that's refused doesn't use up the rest of its
+allowance.
+
+Since the windows are fixed, a client can get up to twice the burst through
+in quick succession by straddling the end of one window and the start of the
+next.'''
+
+import hashlib
+import logging
+import math
+import time
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from chain.settings import RATE_LIMIT_CACHE
+from chain.settings import INGEST_SITE_RATE_LIMIT, INGEST_SITE_RATE_LIMITS
+from chain.settings import INGEST_CLIENT_RATE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# caches that each process has its own copy of
+PER_PROCESS_CACHES = (LocMemCache, DummyCache)
+
+
+def limits_enabled():
+    return INGEST_SITE_RATE_LIMIT is not None or \
+        INGEST_CLIENT_RATE_LIMIT is not None or \
+        any(limit is not None for limit in INGEST_SITE_RATE_LIMITS.values())
+
+
+def get_limit_cache():
+    '''Returns the cache the limits are kept in, or None if it isn't shared
+    between processes'''
+    cache = get_cache(RATE_LIMIT_CACHE)
+    if type(cache) in PER_PROCESS_CACHES:
+        return None
+    return cache
+
+
+def check_limit_cache():
+    '''Logs a warning if limits are set but can't be enforced'''
+    if limits_enabled() and get_limit_cache() is None:
+        logger.warning('Rate limits are off, as RATE_LIMIT_CACHE does not '
+                       'name a cache that is shared between processes, such '
+                       'as memcached')
+
+
+class RateLimit(object):
+    '''Allows up to burst requests in each window of burst / rate seconds'''
+
+    def __init__(self, name, rate, burst, cache):
+        self.burst = burst
+        # memcached expiry times are whole seconds
+        self.window = max(1, int(math.ceil(burst / float(rate))))
+        self.cache = cache
+        # names can contain characters memcached doesn't allow in keys
+        self.name = 'ratelimit:' + hashlib.md5(name).hexdigest()
+
+    def get_key(self, now):
+        return '%s:%d' % (self.name, int(now) // self.window)
+
+    def get_wait(self, now):
+        '''Returns the number of seconds until the current window ends'''
+        return self.window - now % self.window
+
+    def check(self, now=None):
+        '''Returns 0 if there's room for another request in the current
+        window, otherwise the number of seconds until there will be'''
+        now = time.time() if now is None else now
+        if self.cache.get(self.get_key(now), 0) < self.burst:
+            return 0
+        return self.get_wait(now)
+
+    def consume(self, now=None):
+        '''Counts a request against the limit. Returns 0 if it's allowed,
+        otherwise the number of seconds until one will be, in which case it
+        isn't counted'''
+        now = time.time() if now is None else now
+        key = self.get_key(now)
+        # the count only needs keeping until its window is over
+        self.cache.add(key, 0, self.window + 1)
+        try:
+            count = self.cache.incr(key)
+        except ValueError:
+            # it expired in between, so this is the only request
+            self.cache.add(key, 1, self.window + 1)
+            return 0
+        if count <= self.burst:
+            return 0
+        self.release(now)
+        return self.get_wait(now)
+
+    def release(self, now):
+        '''Uncounts a request that was counted by consume at the given time'''
+        try:
+            self.cache.decr(self.get_key(now))
+        except ValueError:
+            pass
+
+
+def get_client_id(request):
+    '''Identifies the client making the request by its IP address. nginx adds
+    the address it saw to the end of X-Forwarded-For, so that's the only entry
+    we can trust'''
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    if forwarded:
+        return forwarded.split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def check_ingest_rate(request, site_id):
+    '''Counts the request against the limits for the client and the site that
+    data is being posted to, unless it's over either of them. Returns 0 if
+    the request can go ahead, or the number of seconds the client should
+    wait before trying again'''
+    site_id = int(site_id)
+    cache = get_limit_cache()
+    if cache is None:
+        # see check_limit_cache
+        return 0
+    limits = []
+    if INGEST_CLIENT_RATE_LIMIT is not None:
+        rate, burst = INGEST_CLIENT_RATE_LIMIT
+        limits.append(RateLimit('client:' + get_client_id(request),
+                                rate, burst, cache))
+    site_limit = INGEST_SITE_RATE_LIMITS.get(site_id, INGEST_SITE_RATE_LIMIT)
+    if site_limit is not None:
+        rate, burst = site_limit
+        limits.append(RateLimit('site:%d' % site_id, rate, burst, cache))
+    now = time.time()
+    wait = max([limit.check(now) for limit in limits] + [0])
+    if wait:
+        return wait
+    # another request may have taken the last of a limit since we checked
+    consumed = []
+    for limit in limits:
+        wait = limit.consume(now)
+        if wait:
+            for other in consumed:
+                other.release(now)
+            return wait
+        consumed.append(limit)
+    return 0
+
+
+check_limit_cache()
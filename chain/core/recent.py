@@ -0,0 +1,240 @@
+'''Shared-memory ring buffers of each sensor's recent data. Most requests
+for data are for the last few hours, so as data is stored it's also appended
+to a fixed-size file per sensor under RECENT_DATA_DIR (ideally on a tmpfs
+such as /dev/shm), which every process maps into memory. Requests for a time
+range that a sensor's buffer fully covers are answered from it without
+touching the database.
+
+Each file is a header followed by RECENT_DATA_POINTS records of a
+little-endian int64 timestamp in microseconds since the unix epoch and a
+float64 value. The header holds the total number of points ever written, so
+the newest is at that count modulo the capacity, and the time the buffer
+covers from: every point the sensor has stored from then on is in the
+buffer. The buffer is only ever appended to in time order, so:
+
+* a new buffer covers from when it was created
+* overwriting the oldest point moves the start of the coverage past it
+* a point that's older than the newest one in the buffer can't be inserted,
+  so the coverage is moved past it instead
+
+Writers and readers take an flock on the file, so it can be shared by the
+web server's worker processes and the ingest daemon. Points are only
+appended once the transaction that stored them has committed, so a rolled
+back batch never shows up in the buffer. Code that stores data inside a
+larger transaction should wrap it in deferred_recent(), like clear_on_error.
+
+Data that's deleted from the database, e.g. in the admin, stays in the
+buffer until it's overwritten, so after deleting recent data empty the
+sensor's buffer with reset_recent.'''
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from chain.core.models import ScalarData
+from chain.core.chunks import to_micros, from_micros
+from chain.settings import RECENT_DATA_DIR, RECENT_DATA_POINTS
+
+MAGIC = 'CRB1'
+HEADER = struct.Struct('<4sqQq')
+RECORD = struct.Struct('<qd')
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+_local = threading.local()
+
+
+class RingBuffer(object):
+    '''One sensor's buffer file, mapped into memory. A new file is created
+    with the given capacity, but an existing one keeps its own'''
+    def __init__(self, path, capacity):
+        self._lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < HEADER.size:
+                    os.ftruncate(fd, HEADER.size + capacity * RECORD.size)
+                    os.write(fd, HEADER.pack(
+                        MAGIC, capacity, 0, to_micros(timezone.now())))
+                self._map = mmap.mmap(fd, 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+        magic, self.capacity, _, _ = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('%s is not a ring buffer' % path)
+
+    @contextmanager
+    def locked(self, operation):
+        with self._lock:
+            fcntl.flock(self._fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def record_time(self, count, index):
+        '''Returns the timestamp of the index'th oldest point in the buffer,
+        given the total count of points written'''
+        n = min(count, self.capacity)
+        offset = HEADER.size + \
+            ((count - n + index) % self.capacity) * RECORD.size
+        return RECORD.unpack_from(self._map, offset)[0]
+
+    def append(self, points):
+        '''Appends a time-ordered list of (microseconds, value) pairs'''
+        with self.locked(fcntl.LOCK_EX):
+            _, _, count, covered_from = HEADER.unpack_from(self._map)
+            newest = self.record_time(count, min(count, self.capacity) - 1) \
+                if count else None
+            for micros, value in points:
+                if micros < covered_from:
+                    continue
+                if newest is not None and micros < newest:
+                    covered_from = micros + 1
+                    continue
+                offset = HEADER.size + (count % self.capacity) * RECORD.size
+                if count >= self.capacity:
+                    overwritten = RECORD.unpack_from(self._map, offset)[0]
+                    covered_from = max(covered_from, overwritten + 1)
+                RECORD.pack_into(self._map, offset, micros, value)
+                count += 1
+                newest = micros
+            HEADER.pack_into(self._map, 0, MAGIC, self.capacity, count,
+                             covered_from)
+
+    def reset(self):
+        '''Empties the buffer, so it covers from now'''
+        with self.locked(fcntl.LOCK_EX):
+            HEADER.pack_into(self._map, 0, MAGIC, self.capacity, 0,
+                             to_micros(timezone.now()))
+
+    def read(self, start, end):
+        '''Returns the (microseconds, value) pairs from start up to end, or
+        None if the buffer doesn't cover all of that time'''
+        with self.locked(fcntl.LOCK_SH):
+            _, _, count, covered_from = HEADER.unpack_from(self._map)
+            if start < covered_from:
+                return None
+            n = min(count, self.capacity)
+            first = self.search(count, n, start)
+            last = self.search(count, n, end)
+            points = []
+            # the points are contiguous in the file, other than where they
+            # wrap around to the start
+            index = first
+            while index < last:
+                position = (count - n + index) % self.capacity
+                span = min(last - index, self.capacity - position)
+                values = struct.unpack_from(
+                    '<' + 'qd' * span, self._map,
+                    HEADER.size + position * RECORD.size)
+                points.extend(zip(values[::2], values[1::2]))
+                index += span
+            return points
+
+    def search(self, count, n, micros):
+        '''Returns the index of the oldest point at or after the given time,
+        or n if there isn't one'''
+        low, high = 0, n
+        while low < high:
+            middle = (low + high) // 2
+            if self.record_time(count, middle) < micros:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+def get_buffer(sensor_id, create=False):
+    '''Returns this process's mapping of the sensor's buffer, or None if it
+    doesn't have one (and create isn't set) or RECENT_DATA_DIR isn't set'''
+    if not RECENT_DATA_DIR:
+        return None
+    with _buffers_lock:
+        ring = _buffers.get(sensor_id)
+        if ring is None:
+            path = os.path.join(RECENT_DATA_DIR, 'sensor-%d.ring' % sensor_id)
+            if not create and not os.path.exists(path):
+                return None
+            ring = _buffers[sensor_id] = RingBuffer(path, RECENT_DATA_POINTS)
+        return ring
+
+
+def append_recent(objs):
+    '''Appends the given stored ScalarData objects to their sensors'
+    buffers'''
+    if not RECENT_DATA_DIR:
+        return
+    by_sensor = {}
+    for obj in objs:
+        by_sensor.setdefault(int(obj.sensor_id), []).append(
+            (to_micros(obj.timestamp), obj.value))
+    for sensor_id, points in by_sensor.items():
+        points.sort(key=lambda point: point[0])
+        get_buffer(sensor_id, create=True).append(points)
+
+
+def stage_recent(objs):
+    '''Appends the given newly stored ScalarData objects to the buffers, or
+    if this is inside deferred_recent, once that's finished without an
+    error'''
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        append_recent(objs)
+    else:
+        pending.extend(objs)
+
+
+@contextmanager
+def deferred_recent():
+    '''Holds back data staged in the wrapped block from the buffers until the
+    block finishes, dropping it if the block raises an exception. Use this
+    around transactions that store data'''
+    outer = getattr(_local, 'pending', None)
+    if outer is not None:
+        # the outermost block decides
+        yield
+        return
+    _local.pending = []
+    try:
+        yield
+        pending = _local.pending
+    finally:
+        _local.pending = None
+    append_recent(pending)
+
+
+def read_recent(sensor_id, start, end):
+    '''Returns the sensor's (timestamp, value) pairs from start up to end if
+    its buffer covers that time, or None if the database needs reading'''
+    ring = get_buffer(sensor_id)
+    if ring is None:
+        return None
+    points = ring.read(to_micros(start), to_micros(end))
+    if points is None:
+        return None
+    return [(from_micros(micros), value) for micros, value in points]
+
+
+def reset_recent(sensor_id):
+    '''Empties the sensor's buffer, if it has one, for every process'''
+    ring = get_buffer(sensor_id)
+    if ring is not None:
+        ring.reset()
+
+
+@receiver(post_save, sender=ScalarData)
+def data_saved(sender, instance, created, raw, **kwargs):
+    # bulk inserts don't send post_save, so they're added by store_data
+    if created and not raw:
+        stage_recent([instance])
@@ -0,0 +1,159 @@
+'''Sends reads made while handling GET requests to read replicas.
+DATABASE_REPLICAS maps database aliases to lists of their replicas' aliases,
+and inside a request that ReplicaMiddleware lets use them, reads that would go
+to a database with replicas go to one of them instead. Everything else, such
+as ingest, management commands and the daemons, only uses the primaries.
+
+Replication is asynchronous, so a client that has just written something
+might not see it on a replica. Any request that isn't a GET or HEAD keeps the
+client's reads on the primaries for the next REPLICA_PIN_SECONDS. The client
+is pinned both with a cookie and by its address, which is remembered in the
+REPLICA_PIN_CACHE cache for clients that don't keep cookies. That cache
+needs to be shared between the workers (e.g. memcached) for the pin to hold
+whichever worker gets the next request. Clients that can't rely on either,
+such as several collectors behind one address, can send an X-Read-Primary
+header with any request that needs up to date data.
+
+Each replica's lag is also checked every REPLICA_LAG_CHECK_INTERVAL seconds,
+and one that's more than REPLICA_MAX_LAG seconds behind (or can't be reached)
+isn't used until it catches up.
+
+Each request sticks to the replica it first picks for each database, so it
+sees a consistent view of the data.'''
+
+import hashlib
+import random
+import threading
+from django.core.cache import get_cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from chain.core.cache import LRUCache
+from chain.core.ratelimit import get_client_id
+from chain.settings import DATABASE_REPLICAS, REPLICA_PIN_SECONDS
+from chain.settings import REPLICA_PIN_CACHE
+from chain.settings import REPLICA_MAX_LAG, REPLICA_LAG_CHECK_INTERVAL
+
+PIN_COOKIE = 'chain_pin_primary'
+PIN_HEADER = 'HTTP_X_READ_PRIMARY'
+SAFE_METHODS = ('GET', 'HEAD')
+
+# the number of seconds a replica is behind its primary, or NULL if it isn't a
+# replica. A replica that has replayed everything it's received is up to date
+# however long ago the last transaction was
+REPLICA_LAG_SQL = {
+    'postgresql': '''
+        SELECT CASE
+            WHEN pg_last_xlog_receive_location() =
+                 pg_last_xlog_replay_location() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END''',
+}
+
+_local = threading.local()
+_lags = LRUCache(100, REPLICA_LAG_CHECK_INTERVAL)
+
+
+def get_primary(alias):
+    '''Returns the alias of the primary database the given one replicates,
+    or the given alias if it isn't a replica'''
+    for primary, replicas in DATABASE_REPLICAS.items():
+        if alias in replicas:
+            return primary
+    return alias
+
+
+def measure_lag(alias):
+    '''Returns the number of seconds the given replica is behind, or infinity
+    if it can't be reached. Databases that can't report it are assumed to be
+    up to date'''
+    connection = connections[alias]
+    if connection.vendor not in REPLICA_LAG_SQL:
+        return 0.0
+    try:
+        cursor = connection.cursor()
+        cursor.execute(REPLICA_LAG_SQL[connection.vendor])
+        lag = cursor.fetchone()[0]
+    except DatabaseError:
+        return float('inf')
+    return float(lag or 0)
+
+
+def replica_lag(alias):
+    '''Returns the given replica's lag, checking it at most every
+    REPLICA_LAG_CHECK_INTERVAL seconds'''
+    lag = _lags.get(alias)
+    if lag is None:
+        lag = measure_lag(alias)
+        _lags.set(alias, lag)
+    return lag
+
+
+def get_read_db(alias):
+    '''Returns the alias to read data that's in the given database from: one
+    of its replicas that's caught up, if the current request may use them, or
+    otherwise the database itself'''
+    if not getattr(_local, 'use_replicas', False):
+        return alias
+    chosen = _local.chosen
+    if alias not in chosen:
+        replicas = [replica for replica in DATABASE_REPLICAS.get(alias, [])
+                    if replica_lag(replica) <= REPLICA_MAX_LAG]
+        chosen[alias] = random.choice(replicas) if replicas else alias
+    return chosen[alias]
+
+
+class ReplicaRouter(object):
+    '''Routes reads to replicas, where get_read_db allows, and makes sure
+    objects that were read from a replica are written to its primary'''
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return get_read_db(get_primary(instance._state.db))
+        return get_read_db(DEFAULT_DB_ALIAS)
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return get_primary(instance._state.db)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if get_primary(obj1._state.db or DEFAULT_DB_ALIAS) == \
+                get_primary(obj2._state.db or DEFAULT_DB_ALIAS):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        # replicas get their tables from their primary
+        if get_primary(db) != db:
+            return False
+        return None
+
+
+def get_pin_key(request):
+    # addresses can contain characters memcached doesn't allow in keys
+    return 'replicapin:' + hashlib.md5(get_client_id(request)).hexdigest()
+
+
+def is_pinned(request):
+    '''Returns whether the request's reads have to go to the primaries'''
+    return PIN_COOKIE in request.COOKIES or PIN_HEADER in request.META or \
+        get_cache(REPLICA_PIN_CACHE).get(get_pin_key(request)) is not None
+
+
+class ReplicaMiddleware(object):
+    '''Lets GET and HEAD requests read from replicas, unless the client has
+    written something in the last REPLICA_PIN_SECONDS or asks not to'''
+
+    def process_request(self, request):
+        _local.use_replicas = bool(DATABASE_REPLICAS) and \
+            request.method in SAFE_METHODS and not is_pinned(request)
+        _local.chosen = {}
+
+    def process_response(self, request, response):
+        _local.use_replicas = False
+        if DATABASE_REPLICAS and request.method not in SAFE_METHODS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS)
+            get_cache(REPLICA_PIN_CACHE).set(get_pin_key(request), 1,
+                                             REPLICA_PIN_SECONDS)
+        return response
@@ -2,11 +2,126 @@ from chain.core.api import Resource, ResourceField, CollectionField
 from chain.core.api import full_reverse
 from chain.core.api import CHAIN_CURIES
 from chain.core.api import BadRequestException
-from chain.core.models import Site, Device, Sensor, ScalarData
+from chain.core.api import render_error, zmq_socket
+from chain.core.api import HTTP_STATUS_SUCCESS
+from chain.core.api import HTTP_STATUS_BAD_REQUEST, HTTP_STATUS_CREATED
+from chain.core.api import HTTP_STATUS_ACCEPTED
+from chain.core.api import HTTP_STATUS_SERVICE_UNAVAILABLE
+from chain.core.api import HTTP_STATUS_METHOD_NOT_ALLOWED
+from chain.core.api import HTTP_STATUS_NOT_FOUND
+from chain.core.api import HTTP_STATUS_UNSUPPORTED_MEDIA_TYPE
+from chain.core.api import HTTP_STATUS_TOO_MANY_REQUESTS
+from chain.core.api import HTTP_STATUS_MULTI_STATUS
+from chain.core.api import get_batch_mode, BATCH_MODE_BEST_EFFORT
+from chain.core.models import Site, Device, Sensor, ScalarData, IngestBatch
+from chain.core.models import SENSOR_DATA_TYPES, ScalarDataRollup
+from chain.core.models import DATA_TYPE_FLOAT, DATA_TYPE_STATE
+from chain.core.models import LatestValue
+from chain.core.ingest import get_write_behind_buffer, BufferFullError
+from chain.core.ingest import flatten_metrics, build_scalar_data
+from chain.core.ingest import resolve_device, resolve_sensors
+from chain.core.ingest import claim_batch, DuplicateBatchError
+from chain.core.ingest import BINARY_DECODERS, iter_json_list
+from chain.core.ingest import DataValidator, apply_ingest_policies
+from chain.core.ingest import deferred_policies
+from chain.core.ingest import store_data, PACKED_DATA_MIME_TYPE
+from chain.core.cache import get_cached, get_sensor_tags, get_device_sensors
+from chain.core.cache import clear_on_error, clear_metadata_cache
+from chain.core.ratelimit import check_ingest_rate
+from chain.core.rollups import aggregate_data, parse_resolution, AGGREGATES
+from chain.core.rollups import MAX_RESOLUTION
+from chain.core.rollups import bucket_start
+from chain.core.downsample import lttb, rollup_points, to_epoch, from_epoch
+from chain.core.history import iter_points, last_point
+from chain.core.recent import deferred_recent, read_recent
+from chain.core.columnar import pack_data
+from chain.core.routers import get_data_db, get_data_read_db, get_data_dbs
+from chain.core.routers import get_site_db
+from chain.core.replicas import get_read_db
+from chain.settings import INGEST_STREAMING_THRESHOLD
+from chain.settings import INGEST_STREAMING_CHUNK_SIZE
+from chain.settings import ROLLUP_RESOLUTIONS
 from django.conf.urls import include, patterns, url
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
+from django.utils.timezone import utc
 from datetime import timedelta, datetime
 import calendar
+import json
+import math
+
+
+def get_batch_id(request):
+    '''Returns the client-supplied ID for the batch of data being posted,
+    given in the X-Batch-Id header, or None if there isn't one'''
+    batch_id = request.META.get('HTTP_X_BATCH_ID')
+    if batch_id is not None and not 0 < len(batch_id) <= 255:
+        raise BadRequestException(
+            'Batch IDs must be between 1 and 255 characters long')
+    return batch_id
+
+
+def parse_timestamp_filter(value, bound):
+    '''Converts a unix timestamp from the query string to a datetime, where
+    bound is "lower" or "upper" for the error message'''
+    try:
+        return datetime.utcfromtimestamp(float(value)).replace(tzinfo=utc)
+    except ValueError:
+        raise BadRequestException(
+            "Invalid timestamp format for %s bound of date range." % bound)
+
+
+def rate_limit_error(request, site_id):
+    '''Returns a 429 response if the client or the site has posted too much
+    data recently, or None if the request can go ahead'''
+    wait = check_ingest_rate(request, site_id)
+    if not wait:
+        return None
+    response = render_error(HTTP_STATUS_TOO_MANY_REQUESTS,
+                            'Too many requests, please slow down', request)
+    response['Retry-After'] = str(int(math.ceil(wait)))
+    return response
+
+
+def get_report_target(request, model, id):
+    '''Returns the object of the given model that reports are being POSTed
+    to, before anything else is checked. Raises BadRequestException if the
+    request isn't a POST or there's no such object'''
+    if request.method != 'POST':
+        raise BadRequestException('Reports must be POSTed to this resource',
+                                  status=HTTP_STATUS_METHOD_NOT_ALLOWED)
+    try:
+        return get_cached(model, id=id)
+    except (model.DoesNotExist, ValueError):
+        raise BadRequestException(
+            'There is no %s with ID %s' % (model._meta.verbose_name, id),
+            status=HTTP_STATUS_NOT_FOUND)
+
+
+def parse_reports(request, require_device=False):
+    '''Parses the body of a POSTed device report (or list of reports) and
+    checks that each one has a metrics object, and a device object if
+    require_device is set. Always returns a list'''
+    try:
+        reports = json.loads(request.body)
+    except ValueError:
+        raise BadRequestException('The data provided in the request body '
+                                  'cannot be parsed as legal JSON.')
+    if not isinstance(reports, list):
+        reports = [reports]
+    for i, report in enumerate(reports):
+        if not isinstance(report, dict) or \
+                not isinstance(report.get('metrics'), dict):
+            raise BadRequestException(
+                'Report %d must be an object with a "metrics" object' % i)
+        if require_device and not isinstance(report.get('device'), dict):
+            raise BadRequestException(
+                'Report %d must have a "device" object' % i)
+    return reports
 
 
 class SensorDataResource(Resource):
@@ -18,6 +133,19 @@ class SensorDataResource(Resource):
     required_fields = ['value']
     queryset = ScalarData.objects
     default_timespan = timedelta(hours=6)
+    # when aggregated data is requested without a time range, the page covers
+    # at least this many buckets
+    default_bucket_count = 360
+    default_aggregate = 'mean'
+    max_points_limit = 10000
+    # when downsampling, windows with up to this many points are read raw
+    downsample_raw_limit = 50000
+    # compressed and archived data is only read for requests that don't
+    # filter on anything but the sensor and time range
+    chunked_filters = set(['sensor_id', 'timestamp__gte', 'timestamp__lt'])
+    streaming_threshold = INGEST_STREAMING_THRESHOLD
+    streaming_chunk_size = INGEST_STREAMING_CHUNK_SIZE
+    validator = DataValidator(required_fields)
 
     def __init__(self, *args, **kwargs):
         super(SensorDataResource, self).__init__(*args, **kwargs)
@@ -31,7 +159,13 @@ class SensorDataResource(Resource):
         if not embed:
             return super(SensorDataResource, self).serialize_list(embed, cache)
 
+        # the page links keep the resolution, but it isn't a filter on the data
         href = self.get_list_href()
+        resolution, aggregates = self.pop_aggregation_params()
+        max_points = self.pop_max_points()
+        if max_points is not None and resolution is not None:
+            raise BadRequestException(
+                'max_points and resolution can\'t be used together')
 
         serialized_data = {
             '_links': {
@@ -41,44 +175,172 @@ class SensorDataResource(Resource):
                     'title': 'Add Data'
                 }
             },
-            'dataType': 'float'
+            'dataType': DATA_TYPE_FLOAT
         }
+        try:
+            sensor = get_cached(Sensor, id=self._filters.get('sensor_id'))
+        except (Sensor.DoesNotExist, ValueError, TypeError):
+            sensor = None
+        else:
+            serialized_data['dataType'] = sensor.data_type
         request_time = timezone.now()
 
         # if the time filters aren't given then use the most recent timespan,
         # if they are given, then we need to convert them from unix time to use
         # in the queryset filter
         if 'timestamp__gte' in self._filters:
-            try:
-                page_start = datetime.utcfromtimestamp(
-                    float(self._filters['timestamp__gte']))
-            except ValueError:
-                raise BadRequestException("Invalid timestamp format for lower bound of date range.")
+            page_start = parse_timestamp_filter(
+                self._filters['timestamp__gte'], 'lower')
+        elif resolution is not None:
+            page_start = request_time - max(
+                self.default_timespan,
+                timedelta(seconds=resolution * self.default_bucket_count))
         else:
             page_start = request_time - self.default_timespan
 
         if 'timestamp__lt' in self._filters:
-            try:
-                page_end = datetime.utcfromtimestamp(
-                    float(self._filters['timestamp__lt']))
-            except ValueError:
-                raise BadRequestException("Invalid timestamp format for upper bound of date range.")
+            page_end = parse_timestamp_filter(
+                self._filters['timestamp__lt'], 'upper')
         else:
             page_end = request_time
 
         self._filters['timestamp__gte'] = page_start
         self._filters['timestamp__lt'] = page_end
 
-        objs = self._queryset.filter(**self._filters).order_by('timestamp')
+        if sensor is not None and \
+                set(self._filters) <= self.chunked_filters:
+            # recent data can usually be read from the sensor's buffer
+            points = read_recent(sensor.id, page_start, page_end)
+            if points is None:
+                points = iter_points(sensor.id, page_start, page_end)
+        else:
+            queryset = self._queryset
+            if sensor is not None:
+                queryset = queryset.using(get_data_read_db(sensor.id))
+            points = queryset.filter(**self._filters).order_by(
+                'timestamp').values_list('timestamp', 'value')
 
         serialized_data = self.add_page_links(serialized_data, href,
                                               page_start, page_end)
-        serialized_data['data'] = [{
-            'value': obj.value,
-            'timestamp': obj.timestamp.isoformat()}
-            for obj in objs]
+        if (resolution is not None or max_points is not None) and \
+                sensor is None:
+            raise BadRequestException(
+                'Aggregated data can only be requested for one sensor')
+        if max_points is not None:
+            serialized_data['maxPoints'] = max_points
+            serialized_data['data'] = [
+                {'value': value, 'timestamp': from_epoch(x).isoformat()}
+                for x, value in self.downsample(points, sensor, page_start,
+                                                page_end, max_points)]
+        elif resolution is not None:
+            serialized_data['resolution'] = resolution
+            serialized_data['aggregate'] = aggregates
+            serialized_data['data'] = [
+                self.serialize_rollup(rollup, aggregates)
+                for rollup in aggregate_data(sensor.id, resolution,
+                                             page_start, page_end,
+                                             aggregates)]
+        elif sensor is not None and sensor.data_type == DATA_TYPE_STATE:
+            serialized_data['data'] = self.serialize_states(
+                sensor, points, page_start)
+        else:
+            serialized_data['data'] = [{
+                'value': value,
+                'timestamp': timestamp.isoformat()}
+                for timestamp, value in points]
         return serialized_data
 
+    def pop_aggregation_params(self):
+        '''Takes the resolution and aggregate query parameters out of the
+        filters, returning the resolution in seconds (or None if the raw data
+        was requested) and the list of aggregates'''
+        resolution = self._filters.pop('resolution', None)
+        aggregates = self._filters.pop('aggregate', None)
+        if resolution is None:
+            if aggregates is not None:
+                raise BadRequestException(
+                    'aggregate can only be given with a resolution')
+            return None, None
+        seconds = parse_resolution(resolution)
+        if seconds is None:
+            raise BadRequestException(
+                'Invalid resolution "%s", must be a number of seconds, '
+                'optionally followed by s, m, h or d, up to %dd' % (
+                    resolution, MAX_RESOLUTION // (24 * 60 * 60)))
+        aggregates = (aggregates or self.default_aggregate).split(',')
+        unknown = [a for a in aggregates if a not in AGGREGATES]
+        if unknown:
+            raise BadRequestException(
+                'Unknown aggregate %s, must be one of: %s' % (
+                    ', '.join(unknown), ', '.join(AGGREGATES)))
+        return seconds, aggregates
+
+    def pop_max_points(self):
+        max_points = self._filters.pop('max_points', None)
+        if max_points is None:
+            return None
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            max_points = 0
+        if not 3 <= max_points <= self.max_points_limit:
+            raise BadRequestException(
+                'max_points must be a number from 3 to %d' %
+                self.max_points_limit)
+        return max_points
+
+    def downsample(self, points, sensor, page_start, page_end, max_points):
+        '''Returns at most max_points (epoch seconds, value) pairs that keep
+        the shape of the data. If the time range has too many points to read
+        them all, the rollups are used instead, at the coarsest resolution
+        that still gives at least max_points buckets'''
+        # the coarsest rollups give a quick (over)estimate of the count
+        count_resolution = max(ROLLUP_RESOLUTIONS)
+        count = ScalarDataRollup.objects.using(
+            get_data_read_db(sensor.id)).filter(
+            sensor_id=sensor.id, resolution=count_resolution,
+            start__gte=bucket_start(page_start, count_resolution),
+            start__lt=page_end).aggregate(Sum('count'))['count__sum']
+        if (count or 0) <= self.downsample_raw_limit:
+            resolution = None
+        else:
+            window = (page_end - page_start).total_seconds()
+            resolution = max([r for r in ROLLUP_RESOLUTIONS
+                              if window / r >= max_points] or
+                             [min(ROLLUP_RESOLUTIONS)])
+        if resolution is None:
+            points = [(to_epoch(timestamp), value)
+                      for timestamp, value in points]
+        else:
+            points = rollup_points(aggregate_data(
+                sensor.id, resolution, page_start, page_end, ['min', 'max']))
+        return lttb(points, max_points)
+
+    def serialize_rollup(self, rollup, aggregates):
+        data = {'timestamp': rollup.start.isoformat()}
+        for aggregate in aggregates:
+            data[aggregate] = getattr(rollup, aggregate)
+        return data
+
+    def serialize_states(self, sensor, points, page_start):
+        '''State sensors only store the points where their state changed, so
+        each value holds until the next point. The list starts with the state
+        at the beginning of the page, if it's known'''
+        data = []
+        last_value = None
+        initial = last_point(sensor.id, page_start)
+        if initial is not None:
+            last_value = initial[1]
+            data.append({'value': last_value,
+                         'timestamp': page_start.isoformat()})
+        for timestamp, value in points:
+            # backfilled points can repeat the state they're in
+            if value != last_value:
+                data.append({'value': value,
+                             'timestamp': timestamp.isoformat()})
+                last_value = value
+        return data
+
     def format_time(self, timestamp):
         return calendar.timegm(timestamp.timetuple())
 
@@ -107,22 +369,373 @@ class SensorDataResource(Resource):
         '''Serialize this resource for a stream'''
         data = self.serialize_single(rels=False)
         data['_links'] = {
-            'self': {'href': self.get_single_href()},
             'ch:sensor': {'href': full_reverse(
                 'sensors-single', self._request,
-                args=(self._filters['sensor_id'],))}
+                args=(self._obj.sensor_id,))}
         }
+        # points inserted in bulk don't get their IDs back from the database,
+        # so they can't link to themselves
+        if self._obj.id is not None:
+            data['_links']['self'] = {'href': self.get_single_href()}
         return data
 
+    def get_single_href(self):
+        return self.add_sensor_hint(
+            super(SensorDataResource, self).get_single_href())
+
+    def get_edit_href(self):
+        return self.add_sensor_hint(
+            super(SensorDataResource, self).get_edit_href())
+
+    def add_sensor_hint(self, href):
+        '''Data point IDs are only unique within a database, so with site
+        databases the links to a point also give its sensor, which says
+        which database to look it up in'''
+        if not get_data_dbs():
+            return href
+        return self.update_href(href, sensor_id=self._obj.sensor_id)
+
+    @classmethod
+    def get_object(cls, request, id):
+        sensor_id = request.GET.get('sensor_id')
+        if not get_data_dbs() or sensor_id is None:
+            return super(SensorDataResource, cls).get_object(request, id)
+        try:
+            if request.method in ('GET', 'HEAD'):
+                using = get_data_read_db(sensor_id)
+            else:
+                using = get_data_db(sensor_id)
+        except (Sensor.DoesNotExist, ValueError):
+            raise ScalarData.DoesNotExist(
+                'There is no sensor with ID %s' % sensor_id)
+        return cls.queryset.using(using).get(id=id, sensor_id=sensor_id)
+
     def get_tags(self):
         if not self._obj:
             raise ValueError(
                 'Tried to called get_tags on a resource without an object')
-        db_sensor = Sensor.objects.select_related('device').get(
-            id=self._obj.sensor_id)
-        return ['sensor-%d' % db_sensor.id,
-                'device-%d' % db_sensor.device_id,
-                'site-%d' % db_sensor.device.site_id]
+        return get_sensor_tags(self._obj.sensor_id)
+
+    @classmethod
+    def create_single(cls, data, request):
+        '''Stores a single point the same way as a batch, and renders it as a
+        full resource if it was stored. A point that's buffered with
+        write-behind ingest doesn't exist in the database yet, and one that's
+        suppressed by an IngestPolicy, doesn't change a state sensor's state
+        or repeats an X-Batch-Id has no new point to serialize, so those get
+        the same summary response as a batch'''
+        obj_params = cls.get_obj_params(request)
+        try:
+            obj = cls.validator.build_item(0, data, obj_params)
+            batch_id = get_batch_id(request)
+        except ValidationError as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST,
+                                ' '.join(e.messages), request)
+        except BadRequestException as e:
+            return render_error(e.status, e.message, request)
+        if not batch_id and get_write_behind_buffer() is not None:
+            return cls.create_batch([obj], request)
+        try:
+            with deferred_policies():
+                kept = apply_ingest_policies([obj])
+                with deferred_recent(), transaction.atomic():
+                    if batch_id:
+                        claim_batch(cls.get_batch_scope(obj_params),
+                                    batch_id, len(kept))
+                    stored = cls.insert_batch(kept)
+        except DuplicateBatchError as e:
+            return cls.render_summary(e.batch.count, HTTP_STATUS_SUCCESS,
+                                      request)
+        except IntegrityError:
+            return render_error(
+                HTTP_STATUS_BAD_REQUEST, 'Error storing data. Make sure the '
+                'data is being posted to an existing sensor', request)
+        if not kept:
+            return cls.render_summary(0, HTTP_STATUS_CREATED, request,
+                                      suppressed=1)
+        if not stored:
+            # the sensor's state is already recorded, so like in a batch it
+            # counts as stored
+            return cls.render_summary(1, HTTP_STATUS_CREATED, request)
+        cls.publish_batch(stored, request)
+        response_data = cls(obj=obj, request=request,
+                            filters=obj_params).serialize()
+        return cls.render_response(response_data, request,
+                                   status=HTTP_STATUS_CREATED)
+
+    @classmethod
+    def create_list(cls, data, request):
+        '''Lists of data are validated in full before anything is stored, then
+        inserted with a single multi-row INSERT. Rather than echoing back every
+        point the response is a short summary of the batch. In best-effort
+        mode invalid points are left out and listed in the summary, rather
+        than the whole list being rejected'''
+        try:
+            best_effort = get_batch_mode(request) == BATCH_MODE_BEST_EFFORT
+        except BadRequestException as e:
+            return render_error(e.status, e.message, request)
+        obj_params = cls.get_obj_params(request)
+        if not best_effort:
+            try:
+                objs = cls.validator.build(data, obj_params)
+            except ValidationError as e:
+                return render_error(HTTP_STATUS_BAD_REQUEST,
+                                    ' '.join(e.messages), request)
+            return cls.create_batch(objs, request)
+        objs = []
+        errors = []
+        for i, item in enumerate(data):
+            try:
+                objs.append(cls.validator.build_item(i, item, obj_params))
+            except ValidationError as e:
+                errors.append({'item': i, 'message': ' '.join(e.messages)})
+        return cls.create_batch(objs, request, errors)
+
+    @classmethod
+    @csrf_exempt
+    def list_view(cls, request):
+        '''Data can also be read in the packed binary format, as a little-endian
+        int64 timestamp in milliseconds followed by a float64 value for each
+        point. Finished days are read from their columnar files if they've
+        been written'''
+        accepted = [accept.split(';')[0].strip() for accept in
+                    request.META.get('HTTP_ACCEPT', '').split(',')]
+        if PACKED_DATA_MIME_TYPE not in accepted:
+            return super(SensorDataResource, cls).list_view(request)
+        filters = request.GET.dict()
+        try:
+            if not set(filters) <= cls.chunked_filters:
+                raise BadRequestException(
+                    'Packed data can only be filtered by sensor_id, '
+                    'timestamp__gte and timestamp__lt')
+            try:
+                sensor = get_cached(Sensor, id=filters.get('sensor_id'))
+            except (Sensor.DoesNotExist, ValueError, TypeError):
+                raise BadRequestException(
+                    'Packed data must be requested for one sensor')
+            page_end = timezone.now()
+            if 'timestamp__lt' in filters:
+                page_end = parse_timestamp_filter(
+                    filters['timestamp__lt'], 'upper')
+            page_start = page_end - cls.default_timespan
+            if 'timestamp__gte' in filters:
+                page_start = parse_timestamp_filter(
+                    filters['timestamp__gte'], 'lower')
+        except BadRequestException as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST, e.message, request)
+        return HttpResponse(pack_data(sensor.id, page_start, page_end),
+                            content_type=PACKED_DATA_MIME_TYPE)
+
+    @classmethod
+    @csrf_exempt
+    def create_view(cls, request):
+        '''Besides JSON, data can be POSTed in compact binary formats that
+        skip JSON parsing and per-field conversion entirely. Large JSON bodies
+        are parsed and stored incrementally as they're read'''
+        content_type = request.META.get('CONTENT_TYPE', '')
+        content_type = content_type.split(';')[0].strip()
+        if request.method != 'POST':
+            return super(SensorDataResource, cls).create_view(request)
+        try:
+            sensor = get_cached(Sensor, id=request.GET.get('sensor_id'))
+        except (Sensor.DoesNotExist, ValueError, TypeError):
+            return render_error(
+                HTTP_STATUS_BAD_REQUEST,
+                'Data must be posted to an existing sensor', request)
+        error = rate_limit_error(
+            request, get_cached(Device, id=sensor.device_id).site_id)
+        if error is not None:
+            return error
+        if content_type not in BINARY_DECODERS:
+            try:
+                content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                content_length = 0
+            if content_length > cls.streaming_threshold:
+                return cls.create_streamed(request)
+            return super(SensorDataResource, cls).create_view(request)
+        decoder = BINARY_DECODERS[content_type]
+        if decoder is None:
+            return render_error(
+                HTTP_STATUS_UNSUPPORTED_MEDIA_TYPE,
+                '%s is not supported by this server' % content_type, request)
+        try:
+            objs = decoder(request.body, cls.get_obj_params(request))
+        except ValidationError as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST,
+                                ' '.join(e.messages), request)
+        return cls.create_batch(objs, request)
+
+    @classmethod
+    def create_streamed(cls, request):
+        '''Parses a list of data from the request body as it's read, storing it
+        streaming_chunk_size points at a time so only one chunk is ever held in
+        memory. Everything is stored in one transaction, so unless the list is
+        posted in best-effort mode an invalid item part way through means
+        nothing is stored. Streamed data is usually a backfill of old
+        readings, so it isn't pushed to the realtime streams'''
+        obj_params = cls.get_obj_params(request)
+        count = 0
+        suppressed = 0
+        errors = []
+        status = HTTP_STATUS_CREATED
+        try:
+            best_effort = get_batch_mode(request) == BATCH_MODE_BEST_EFFORT
+            batch_id = get_batch_id(request)
+            with deferred_policies(), deferred_recent(), \
+                    transaction.atomic():
+                if batch_id:
+                    batch = claim_batch(cls.get_batch_scope(obj_params),
+                                        batch_id, 0)
+                objs = []
+                for i, item in enumerate(iter_json_list(request)):
+                    try:
+                        objs.append(
+                            cls.validator.build_item(i, item, obj_params))
+                    except ValidationError as e:
+                        if not best_effort:
+                            raise
+                        errors.append({'item': i,
+                                       'message': ' '.join(e.messages)})
+                    if len(objs) >= cls.streaming_chunk_size:
+                        kept = apply_ingest_policies(objs)
+                        cls.insert_batch(kept)
+                        count += len(kept)
+                        suppressed += len(objs) - len(kept)
+                        objs = []
+                kept = apply_ingest_policies(objs)
+                cls.insert_batch(kept)
+                count += len(kept)
+                suppressed += len(objs) - len(kept)
+                if batch_id:
+                    IngestBatch.objects.filter(id=batch.id).update(
+                        count=count)
+        except BadRequestException as e:
+            return render_error(e.status, e.message, request)
+        except ValidationError as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST,
+                                ' '.join(e.messages), request)
+        except DuplicateBatchError as e:
+            count = e.batch.count
+            suppressed = 0
+            status = HTTP_STATUS_SUCCESS
+        except IntegrityError:
+            return render_error(
+                HTTP_STATUS_BAD_REQUEST, 'Error storing data. Make sure the '
+                'data is being posted to an existing sensor', request)
+        return cls.render_summary(count, status, request, errors, suppressed)
+
+    @classmethod
+    def create_batch(cls, objs, request, errors=None):
+        '''Stores a batch of validated but unsaved ScalarData objects and
+        renders the summary response, listing any errors for points that were
+        left out. Points that their sensor's IngestPolicy suppresses are
+        dropped before anything is stored or buffered'''
+        obj_params = cls.get_obj_params(request)
+        try:
+            batch_id = get_batch_id(request)
+        except BadRequestException as e:
+            return render_error(e.status, e.message, request)
+
+        # batches with an ID are always written straight away, so that the ID
+        # is only recorded once the data has actually been stored
+        # (create_view has already checked that the sensor exists)
+        write_buffer = None if batch_id else get_write_behind_buffer()
+        try:
+            # the policies only remember the kept points once they've been
+            # stored or buffered, so a failed batch isn't suppressed when
+            # it's retried
+            with deferred_policies():
+                kept = apply_ingest_policies(objs)
+                suppressed = len(objs) - len(kept)
+                objs = kept
+                count = len(objs)
+                if write_buffer is None:
+                    with deferred_recent(), transaction.atomic():
+                        if batch_id:
+                            claim_batch(cls.get_batch_scope(obj_params),
+                                        batch_id, count)
+                        stored = cls.insert_batch(objs)
+                    status = HTTP_STATUS_CREATED
+                else:
+                    # buffered data is published once it's been stored
+                    write_buffer.put(objs, on_stored=lambda stored:
+                                     cls.publish_batch(stored, request))
+                    stored = []
+                    status = HTTP_STATUS_ACCEPTED
+        except DuplicateBatchError as e:
+            # already stored, so acknowledge it just like the first time
+            stored = []
+            count = e.batch.count
+            suppressed = 0
+            status = HTTP_STATUS_SUCCESS
+        except IntegrityError:
+            return render_error(
+                HTTP_STATUS_BAD_REQUEST, 'Error storing data. Make sure the '
+                'data is being posted to an existing sensor', request)
+        except BufferFullError as e:
+            response = render_error(HTTP_STATUS_SERVICE_UNAVAILABLE,
+                                    str(e), request)
+            response['Retry-After'] = str(
+                int(math.ceil(write_buffer.flush_interval)))
+            return response
+        cls.publish_batch(stored, request)
+        return cls.render_summary(count, status, request, errors, suppressed)
+
+    @classmethod
+    def render_summary(cls, count, status, request, errors=None,
+                       suppressed=0):
+        '''Renders the summary response for a stored batch of data. A 200
+        status means the batch had already been stored. count doesn't include
+        suppressed points, which are counted separately'''
+        obj_params = cls.get_obj_params(request)
+        response_data = {
+            '_links': {
+                'curies': CHAIN_CURIES,
+                'ch:dataHistory': {
+                    'href': cls(queryset=cls.queryset, request=request,
+                                filters=obj_params).get_list_href(),
+                    'title': 'Data'
+                }
+            },
+            'count': count
+        }
+        if status == HTTP_STATUS_SUCCESS:
+            response_data['duplicate'] = True
+        if suppressed:
+            response_data['suppressed'] = suppressed
+        if errors:
+            response_data['errors'] = errors
+            if status == HTTP_STATUS_CREATED:
+                status = HTTP_STATUS_MULTI_STATUS
+        return cls.render_response(response_data, request, status=status)
+
+    @classmethod
+    def get_batch_scope(cls, obj_params):
+        '''Returns the scope that batch IDs of data posted with the given
+        parameters are unique within, which is the sensor it's posted to'''
+        return 'sensor-%s' % obj_params.get('sensor_id', '')
+
+    @classmethod
+    def insert_batch(cls, objs):
+        '''Stores the given unsaved ScalarData objects in one statement,
+        returning the ones that were stored'''
+        return store_data(objs)
+
+    @classmethod
+    def publish_batch(cls, objs, request):
+        '''Pushes the given data to the realtime streams'''
+        tags = {}
+        for obj in objs:
+            filters = {'sensor_id': obj.sensor_id}
+            # the tags only need to be looked up once per sensor
+            if obj.sensor_id not in tags:
+                tags[obj.sensor_id] = cls(obj=obj, request=request,
+                                          filters=filters).get_tags()
+            stream_data = json.dumps(cls(obj=obj, request=request,
+                                         filters=filters).serialize_stream())
+            for tag in tags[obj.sensor_id]:
+                zmq_socket.send_string(tag + ' ' + stream_data)
 
 
 class SensorResource(Resource):
@@ -147,14 +760,37 @@ class SensorResource(Resource):
         data = super(SensorResource, self).serialize_single(embed, cache,
                                                             *args, **kwargs)
         if embed:
-            data['dataType'] = 'float'
-            last_data = self._obj.scalar_data.order_by(
-                'timestamp').reverse()[:1]
-            if last_data:
-                data['value'] = last_data[0].value
-                data['updated'] = last_data[0].timestamp.isoformat()
+            data['dataType'] = self._obj.data_type
+            try:
+                latest = self._obj.latest_value
+            except LatestValue.DoesNotExist:
+                pass
+            else:
+                data['value'] = latest.value
+                data['updated'] = latest.timestamp.isoformat()
         return data
 
+    def deserialize(self):
+        new_obj = self._obj is None
+        obj = super(SensorResource, self).deserialize()
+        if new_obj and 'dataType' in self._data:
+            obj.data_type = self.clean_data_type(self._data['dataType'])
+        return obj
+
+    def update(self, data):
+        if 'dataType' in data:
+            data = dict(data)
+            self._obj.data_type = self.clean_data_type(data.pop('dataType'))
+        super(SensorResource, self).update(data)
+
+    @classmethod
+    def clean_data_type(cls, data_type):
+        if data_type not in dict(SENSOR_DATA_TYPES):
+            raise ValidationError(
+                'dataType must be one of: %s' % ', '.join(
+                    name for name, _ in SENSOR_DATA_TYPES))
+        return data_type
+
     def get_tags(self):
         return ['sensor-%s' % self._obj.id,
                 'device-%s' % self._obj.device_id,
@@ -176,11 +812,108 @@ class DeviceResource(Resource):
     }
     queryset = Device.objects
 
+    def serialize_single(self, embed, cache, *args, **kwargs):
+        data = super(DeviceResource, self).serialize_single(embed, cache,
+                                                            *args, **kwargs)
+        if embed and '_links' in data:
+            data['_links']['ch:ingest'] = {
+                'title': 'Post Data',
+                'href': full_reverse('devices-ingest', self._request,
+                                     args=(self._obj.id,))
+            }
+        return data
+
     def get_tags(self):
         # sometimes the site_id field is unicode? weird
         return ['device-%d' % self._obj.id,
                 'site-%s' % self._obj.site_id]
 
+    @classmethod
+    @csrf_exempt
+    def ingest_view(cls, request, id):
+        '''Accepts a whole report from a device at once, e.g.
+
+            {"timestamp": "2014-04-12T15:00:04+00:00",
+             "metrics": {"temperature": 22.3, "humidity": 41.2}}
+
+        and stores a point for each metric's sensor in a single transaction.
+        Nested objects in metrics are flattened, so {"charge_flags": {"fault":
+        false}} is stored on the "charge_flags_fault" sensor. A list of
+        reports can also be given'''
+        try:
+            device = get_report_target(request, Device, id)
+        except BadRequestException as e:
+            return render_error(e.status, e.message, request)
+        error = rate_limit_error(request, device.site_id)
+        if error is not None:
+            return error
+        try:
+            reports = parse_reports(request)
+            batch_id = get_batch_id(request)
+        except BadRequestException as e:
+            return render_error(e.status, e.message, request)
+        sensors = get_device_sensors(device.id)
+        objs = []
+        for report in reports:
+            metrics = flatten_metrics(report['metrics'])
+            unknown = [name for name in metrics if name not in sensors]
+            if unknown:
+                return render_error(
+                    HTTP_STATUS_BAD_REQUEST, 'No sensors on this device for '
+                    'metrics: %s' % ', '.join(sorted(unknown)), request)
+            try:
+                objs.extend(build_scalar_data(metrics, sensors,
+                                              report.get('timestamp')))
+            except ValidationError as e:
+                return render_error(HTTP_STATUS_BAD_REQUEST,
+                                    ' '.join(e.messages), request)
+        status = HTTP_STATUS_CREATED
+        try:
+            with deferred_policies(), deferred_recent(), \
+                    transaction.atomic():
+                kept = apply_ingest_policies(objs)
+                suppressed = len(objs) - len(kept)
+                objs = kept
+                count = len(objs)
+                if batch_id:
+                    claim_batch('device-%d' % device.id, batch_id, count)
+                SensorDataResource.insert_batch(objs)
+        except DuplicateBatchError as e:
+            objs = []
+            count = e.batch.count
+            suppressed = 0
+            status = HTTP_STATUS_SUCCESS
+        except IntegrityError:
+            # one of the cached sensors has probably been deleted
+            clear_metadata_cache()
+            return render_error(
+                HTTP_STATUS_BAD_REQUEST, 'Error storing data. Make sure the '
+                'device\'s sensors still exist', request)
+        SensorDataResource.publish_batch(objs, request)
+        response_data = {
+            '_links': {
+                'curies': CHAIN_CURIES,
+                'ch:device': {
+                    'href': full_reverse('devices-single', request,
+                                         args=(device.id,)),
+                    'title': device.name
+                }
+            },
+            'count': count
+        }
+        if status == HTTP_STATUS_SUCCESS:
+            response_data['duplicate'] = True
+        if suppressed:
+            response_data['suppressed'] = suppressed
+        return cls.render_response(response_data, request, status=status)
+
+    @classmethod
+    def urls(cls):
+        base_patterns = super(DeviceResource, cls).urls()
+        base_patterns.append(
+            url(r'^(\d+)/ingest$', cls.ingest_view, name='devices-ingest'))
+        return base_patterns
+
 
 class SiteResource(Resource):
 
@@ -211,6 +944,11 @@ class SiteResource(Resource):
                 'href': full_reverse('site-summary', self._request,
                                      args=(self._obj.id,))
             }
+            data['_links']['ch:ingest'] = {
+                'title': 'Post Data',
+                'href': full_reverse('sites-ingest', self._request,
+                                     args=(self._obj.id,))
+            }
         return data
 
     def get_filled_schema(self):
@@ -244,16 +982,124 @@ class SiteResource(Resource):
         }
         return schema
 
+    @classmethod
+    @csrf_exempt
+    def ingest_view(cls, request, id):
+        '''Accepts device reports addressed by natural keys rather than
+        URLs, e.g.
+
+            {"device": {"name": "0x8110", "building": "E14"},
+             "timestamp": "2014-04-12T15:00:04+00:00",
+             "metrics": {"sht_humidity": 15.9, "illuminance": 413},
+             "units": {"sht_humidity": "percent", "illuminance": "lux"}}
+
+        The device is looked up by its name, building, floor and room, and
+        its sensors by metric. Any that don't exist yet are created, which is
+        why new metrics need a unit. A list of reports can also be given, and
+        everything is stored in a single transaction'''
+        try:
+            site = get_report_target(request, Site, id)
+        except BadRequestException as e:
+            return render_error(e.status, e.message, request)
+        error = rate_limit_error(request, site.id)
+        if error is not None:
+            return error
+        try:
+            reports = parse_reports(request, require_device=True)
+            batch_id = get_batch_id(request)
+        except BadRequestException as e:
+            return render_error(e.status, e.message, request)
+        objs = []
+        suppressed = 0
+        new_devices = []
+        new_sensors = []
+        status = HTTP_STATUS_CREATED
+        try:
+            with clear_on_error(), deferred_policies(), deferred_recent(), \
+                    transaction.atomic():
+                if batch_id:
+                    # the count is filled in once we know it. Claiming the
+                    # batch first means a repeat doesn't create anything
+                    batch = claim_batch('site-%d' % site.id, batch_id, 0)
+                for report in reports:
+                    device, created = resolve_device(site.id,
+                                                     report['device'])
+                    if created:
+                        new_devices.append(device)
+                    metrics = flatten_metrics(report['metrics'])
+                    sensors, created = resolve_sensors(
+                        device, metrics.keys(), report.get('units', {}))
+                    new_sensors.extend(created)
+                    objs.extend(build_scalar_data(metrics, sensors,
+                                                  report.get('timestamp')))
+                kept = apply_ingest_policies(objs)
+                suppressed = len(objs) - len(kept)
+                objs = kept
+                SensorDataResource.insert_batch(objs)
+                if batch_id:
+                    IngestBatch.objects.filter(id=batch.id).update(
+                        count=len(objs))
+        except ValidationError as e:
+            return render_error(HTTP_STATUS_BAD_REQUEST,
+                                ' '.join(e.messages), request)
+        except (IntegrityError, ObjectDoesNotExist):
+            # e.g. a device or sensor was deleted while we were using it
+            return render_error(
+                HTTP_STATUS_BAD_REQUEST, 'Error storing data. Make sure the '
+                'devices in the reports are valid', request)
+        except DuplicateBatchError as e:
+            return cls.render_response({
+                '_links': {
+                    'curies': CHAIN_CURIES,
+                    'ch:site': {
+                        'href': full_reverse('sites-single', request,
+                                             args=(site.id,)),
+                        'title': site.name
+                    }
+                },
+                'count': e.batch.count,
+                'duplicate': True
+            }, request, status=HTTP_STATUS_SUCCESS)
+
+        for resource in ([DeviceResource(obj=d, request=request)
+                          for d in new_devices] +
+                         [SensorResource(obj=s, request=request)
+                          for s in new_sensors]):
+            stream_data = json.dumps(resource.serialize_stream())
+            for tag in resource.get_tags():
+                zmq_socket.send_string(tag + ' ' + stream_data)
+        SensorDataResource.publish_batch(objs, request)
+
+        response_data = {
+            '_links': {
+                'curies': CHAIN_CURIES,
+                'ch:site': {
+                    'href': full_reverse('sites-single', request,
+                                         args=(site.id,)),
+                    'title': site.name
+                }
+            },
+            'count': len(objs),
+            'devicesCreated': len(new_devices),
+            'sensorsCreated': len(new_sensors)
+        }
+        if suppressed:
+            response_data['suppressed'] = suppressed
+        return cls.render_response(response_data, request,
+                                   status=HTTP_STATUS_CREATED)
+
     @classmethod
     def site_summary_view(cls, request, id):
         time_begin = timezone.now() - timedelta(hours=2)
         #filters = request.GET.dict()
-        devices = Device.objects.filter(site_id=id).select_related(
+        devices = Device.objects.filter(site_id=id).prefetch_related(
             'sensors',
             'sensors__metric',
-            'sensors__unit')
-        db_sensor_data = ScalarData.objects.filter(sensor__device__site_id=id,
-                                                   timestamp__gt=time_begin)
+            'sensors__unit',
+            'sensors__latest_value')
+        db_sensor_data = ScalarData.objects.using(
+            get_read_db(get_site_db(id))).filter(
+            sensor__device__site_id=id, timestamp__gt=time_begin)
         response = {
             '_links': {
                 'self': {'href': full_reverse('site-summary', request,
@@ -289,6 +1135,8 @@ class SiteResource(Resource):
         base_patterns.append(
             url(r'^(\d+)/summary$', cls.site_summary_view,
                 name='site-summary'))
+        base_patterns.append(
+            url(r'^(\d+)/ingest$', cls.ingest_view, name='sites-ingest'))
         return base_patterns
 
 
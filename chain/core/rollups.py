@@ -0,0 +1,246 @@
+'''Rollups summarize each sensor's data over fixed buckets of time at each of
+the resolutions in ROLLUP_RESOLUTIONS, giving the count, min, max, sum, first
+and last value in each bucket. They're updated in the same transaction as
+the data they summarize, so long-range queries can read them instead of
+every raw point.
+
+Rollups only ever have data added to them, so if raw data is edited, deleted
+or written without going through the models (e.g. restored from a dump),
+the affected buckets need rebuilding with the rebuild_rollups management
+command. Compressing or archiving data doesn't count, as rebuilding reads
+the data from wherever it's stored.'''
+
+import calendar
+import operator
+import re
+from datetime import datetime
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections
+from django.db import transaction
+from django.db.models import Count, Min, Max, Sum, Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.timezone import utc
+from chain.core.models import ScalarData, ScalarDataRollup, Sensor
+from chain.core.history import iter_points, has_cold_data
+from chain.core.routers import get_data_db, get_data_read_db
+from chain.settings import ROLLUP_RESOLUTIONS
+
+# how many finished rollups to hold before inserting them while rebuilding
+REBUILD_CHUNK_SIZE = 1000
+
+AGGREGATES = ['mean', 'min', 'max', 'sum', 'count', 'first', 'last']
+RESOLUTION_RE = re.compile(r'^(\d+)([smhd]?)$')
+RESOLUTION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+# a page of buckets has to cover a time range that dates can represent
+MAX_RESOLUTION = 366 * 24 * 60 * 60
+
+# SQL and its parameters giving the number of the bucket a point falls in,
+# for each database that can group points into buckets itself
+BUCKET_SQL = {
+    'postgresql': ('floor(extract(epoch from "timestamp") / %d)', []),
+    'sqlite': ('CAST(strftime(%%s, "timestamp") AS INTEGER) / %d', ['%s']),
+}
+
+
+def bucket_start(timestamp, resolution):
+    '''Returns the start of the bucket of the given resolution that an aware
+    datetime falls in'''
+    seconds = calendar.timegm(timestamp.utctimetuple())
+    return datetime.utcfromtimestamp(seconds - seconds % resolution).replace(
+        tzinfo=utc)
+
+
+def summarize(points, resolutions=None):
+    '''Builds unsaved rollups for the given (sensor_id, timestamp, value)
+    tuples. Returns a dictionary keyed by (sensor_id, resolution, start)'''
+    rollups = {}
+    for sensor_id, timestamp, value in points:
+        for resolution in resolutions or ROLLUP_RESOLUTIONS:
+            start = bucket_start(timestamp, resolution)
+            key = (sensor_id, resolution, start)
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = rollups[key] = ScalarDataRollup(
+                    sensor_id=sensor_id, resolution=resolution, start=start)
+            rollup.add(timestamp, value)
+    return rollups
+
+
+def update_rollups(objs, using=DEFAULT_DB_ALIAS):
+    '''Adds the given newly stored ScalarData objects to their rollups. This
+    should be called in the same transaction that stored them, in the
+    database they were stored in'''
+    if not objs:
+        return
+    rollups = summarize((int(obj.sensor_id), obj.timestamp, obj.value)
+                        for obj in objs)
+    # only the buckets being added to are looked up, one set of starts for
+    # each sensor and resolution, so a backfill doesn't lock everything in
+    # between
+    starts = {}
+    for sensor_id, resolution, start in rollups:
+        starts.setdefault((sensor_id, resolution), []).append(start)
+    buckets = reduce(operator.or_, [
+        Q(sensor_id=sensor_id, resolution=resolution, start__in=key_starts)
+        for (sensor_id, resolution), key_starts in sorted(starts.items())])
+    with transaction.atomic(using=using):
+        # lock the existing rollups, as other processes may be adding to
+        # them too. They're locked in a consistent order so that concurrent
+        # batches for the same buckets can't deadlock
+        existing = ScalarDataRollup.objects.using(using).select_for_update(
+            ).filter(buckets).order_by('sensor', 'resolution', 'start')
+        for stored in existing:
+            key = (stored.sensor_id, stored.resolution, stored.start)
+            if key in rollups:
+                stored.merge(rollups.pop(key))
+                stored.save(using=using)
+        if not rollups:
+            return
+        try:
+            with transaction.atomic(using=using):
+                ScalarDataRollup.objects.using(using).bulk_create(
+                    rollups.values())
+        except IntegrityError:
+            # someone else created some of them after we looked, so go
+            # through them one at a time
+            for _, rollup in sorted(rollups.items()):
+                add_rollup(rollup, using)
+
+
+def add_rollup(rollup, using=DEFAULT_DB_ALIAS):
+    '''Merges an unsaved rollup into the stored one for the same bucket, or
+    stores it if there isn't one yet'''
+    try:
+        stored = ScalarDataRollup.objects.using(using).select_for_update(
+            ).get(sensor_id=rollup.sensor_id, resolution=rollup.resolution,
+                  start=rollup.start)
+    except ScalarDataRollup.DoesNotExist:
+        rollup.save(using=using)
+    else:
+        stored.merge(rollup)
+        stored.save(using=using)
+
+
+@receiver(post_save, sender=ScalarData)
+def data_saved(sender, instance, created, raw, using, **kwargs):
+    # bulk inserts don't send post_save, so they're added by store_data
+    if created and not raw:
+        update_rollups([instance], using)
+
+
+def rebuild_rollups(since=None, sensor_ids=None):
+    '''Recomputes the rollups from the raw data, for data from since onwards
+    (or all of it if since is None), for the given sensors (or all of them).
+    since is rounded down to the start of a bucket of every resolution. Each
+    sensor is rebuilt in its own transaction. Returns the number of rollups
+    stored'''
+    if since is not None:
+        since = bucket_start(since, max(ROLLUP_RESOLUTIONS))
+    if sensor_ids is None:
+        sensor_ids = Sensor.objects.values_list('id', flat=True)
+    count = 0
+    for sensor_id in sensor_ids:
+        with transaction.atomic(using=get_data_db(sensor_id)):
+            count += rebuild_sensor_rollups(sensor_id, since)
+    return count
+
+
+def rebuild_sensor_rollups(sensor_id, since):
+    using = get_data_db(sensor_id)
+    rollups = ScalarDataRollup.objects.using(using).filter(sensor_id=sensor_id)
+    if since is not None:
+        rollups = rollups.filter(start__gte=since)
+    rollups.delete()
+    count = 0
+    # the data is in time order, so each bucket is finished once a point
+    # falls in the next one, and only the current bucket of each resolution
+    # needs keeping in memory
+    current = {}
+    finished = []
+    for timestamp, value in iter_points(sensor_id, since):
+        for resolution in ROLLUP_RESOLUTIONS:
+            start = bucket_start(timestamp, resolution)
+            rollup = current.get(resolution)
+            if rollup is None or rollup.start != start:
+                if rollup is not None:
+                    finished.append(rollup)
+                rollup = current[resolution] = ScalarDataRollup(
+                    sensor_id=sensor_id, resolution=resolution, start=start)
+            rollup.add(timestamp, value)
+        if len(finished) >= REBUILD_CHUNK_SIZE:
+            ScalarDataRollup.objects.using(using).bulk_create(finished)
+            count += len(finished)
+            finished = []
+    finished.extend(current.values())
+    ScalarDataRollup.objects.using(using).bulk_create(finished)
+    return count + len(finished)
+
+
+def parse_resolution(resolution):
+    '''Parses a resolution like "90", "15m" or "1d" into a number of seconds,
+    returning None if it isn't valid or is longer than MAX_RESOLUTION'''
+    match = RESOLUTION_RE.match(resolution.strip())
+    if match is None:
+        return None
+    seconds = int(match.group(1)) * RESOLUTION_UNITS[match.group(2)]
+    if not 0 < seconds <= MAX_RESOLUTION:
+        return None
+    return seconds
+
+
+def aggregate_data(sensor_id, resolution, start, end, aggregates=AGGREGATES):
+    '''Returns a list of unsaved rollups summarizing the sensor's data in
+    buckets of the given resolution, for every bucket that overlaps the time
+    range from start up to end, in time order. Only the given aggregates are
+    guaranteed to be filled in.
+
+    If the resolution is a multiple of one of the ROLLUP_RESOLUTIONS this
+    reads (and if necessary merges) the stored rollups. Otherwise the data is
+    aggregated by the database, or read and aggregated here if first or last
+    values are needed, as they can't be computed with a GROUP BY, or if some
+    of the data has been compressed or archived'''
+    start = bucket_start(start, resolution)
+    using = get_data_read_db(sensor_id)
+    rollup_resolutions = [r for r in ROLLUP_RESOLUTIONS if resolution % r == 0]
+    if rollup_resolutions:
+        stored = ScalarDataRollup.objects.using(using).filter(
+            sensor_id=sensor_id, resolution=max(rollup_resolutions),
+            start__gte=start, start__lt=end).order_by('start')
+        return merge_rollups(stored, resolution)
+    data = ScalarData.objects.using(using).filter(
+        sensor_id=sensor_id, timestamp__gte=start, timestamp__lt=end)
+    vendor = connections[using].vendor
+    if vendor not in BUCKET_SQL or \
+            'first' in aggregates or 'last' in aggregates or \
+            has_cold_data(sensor_id, start, end):
+        points = ((sensor_id, timestamp, value) for timestamp, value in
+                  iter_points(sensor_id, start, end))
+        return sorted(summarize(points, [resolution]).values(),
+                      key=lambda rollup: rollup.start)
+    bucket_sql, bucket_params = BUCKET_SQL[vendor]
+    buckets = data.extra(select={'bucket': bucket_sql % resolution},
+                         select_params=bucket_params).values(
+        'bucket').annotate(count=Count('id'), min=Min('value'),
+                           max=Max('value'), sum=Sum('value')).order_by(
+                               'bucket')
+    return [ScalarDataRollup(
+        sensor_id=sensor_id, resolution=resolution,
+        start=datetime.utcfromtimestamp(
+            int(bucket['bucket']) * resolution).replace(tzinfo=utc),
+        count=bucket['count'], min=bucket['min'], max=bucket['max'],
+        sum=bucket['sum']) for bucket in buckets]
+
+
+def merge_rollups(rollups, resolution):
+    '''Merges time-ordered rollups into buckets of a coarser resolution,
+    which must be a multiple of theirs'''
+    merged = []
+    for rollup in rollups:
+        start = bucket_start(rollup.start, resolution)
+        if merged and merged[-1].start == start:
+            merged[-1].merge(rollup)
+        else:
+            rollup.resolution = resolution
+            rollup.start = start
+            merged.append(rollup)
+    return merged
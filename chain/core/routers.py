@@ -0,0 +1,151 @@
+'''Stores each site's sensor data in its own database. SITE_DATABASES maps site
+IDs to database aliases (from DATABASES), and the data of sites that aren't
+listed stays in the default database. The data is the ScalarData table and
+everything derived from it: rollups, compressed chunks, archive file records
+and latest values. Everything else, such as sites, devices and sensors, is
+kept in the default database.
+
+The data tables have foreign keys to sensors, so every data database also
+holds a copy of the metadata, which is kept up to date as it's saved or
+deleted in the default database. Create a data database's tables with
+
+    ./manage.py syncdb --database=<alias>
+    ./manage.py migrate --database=<alias>
+
+and then copy the existing metadata to it with mirror_metadata.
+
+Queries that filter by sensor should use the database from get_data_db (or
+get_data_read_db, which may give a read replica), and SiteRouter sends
+queries through a sensor's related managers (and saves of individual data
+points) to the right database. A transaction on the default database
+doesn't cover the data databases, so data and the batch ID it was stored
+under (see chain.core.ingest.claim_batch) are committed separately.'''
+
+import copy
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.base import ModelState
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from chain.core.models import GeoLocation, Site, Device, Sensor, Metric, Unit
+from chain.core.models import ScalarData, ScalarDataRollup, ScalarDataChunk
+from chain.core.models import ArchiveFile, LatestValue
+from chain.core.cache import get_cached
+from chain.core.replicas import get_read_db
+from chain.settings import SITE_DATABASES
+
+DATA_MODELS = (ScalarData, ScalarDataRollup, ScalarDataChunk, ArchiveFile,
+               LatestValue)
+# in the order they need copying, so that foreign keys are satisfied
+METADATA_MODELS = (GeoLocation, Unit, Metric, Site, Device, Sensor)
+
+
+def get_site_db(site_id):
+    '''Returns the alias of the database holding the given site's data'''
+    return SITE_DATABASES.get(int(site_id), DEFAULT_DB_ALIAS)
+
+
+def get_data_db(sensor_id):
+    '''Returns the alias of the database holding the given sensor's data'''
+    if not SITE_DATABASES:
+        return DEFAULT_DB_ALIAS
+    sensor = get_cached(Sensor, id=sensor_id)
+    return get_site_db(get_cached(Device, id=sensor.device_id).site_id)
+
+
+def get_data_read_db(sensor_id):
+    '''Returns the alias of the database to read the given sensor's data
+    from, which may be a replica (see chain.core.replicas)'''
+    return get_read_db(get_data_db(sensor_id))
+
+
+def get_data_dbs():
+    '''Returns the aliases of every database holding data other than the
+    default one'''
+    return sorted(set(SITE_DATABASES.values()) - set([DEFAULT_DB_ALIAS]))
+
+
+def group_by_db(objs):
+    '''Returns a dictionary mapping database aliases to lists of the given
+    objects of data models that belong in them'''
+    groups = {}
+    for obj in objs:
+        groups.setdefault(get_data_db(obj.sensor_id), []).append(obj)
+    return groups
+
+
+class SiteRouter(object):
+    '''Routes data models to their site's database, where the query is
+    related to a particular object. Other queries aren't routed, so they go
+    to the default database'''
+
+    def db_for_instance(self, model, instance):
+        if not SITE_DATABASES or instance is None or \
+                not issubclass(model, DATA_MODELS):
+            return None
+        if isinstance(instance, DATA_MODELS):
+            return get_data_db(instance.sensor_id)
+        if isinstance(instance, Sensor):
+            return get_data_db(instance.id)
+        return None
+
+    def db_for_read(self, model, **hints):
+        using = self.db_for_instance(model, hints.get('instance'))
+        return using and get_read_db(using)
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_instance(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the metadata is copied to every database, so data can refer to it
+        # wherever it's stored
+        if isinstance(obj1, DATA_MODELS) or isinstance(obj2, DATA_MODELS):
+            return True
+        return None
+
+
+def copy_object(obj, using):
+    '''Saves a copy of the given object, with the same primary key, to the
+    given database'''
+    mirror = copy.copy(obj)
+    mirror._state = ModelState()
+    mirror.save_base(raw=True, using=using)
+
+
+def mirror_metadata(using):
+    '''Copies all the metadata from the default database to the given one.
+    Returns the number of objects copied'''
+    count = 0
+    with transaction.atomic(using=using):
+        for model in METADATA_MODELS:
+            for obj in model.objects.using(DEFAULT_DB_ALIAS).iterator():
+                copy_object(obj, using)
+                count += 1
+    return count
+
+
+@receiver(post_save, sender=GeoLocation)
+@receiver(post_save, sender=Unit)
+@receiver(post_save, sender=Metric)
+@receiver(post_save, sender=Site)
+@receiver(post_save, sender=Device)
+@receiver(post_save, sender=Sensor)
+def metadata_saved(sender, instance, using, **kwargs):
+    if using != DEFAULT_DB_ALIAS:
+        # this is the copy being saved
+        return
+    for data_db in get_data_dbs():
+        copy_object(instance, data_db)
+
+
+@receiver(post_delete, sender=GeoLocation)
+@receiver(post_delete, sender=Unit)
+@receiver(post_delete, sender=Metric)
+@receiver(post_delete, sender=Site)
+@receiver(post_delete, sender=Device)
+@receiver(post_delete, sender=Sensor)
+def metadata_deleted(sender, instance, using, **kwargs):
+    if using != DEFAULT_DB_ALIAS:
+        return
+    for data_db in get_data_dbs():
+        # deleting the copy also deletes the data that refers to it
+        sender.objects.using(data_db).filter(pk=instance.pk).delete()
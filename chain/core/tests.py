@@ -1,8 +1,14 @@
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
 from datetime import datetime, timedelta
+import calendar
 import json
+import math
+import os
+import shutil
+import struct
+import tempfile
 import zmq
-from django.utils.timezone import make_aware, utc, now
+from django.utils.timezone import make_aware, utc, now, get_default_timezone
 
 
 fake_zmq_socket = None
@@ -39,14 +45,49 @@ class FakeZMQSocket(object):
 zmq.Context = FakeZMQContext
 
 from chain.core.models import ScalarData, Unit, Metric, Device, Sensor, Site
-from chain.core.models import GeoLocation
-from chain.core.resources import DeviceResource
+from chain.core.models import GeoLocation, IngestPolicy, ScalarDataRollup
+from chain.core.models import ScalarDataChunk, RetentionPolicy, ArchiveFile
+from chain.core.models import LatestValue, IngestBatch
+from chain.core.resources import DeviceResource, SensorDataResource
 from chain.core.api import HTTP_STATUS_SUCCESS, HTTP_STATUS_CREATED
+from chain.core.api import HTTP_STATUS_MULTI_STATUS, HTTP_STATUS_ACCEPTED
 from chain.core.hal import HALDoc
+from chain.core.ingest import WriteBehindBuffer, BufferFullError
+from chain.core.ingest import iter_json_list, parse_timestamp, store_data
+from chain.core import ingest
+from chain.core.downsample import lttb
+from chain.core.chunks import encode_points, decode_points, compress_history
+from chain.core import archive
+from chain.core import recent
+from chain.core.recent import RingBuffer, deferred_recent
+from chain.core import columnar
+from chain.core import routers
+from chain.core import replicas
+from chain.core.latest import refresh_latest_values
+from chain.core import resources
+from chain.core.partitions import month_start, add_months, months_between
+from chain.core.partitions import partition_name, parse_partition_name
+from chain.core.partitions import trigger_function_sql
+from chain.ingestd import IngestDaemon
+from chain.core.cache import LRUCache, get_cached
+from chain.core.ratelimit import RateLimit
+from chain.core import ratelimit
+from django.core.cache import get_cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.commands import syncdb
+from django.db import IntegrityError, connection, connections, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import unittest
+from django.core.management.base import CommandError
+from StringIO import StringIO
 
 HTTP_STATUS_NOT_ACCEPTABLE = 406
 HTTP_STATUS_NOT_FOUND = 404
 HTTP_STATUS_BAD_REQUEST = 400
+HTTP_STATUS_TOO_MANY_REQUESTS = 429
+HTTP_STATUS_METHOD_NOT_ALLOWED = 405
 
 BASE_API_URL = '/'
 SCALAR_DATA_URL = BASE_API_URL + 'scalar_data/'
@@ -57,6 +98,29 @@ ACCEPT_TAIL = 'application/xhtml+xml,application/xml;q=0.9,\
         image/webp,*/*;q=0.8'
 
 
+class SharedTestCache(LocMemCache):
+    '''Stands in for memcached in the rate limit tests, as the rate limits
+    refuse to use a per-process cache'''
+
+
+SHARED_TEST_CACHE = 'chain.core.tests.SharedTestCache'
+
+
+def add_test_database(alias):
+    '''Adds an in-memory database with all the tables to the connections.
+    South only knows about the databases that were configured when it was
+    imported, so this uses Django's own syncdb rather than migrations'''
+    connections.databases[alias] = {
+        'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+    syncdb.Command().execute(database=alias, interactive=False,
+                             verbosity=0, load_initial_data=False)
+
+
+def remove_test_database(alias):
+    connections[alias].close()
+    del connections.databases[alias]
+
+
 def obj_from_filled_schema(schema):
     '''Creates an object corresponding to the default values provided with
     a form schema'''
@@ -541,6 +605,16 @@ class ApiSitesTests(ChainTestCase):
         summary_dev = summary.devices[0]
         self.assertIn('value', summary_dev['sensors'][0]['data'][0])
 
+    def test_site_summary_should_read_latest_values_in_one_query(self):
+        site = self.get_a_site()
+        with CaptureQueriesContext(connection) as queries:
+            summary = self.get_resource(site.links['ch:siteSummary'].href)
+        self.assertEqual(summary.devices[0]['sensors'][0]['value'], 23.0)
+        sql = [query['sql'] for query in queries.captured_queries]
+        self.assertEqual(len([q for q in sql if 'core_latestvalue' in q]), 1)
+        # the only data query is for the recent data itself
+        self.assertEqual(len([q for q in sql if 'core_scalardata' in q]), 1)
+
     def test_site_summary_resources_should_have_href(self):
         site = self.get_a_site()
         summary = self.get_resource(site.links['ch:siteSummary'].href)
@@ -549,6 +623,106 @@ class ApiSitesTests(ChainTestCase):
         self.assertIn('href', summary_dev['sensors'][0])
 
 
+    def test_site_ingest_should_create_devices_and_sensors(self):
+        site = self.get_a_site()
+        report = {
+            'device': {'name': '0x8110', 'building': 'E14'},
+            'metrics': {'sht_humidity': 15.9,
+                        'charge_flags': {'fault': False}},
+            'units': {'sht_humidity': 'percent',
+                      'charge_flags_fault': 'boolean'}
+        }
+        response = self.create_resource(site.links['ch:ingest'].href, report)
+        self.assertEqual(response.count, 2)
+        self.assertEqual(response.devicesCreated, 1)
+        self.assertEqual(response.sensorsCreated, 2)
+        db_sensor = Sensor.objects.get(device__name='0x8110',
+                                       device__building='E14',
+                                       metric__name='sht_humidity')
+        self.assertEqual(db_sensor.unit.name, 'percent')
+        self.assertEqual(db_sensor.device.site.name, site.name)
+        self.assertEqual(db_sensor.scalar_data.get().value, 15.9)
+
+    def test_site_ingest_should_reuse_existing_devices(self):
+        site = self.get_a_site()
+        db_site = Site.objects.get(name=site.name)
+        device = db_site.devices.all()[0]
+        report = {
+            'device': {'name': device.name},
+            'metrics': {'temperature': 19.0}
+        }
+        response = self.create_resource(site.links['ch:ingest'].href,
+                                        [report, report])
+        self.assertEqual(response.count, 2)
+        self.assertEqual(response.devicesCreated, 0)
+        self.assertEqual(response.sensorsCreated, 0)
+        self.assertEqual(ScalarData.objects.filter(
+            sensor__device=device, value=19.0).count(), 2)
+
+    def test_repeated_site_ingest_batch_should_only_be_stored_once(self):
+        site = self.get_a_site()
+        report = {
+            'device': {'name': 'Retried Device'},
+            'metrics': {'flux': 3},
+            'units': {'flux': 'Wb'}
+        }
+        for expected_status in [HTTP_STATUS_CREATED, HTTP_STATUS_SUCCESS]:
+            response = self.client.post(site.links['ch:ingest'].href,
+                                        json.dumps(report),
+                                        content_type='application/json',
+                                        HTTP_X_BATCH_ID='retry-me',
+                                        HTTP_HOST='localhost')
+            self.assertEqual(response.status_code, expected_status)
+            self.assertEqual(json.loads(response.content)['count'], 1)
+        self.assertEqual(ScalarData.objects.filter(
+            sensor__device__name='Retried Device').count(), 1)
+
+    def test_site_ingest_should_treat_null_device_field_as_empty(self):
+        site = self.get_a_site()
+        report = {'device': {'name': 'Null Floor', 'floor': None},
+                  'metrics': {'flux': 3},
+                  'units': {'flux': 'Wb'}}
+        response = self.create_resource(site.links['ch:ingest'].href, report)
+        self.assertEqual(response.count, 1)
+        self.assertEqual(Device.objects.get(name='Null Floor').floor, '')
+
+    def test_site_ingest_with_invalid_device_field_should_400(self):
+        site = self.get_a_site()
+        report = {'device': {'name': 'Odd Floor', 'floor': {'level': 5}},
+                  'metrics': {'flux': 3},
+                  'units': {'flux': 'Wb'}}
+        response = self.client.post(site.links['ch:ingest'].href,
+                                    json.dumps(report),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        self.assertFalse(Device.objects.filter(name='Odd Floor').exists())
+
+    def test_site_ingest_to_missing_site_should_404(self):
+        report = {'device': {'name': 'Thermostat 99'},
+                  'metrics': {'temperature': 21.5},
+                  'units': {'temperature': 'C'}}
+        response = self.client.post(BASE_API_URL + 'sites/999999/ingest',
+                                    json.dumps(report),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_NOT_FOUND)
+        self.assertFalse(Device.objects.filter(name='Thermostat 99').exists())
+
+    def test_site_ingest_without_unit_should_create_nothing(self):
+        site = self.get_a_site()
+        report = {
+            'device': {'name': 'Brand New Device'},
+            'metrics': {'flux': 3}
+        }
+        response = self.client.post(site.links['ch:ingest'].href,
+                                    json.dumps(report),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        self.assertFalse(Device.objects.filter(
+            name='Brand New Device').exists())
+
 class ApiDeviceTests(ChainTestCase):
     def test_device_should_have_sensors_link(self):
         device = self.get_a_device()
@@ -589,6 +763,51 @@ class ApiDeviceTests(ChainTestCase):
         db_site = Site.objects.get(name=site['name'])
         self.assertEqual(db_device.site, db_site)
 
+    def test_device_list_with_duplicate_should_store_nothing(self):
+        site = self.get_a_site()
+        devices = self.get_resource(site.links['ch:devices'].href)
+        dev_url = devices.links.createForm.href
+        new_devices = [{'name': 'Batch Device 1'}, {'name': 'Batch Device 2'},
+                       {'name': 'Batch Device 1'}]
+        response = self.client.post(dev_url, json.dumps(new_devices),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        self.assertIn('Item 2', json.loads(response.content)['message'])
+        self.assertFalse(Device.objects.filter(
+            name__startswith='Batch Device').exists())
+
+    def test_failed_list_should_not_leave_metadata_cached(self):
+        device = self.get_a_device()
+        sensors = self.get_resource(device.links['ch:sensors'].href)
+        new_sensors = [{'metric': 'brandnew', 'unit': 'C'}] * 2
+        response = self.client.post(sensors.links.createForm.href,
+                                    json.dumps(new_sensors),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        with self.assertRaises(Metric.DoesNotExist):
+            get_cached(Metric, name='brandnew')
+
+    def test_best_effort_device_list_should_report_each_item(self):
+        site = self.get_a_site()
+        devices = self.get_resource(site.links['ch:devices'].href)
+        dev_url = devices.links.createForm.href
+        new_devices = [{'name': 'Batch Device 1'}, {'name': 'Batch Device 1'},
+                       {'name': 'Batch Device 2'}]
+        response = self.client.post(dev_url + '&mode=best-effort',
+                                    json.dumps(new_devices),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_MULTI_STATUS)
+        results = json.loads(response.content)
+        self.assertEqual([r['status'] for r in results],
+                         [HTTP_STATUS_CREATED, HTTP_STATUS_BAD_REQUEST,
+                          HTTP_STATUS_CREATED])
+        self.assertEqual(results[2]['resource']['name'], 'Batch Device 2')
+        self.assertEqual(Device.objects.filter(
+            name__startswith='Batch Device').count(), 2)
+
     def test_device_create_form_should_return_schema(self):
         devices = self.get_devices()
         device_schema = self.get_resource(devices.links.createForm.href)
@@ -645,6 +864,81 @@ class ApiDeviceTests(ChainTestCase):
                              fake_zmq_socket.sent_msgs[tag][0]['name'])
 
 
+    def test_device_should_have_ingest_link(self):
+        device = self.get_a_device()
+        self.assertIn('ch:ingest', device.links)
+
+    def test_device_report_should_store_all_metrics(self):
+        device = self.get_a_device()
+        timestamp = make_aware(datetime(2013, 1, 1, 0, 0, 0), utc)
+        report = {
+            'timestamp': timestamp.isoformat(),
+            'metrics': {'temperature': 21.5, 'setpoint': '22'}
+        }
+        response = self.create_resource(device.links['ch:ingest'].href,
+                                        report)
+        self.assertEqual(response.count, 2)
+        for metric, value in [('temperature', 21.5), ('setpoint', 22.0)]:
+            db_data = ScalarData.objects.get(
+                sensor__metric__name=metric,
+                sensor__device__name=device.name,
+                timestamp=timestamp)
+            self.assertEqual(db_data.value, value)
+
+    def test_device_report_should_flatten_nested_metrics(self):
+        device = self.get_a_device()
+        db_device = Device.objects.get(name=device.name)
+        db_device.sensors.create(metric=Metric.objects.create(
+            name='charge_flags_fault'), unit=self.unit)
+        report = {'metrics': {'charge_flags': {'fault': True}}}
+        self.create_resource(device.links['ch:ingest'].href, report)
+        db_data = ScalarData.objects.get(
+            sensor__metric__name='charge_flags_fault',
+            sensor__device=db_device)
+        self.assertEqual(db_data.value, 1.0)
+
+    def test_device_report_with_unknown_metric_should_store_nothing(self):
+        device = self.get_a_device()
+        report = {'metrics': {'temperature': 21.5, 'flux': 3}}
+        count_before = ScalarData.objects.count()
+        response = self.client.post(device.links['ch:ingest'].href,
+                                    json.dumps(report),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        self.assertIn('flux', json.loads(response.content)['message'])
+        self.assertEqual(ScalarData.objects.count(), count_before)
+
+    def test_device_report_with_deleted_sensor_should_400(self):
+        device = self.get_a_device()
+
+        def insert_batch(objs):
+            # as if a sensor was deleted after it was looked up
+            raise IntegrityError('foreign key constraint failed')
+        old_insert_batch = SensorDataResource.__dict__['insert_batch']
+        SensorDataResource.insert_batch = staticmethod(insert_batch)
+        try:
+            response = self.client.post(
+                device.links['ch:ingest'].href,
+                json.dumps({'metrics': {'temperature': 21.5}}),
+                content_type='application/json', HTTP_HOST='localhost')
+        finally:
+            SensorDataResource.insert_batch = old_insert_batch
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+
+    def test_device_report_to_missing_device_should_404(self):
+        response = self.client.post(BASE_API_URL + 'devices/999999/ingest',
+                                    json.dumps({'metrics': {'flux': 3}}),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_NOT_FOUND)
+
+    def test_device_report_should_only_be_posted(self):
+        device = self.get_a_device()
+        response = self.client.get(device.links['ch:ingest'].href,
+                                   HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_METHOD_NOT_ALLOWED)
+
 class ApiSensorTests(ChainTestCase):
     def test_sensors_should_be_postable_to_existing_device(self):
         device = self.get_a_device()
@@ -684,6 +978,73 @@ class ApiSensorTests(ChainTestCase):
                                        device__name=device.name)
         self.assertEqual('millihelen', db_sensor.unit.name)
 
+    def test_state_sensors_should_only_store_changes(self):
+        device = self.get_a_device()
+        sensors = self.get_resource(device.links['ch:sensors'].href)
+        sensor = self.create_resource(sensors.links['createForm'].href, {
+            'metric': 'charge_flags_fault',
+            'unit': 'boolean',
+            'dataType': 'state'
+        })
+        self.assertEqual(sensor.dataType, 'state')
+        sensor_data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        self.assertEqual(sensor_data.dataType, 'state')
+        start = now() - timedelta(minutes=10)
+        data = [{'value': v, 'timestamp': (start + timedelta(minutes=i))
+                 .isoformat()}
+                for i, v in enumerate([0, 0, 1, 1, 1, 0, 0])]
+        response = self.client.post(sensor_data.links.createForm.href,
+                                    json.dumps(data),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(json.loads(response.content)['count'], 7)
+        db_sensor = Sensor.objects.get(metric__name='charge_flags_fault',
+                                       device__name=device.name)
+        self.assertEqual([d.value for d in db_sensor.scalar_data.order_by(
+            'timestamp')], [0, 1, 0])
+
+        # a window that starts between changes begins with the current state
+        window_start = calendar.timegm(
+            (start + timedelta(minutes=3)).utctimetuple())
+        window = self.get_resource(
+            sensor.links['ch:dataHistory'].href +
+            '&timestamp__gte=%d&timestamp__lt=%d' % (
+                window_start, window_start + 3600))
+        self.assertEqual([d['value'] for d in window.data], [1, 0])
+        self.assertEqual(parse_timestamp(window.data[0]['timestamp']),
+                         datetime.utcfromtimestamp(window_start).replace(
+                             tzinfo=utc))
+
+    def test_state_sensors_should_only_store_changes_posted_singly(self):
+        device = self.get_a_device()
+        sensors = self.get_resource(device.links['ch:sensors'].href)
+        sensor = self.create_resource(sensors.links['createForm'].href, {
+            'metric': 'charge_flags_fault',
+            'unit': 'boolean',
+            'dataType': 'state'
+        })
+        sensor_data = self.get_resource(sensor.links['ch:dataHistory'].href)
+        start = now() - timedelta(minutes=10)
+        for i, v in enumerate([0, 1, 1, 0]):
+            self.create_resource(sensor_data.links.createForm.href, {
+                'value': v,
+                'timestamp': (start + timedelta(minutes=i)).isoformat()})
+        db_sensor = Sensor.objects.get(metric__name='charge_flags_fault',
+                                       device__name=device.name)
+        self.assertEqual([d.value for d in db_sensor.scalar_data.order_by(
+            'timestamp')], [0, 1, 0])
+        self.assertEqual(db_sensor.latest_value.value, 0)
+
+    def test_sensor_data_type_should_be_validated(self):
+        device = self.get_a_device()
+        sensors = self.get_resource(device.links['ch:sensors'].href)
+        response = self.client.post(
+            sensors.links['createForm'].href,
+            json.dumps({'metric': 'mode', 'unit': 'enum',
+                        'dataType': 'complex'}),
+            content_type='application/json', HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+
     def test_sensor_should_have_data_url(self):
         sensor = self.get_a_sensor()
         self.assertIn('ch:dataHistory', sensor.links)
@@ -767,6 +1128,299 @@ class ApiSensorDataTests(ChainTestCase):
                 timestamp=timestamps[i])
             self.assertEqual(db_data.value, values[i])
 
+    def test_posting_list_of_data_should_return_summary(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        data = [{'value': i} for i in range(5)]
+        response = self.create_resource(data_url, data)
+        self.assertEqual(response.count, 5)
+        self.assertIn('ch:dataHistory', response.links)
+
+    def test_invalid_item_should_reject_whole_list(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        data = [{'value': 1}, {'value': 'not a number'}, {'value': 3}]
+        count_before = ScalarData.objects.count()
+        response = self.client.post(data_url, json.dumps(data),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        self.assertIn('Item 1', json.loads(response.content)['message'])
+        self.assertEqual(ScalarData.objects.count(), count_before)
+
+    def test_non_finite_values_should_be_rejected(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        for bad_value in ['NaN', 'Infinity', '-Infinity']:
+            body = '[{"value": 1}, {"value": %s}]' % bad_value
+            response = self.client.post(data_url, body,
+                                        content_type='application/json',
+                                        HTTP_HOST='localhost')
+            self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+            self.assertIn('Item 1', json.loads(response.content)['message'])
+
+    def test_epoch_timestamps_should_be_accepted(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        self.create_resource(data_url, [{'value': 301,
+                                         'timestamp': 1356998400.5}])
+        self.assertEqual(ScalarData.objects.get(value=301).timestamp,
+                         datetime(2013, 1, 1, 0, 0, 0, 500000, tzinfo=utc))
+
+    def test_best_effort_data_list_should_skip_invalid_items(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        data = [{'value': 401}, {'value': 'not a number'}, {'value': 403}]
+        response = self.client.post(data_url + '&mode=best-effort',
+                                    json.dumps(data),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_MULTI_STATUS)
+        summary = json.loads(response.content)
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual([e['item'] for e in summary['errors']], [1])
+        self.assertNotIn('mode', summary['_links']['ch:dataHistory']['href'])
+        self.assertEqual(ScalarData.objects.filter(value__gt=400).count(), 2)
+
+    def test_ingest_policy_should_suppress_repeated_values(self):
+        device = self.get_a_device()
+        sensor = self.get_a_sensor()
+        db_sensor = Sensor.objects.get(
+            metric__name=sensor.metric,
+            device__name=device.name)
+        IngestPolicy.objects.create(sensor=db_sensor, drop_duplicates=True)
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        ingest._last_points.clear()
+        start = now()
+        data = [{'value': v, 'timestamp': (start + timedelta(seconds=i))
+                 .isoformat()}
+                for i, v in enumerate([501, 501, 501, 502, 502, 501])]
+        response = self.client.post(data_url, json.dumps(data),
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_CREATED)
+        summary = json.loads(response.content)
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['suppressed'], 3)
+        self.assertEqual(ScalarData.objects.filter(value__gt=500).count(), 3)
+
+    def test_single_point_should_be_returned_whatever_the_policy(self):
+        device = self.get_a_device()
+        sensor = self.get_a_sensor()
+        db_sensor = Sensor.objects.get(
+            metric__name=sensor.metric,
+            device__name=device.name)
+        IngestPolicy.objects.create(sensor=db_sensor, drop_duplicates=True)
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        ingest._last_points.clear()
+        start = now()
+        responses = [self.client.post(
+            data_url, json.dumps({'value': 601, 'timestamp': (
+                start + timedelta(seconds=i)).isoformat()}),
+            content_type='application/json', HTTP_X_BATCH_ID='single-%d' % i,
+            HTTP_HOST='localhost') for i in range(2)]
+        # the point was stored, so it's returned as a resource
+        self.assertEqual(responses[0].status_code, HTTP_STATUS_CREATED)
+        self.assertEqual(json.loads(responses[0].content)['value'], 601)
+        # the repeat was suppressed, so there's nothing but a summary
+        self.assertEqual(json.loads(responses[1].content)['suppressed'], 1)
+
+    def test_ingest_policy_should_not_suppress_retry_of_failed_batch(self):
+        device = self.get_a_device()
+        sensor = self.get_a_sensor()
+        db_sensor = Sensor.objects.get(
+            metric__name=sensor.metric,
+            device__name=device.name)
+        IngestPolicy.objects.create(sensor=db_sensor, drop_duplicates=True)
+        ingest._last_points.clear()
+        start = now()
+
+        def build(seconds):
+            return [ScalarData(sensor=db_sensor, value=501,
+                               timestamp=start + timedelta(seconds=seconds))]
+        with self.assertRaises(BufferFullError):
+            with ingest.deferred_policies():
+                self.assertEqual(len(ingest.apply_ingest_policies(build(0))),
+                                 1)
+                raise BufferFullError('full')
+        # nothing was stored, so the next reading isn't a duplicate
+        with ingest.deferred_policies():
+            self.assertEqual(len(ingest.apply_ingest_policies(build(1))), 1)
+        self.assertEqual(ingest.apply_ingest_policies(build(2)), [])
+
+    def test_repeated_batch_should_only_be_stored_once(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        data = [{'value': 101}, {'value': 102}]
+        for expected_status in [HTTP_STATUS_CREATED, HTTP_STATUS_SUCCESS]:
+            response = self.client.post(data_url, json.dumps(data),
+                                        content_type='application/json',
+                                        HTTP_X_BATCH_ID='collector-1-batch-7',
+                                        HTTP_HOST='localhost')
+            self.assertEqual(response.status_code, expected_status)
+            self.assertEqual(json.loads(response.content)['count'], 2)
+        self.assertTrue(json.loads(response.content)['duplicate'])
+        self.assertEqual(ScalarData.objects.filter(value=101).count(), 1)
+
+    def test_batch_ids_should_be_scoped_to_sensor(self):
+        data = [{'value': 101}, {'value': 102}]
+        for sensor in self.sensors[:2]:
+            response = self.client.post(
+                BASE_API_URL + 'sensordata/create?sensor_id=%d' % sensor.id,
+                json.dumps(data), content_type='application/json',
+                HTTP_X_BATCH_ID='batch-1', HTTP_HOST='localhost')
+            self.assertEqual(response.status_code, HTTP_STATUS_CREATED)
+        self.assertEqual(ScalarData.objects.filter(value=101).count(), 2)
+
+    def test_old_batches_should_expire(self):
+        IngestBatch.objects.create(scope='sensor-1', batch_id='old', count=1,
+                                   created=now() - timedelta(days=8))
+        IngestBatch.objects.create(scope='sensor-1', batch_id='new', count=1)
+        out = StringIO()
+        call_command('expire_batches', stdout=out)
+        self.assertEqual(out.getvalue(), 'Expired 1 batches\n')
+        self.assertEqual(list(IngestBatch.objects.values_list(
+            'batch_id', flat=True)), ['new'])
+
+    def test_posting_data_should_not_query_metadata_when_cached(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        self.create_resource(data_url, {'value': 23})
+        # just the INSERT and the rollup updates
+        with CaptureQueriesContext(connection) as queries:
+            self.create_resource(data_url, {'value': 24})
+        metadata_tables = ['"core_site"', '"core_device"', '"core_sensor"',
+                           '"core_metric"', '"core_unit"',
+                           '"core_ingestpolicy"']
+        for query in queries:
+            for table in metadata_tables:
+                self.assertNotIn(table, query['sql'])
+
+    def test_posting_too_fast_should_be_rate_limited(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        ratelimit.INGEST_SITE_RATE_LIMIT = (0.1, 2)
+        ratelimit.RATE_LIMIT_CACHE = SHARED_TEST_CACHE
+        get_cache(SHARED_TEST_CACHE).clear()
+        try:
+            statuses = [self.client.post(data_url, json.dumps({'value': 1}),
+                                         content_type='application/json',
+                                         HTTP_HOST='localhost')
+                        for i in range(3)]
+        finally:
+            ratelimit.INGEST_SITE_RATE_LIMIT = None
+            ratelimit.RATE_LIMIT_CACHE = 'default'
+        self.assertEqual([r.status_code for r in statuses],
+                         [HTTP_STATUS_CREATED, HTTP_STATUS_CREATED,
+                          HTTP_STATUS_TOO_MANY_REQUESTS])
+        # the window is 20 seconds long
+        self.assertIn(int(statuses[2]['Retry-After']), range(1, 21))
+
+    def test_rate_limits_should_be_off_without_a_shared_cache(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        warnings = []
+        ratelimit.INGEST_SITE_RATE_LIMIT = (0.1, 2)
+        ratelimit.logger.warning = warnings.append
+        try:
+            ratelimit.check_limit_cache()
+            statuses = [self.client.post(sensor_data.links.createForm.href,
+                                         json.dumps({'value': 1}),
+                                         content_type='application/json',
+                                         HTTP_HOST='localhost').status_code
+                        for i in range(3)]
+        finally:
+            ratelimit.INGEST_SITE_RATE_LIMIT = None
+            del ratelimit.logger.warning
+        self.assertEqual(len(warnings), 1)
+        self.assertEqual(statuses, [HTTP_STATUS_CREATED] * 3)
+
+    def post_streamed(self, data_url, body):
+        '''posts the body with the streaming threshold lowered so that it's
+        parsed incrementally, and stored two points at a time'''
+        threshold = SensorDataResource.streaming_threshold
+        chunk_size = SensorDataResource.streaming_chunk_size
+        SensorDataResource.streaming_threshold = 0
+        SensorDataResource.streaming_chunk_size = 2
+        try:
+            return self.client.post(data_url, body,
+                                    content_type='application/json',
+                                    HTTP_HOST='localhost')
+        finally:
+            SensorDataResource.streaming_threshold = threshold
+            SensorDataResource.streaming_chunk_size = chunk_size
+
+    def test_large_list_of_data_should_be_streamed(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        data = [{'value': 200 + i} for i in range(5)]
+        response = self.post_streamed(data_url, json.dumps(data))
+        self.assertEqual(response.status_code, HTTP_STATUS_CREATED)
+        self.assertEqual(json.loads(response.content)['count'], 5)
+        self.assertEqual(ScalarData.objects.filter(value__gte=200).count(), 5)
+
+    def test_invalid_item_should_reject_whole_streamed_list(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        data = [{'value': 201}, {'value': 202}, {'value': 203}, {}]
+        count_before = ScalarData.objects.count()
+        response = self.post_streamed(data_url, json.dumps(data))
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        self.assertIn('Item 3', json.loads(response.content)['message'])
+        self.assertEqual(ScalarData.objects.count(), count_before)
+
+    def test_packed_binary_data_should_be_postable(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        # 2013-01-01T00:00:00Z and one second later, in epoch milliseconds
+        body = struct.pack('<qdqd', 1356998400000, 1.5, 1356998401000, 2.5)
+        response = self.client.post(data_url, body,
+                                    content_type='application/x-chain-packed',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_CREATED)
+        self.assertEqual(json.loads(response.content)['count'], 2)
+        db_data = ScalarData.objects.get(
+            timestamp=make_aware(datetime(2013, 1, 1, 0, 0, 1), utc))
+        self.assertEqual(db_data.value, 2.5)
+
+    def test_truncated_packed_data_should_be_rejected(self):
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        body = struct.pack('<qd', 1356998400000, 1.5)[:-1]
+        response = self.client.post(data_url, body,
+                                    content_type='application/x-chain-packed',
+                                    HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+
     def test_posting_data_should_send_zmq_msgs(self):
         fake_zmq_socket.clear()
         sensor = self.get_a_sensor()
@@ -792,6 +1446,29 @@ class ApiSensorDataTests(ChainTestCase):
             self.assertEqual(data['value'],
                              fake_zmq_socket.sent_msgs[tag][0]['value'])
 
+    def test_buffered_data_should_be_published_once_stored(self):
+        fake_zmq_socket.clear()
+        sensor = self.get_a_sensor()
+        sensor_data = self.get_resource(
+            sensor.links['ch:dataHistory'].href)
+        data_url = sensor_data.links.createForm.href
+        buf = WriteBehindBuffer(max_size=10, flush_size=5, flush_interval=1,
+                                background=False)
+        get_write_behind_buffer = resources.get_write_behind_buffer
+        resources.get_write_behind_buffer = lambda: buf
+        try:
+            response = self.client.post(
+                data_url, json.dumps([{'value': 1}, {'value': 2}]),
+                content_type='application/json', HTTP_HOST='localhost')
+        finally:
+            resources.get_write_behind_buffer = get_write_behind_buffer
+        self.assertEqual(response.status_code, HTTP_STATUS_ACCEPTED)
+        self.assertEqual(fake_zmq_socket.sent_msgs, {})
+        buf.flush()
+        self.assertEqual([len(msgs) for tag, msgs
+                          in fake_zmq_socket.sent_msgs.items()
+                          if tag.startswith('sensor-')], [2])
+
     def test_posting_data_should_sanitize_args_for_response(self):
         fake_zmq_socket.clear()
         sensor = self.get_a_sensor()
@@ -849,6 +1526,988 @@ class ApiSensorDataTests(ChainTestCase):
             self.assertTrue(False) # Timestamp edge cases crashed the server
 
 
+class WriteBehindBufferTests(TestCase):
+    def setUp(self):
+        self.flushed = []
+        self.buffer = WriteBehindBuffer(max_size=10, flush_size=5,
+                                        flush_interval=1,
+                                        flush_func=self.flushed.extend,
+                                        background=False)
+
+    def test_flush_should_write_buffered_items(self):
+        self.buffer.put([1, 2, 3])
+        self.assertEqual(self.flushed, [])
+        self.buffer.flush()
+        self.assertEqual(self.flushed, [1, 2, 3])
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_full_buffer_should_refuse_whole_batch(self):
+        self.buffer.put(range(8))
+        with self.assertRaises(BufferFullError):
+            self.buffer.put(range(3))
+        self.assertEqual(len(self.buffer), 8)
+
+    def test_failed_flush_should_keep_items(self):
+        def fail(items):
+            raise IOError('database went away')
+        buf = WriteBehindBuffer(max_size=10, flush_size=5, flush_interval=1,
+                                flush_func=fail, background=False)
+        buf.put([1, 2])
+        with self.assertRaises(IOError):
+            buf.flush()
+        self.assertEqual(len(buf), 2)
+
+    def test_on_stored_should_only_be_called_after_flush(self):
+        published = []
+        self.buffer.put([1, 2], on_stored=published.extend)
+        self.assertEqual(published, [])
+        self.buffer.flush()
+        self.assertEqual(published, [1, 2])
+
+    def test_integrity_error_should_only_drop_failing_sensor(self):
+        def store(objs):
+            if any(obj.sensor_id == 2 for obj in objs):
+                raise IntegrityError('no such sensor')
+            self.flushed.extend(objs)
+        published = []
+        buf = WriteBehindBuffer(max_size=10, flush_size=5, flush_interval=1,
+                                flush_func=store, background=False)
+        objs = [ScalarData(sensor_id=sensor_id, value=sensor_id)
+                for sensor_id in [1, 2, 3]]
+        buf.put(objs, on_stored=published.extend)
+        buf.flush()
+        self.assertEqual(self.flushed, [objs[0], objs[2]])
+        self.assertEqual(published, [objs[0], objs[2]])
+        self.assertEqual(len(buf), 0)
+
+
+class IngestDaemonTests(TestCase):
+    def setUp(self):
+        self.site = Site.objects.create(name='Test Site',
+                                        raw_zmq_stream='tcp://localhost:1')
+        self.pub_socket = FakeZMQSocket(zmq.PUB)
+        self.daemon = IngestDaemon(self.pub_socket, background=False)
+
+    def test_reports_should_create_devices_and_sensors(self):
+        report = {'src': '0x8110', 'via': '0x0000', 'sht_humidity': 15.9,
+                  'charge_flags': {'fault': False, 'charge': True}}
+        self.daemon.handle_message(self.site, json.dumps(report))
+        self.daemon.buffer.flush()
+        device = Device.objects.get(site=self.site, name='0x8110')
+        humidity = device.sensors.get(metric__name='sht_humidity')
+        self.assertEqual(humidity.unit.name, 'percent')
+        self.assertEqual(humidity.scalar_data.get().value, 15.9)
+        self.assertEqual(device.sensors.get(
+            metric__name='charge_flags_charge').scalar_data.get().value, 1)
+        self.assertFalse(device.sensors.filter(metric__name='via').exists())
+        self.assertEqual(len(self.pub_socket.sent_msgs['site-%d' %
+                                                       self.site.id]), 3)
+
+    def test_invalid_reports_should_be_ignored(self):
+        for raw in ['not json', json.dumps({'sht_humidity': 15.9}),
+                    json.dumps({'src': '0x8110', 'sht_humidity': 'high'})]:
+            self.daemon.handle_message(self.site, raw)
+        self.daemon.buffer.flush()
+        self.assertEqual(ScalarData.objects.count(), 0)
+
+    def test_unknown_nested_metric_should_be_named_like_tidpost(self):
+        report = {'src': '0x8110', 'light': {'red': 12}}
+        self.daemon.handle_message(self.site, json.dumps(report))
+        sensor = Sensor.objects.get(metric__name='light_red')
+        self.assertEqual(sensor.unit.name, 'red units')
+
+    def test_data_should_be_published_to_device_current_site(self):
+        report = json.dumps({'src': '0x8110', 'sht_humidity': 15.9})
+        self.daemon.handle_message(self.site, report)
+        self.daemon.buffer.flush()
+        other_site = Site.objects.create(name='Other Site')
+        device = Device.objects.get(name='0x8110')
+        device.site = other_site
+        device.save()
+        self.pub_socket.clear()
+        # the daemon mustn't remember the device's old site
+        self.daemon.buffer.put([ScalarData(sensor=device.sensors.get(),
+                                           value=16.0)])
+        self.daemon.buffer.flush()
+        self.assertIn('site-%d' % other_site.id, self.pub_socket.sent_msgs)
+        self.assertNotIn('site-%d' % self.site.id, self.pub_socket.sent_msgs)
+
+
+class MetadataCacheTests(TestCase):
+    def test_lru_cache_should_discard_least_recently_used(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_lru_cache_entries_should_expire(self):
+        cache = LRUCache(max_size=2, ttl=-1)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_saving_metadata_should_invalidate_cache(self):
+        unit = Unit.objects.create(name='lux')
+        self.assertEqual(get_cached(Unit, name='lux').id, unit.id)
+        unit.name = 'lumens'
+        unit.save()
+        with self.assertRaises(Unit.DoesNotExist):
+            get_cached(Unit, name='lux')
+
+
+class LatestValueTests(ChainTestCase):
+    def test_latest_value_should_only_move_forward(self):
+        sensor = self.sensors[0]
+        latest = sensor.latest_value
+        self.assertEqual(latest.value, 23.0)
+        # backfilled data doesn't replace the latest value
+        store_data([ScalarData(sensor=sensor, value=5,
+                               timestamp=latest.timestamp -
+                               timedelta(hours=1))])
+        self.assertEqual(LatestValue.objects.get(sensor=sensor).value, 23.0)
+        timestamp = latest.timestamp + timedelta(seconds=10)
+        store_data([ScalarData(sensor=sensor, value=v,
+                               timestamp=timestamp - timedelta(seconds=s))
+                    for s, v in [(0, 24), (5, 25)]] +
+                   [ScalarData(sensor=self.sensors[1], value=1,
+                               timestamp=timestamp)])
+        updated = LatestValue.objects.get(sensor=sensor)
+        self.assertEqual((updated.value, updated.timestamp), (24, timestamp))
+        self.assertGreaterEqual(updated.received, latest.received)
+        self.assertEqual(LatestValue.objects.get(
+            sensor=self.sensors[1]).value, 1)
+
+    def test_refresh_should_move_latest_value_back_after_delete(self):
+        sensor = self.sensors[0]
+        latest = sensor.latest_value
+        store_data([ScalarData(sensor=sensor, value=99,
+                               timestamp=latest.timestamp +
+                               timedelta(hours=1))])
+        sensor.scalar_data.filter(value=99).delete()
+        refresh_latest_values([sensor.id])
+        restored = LatestValue.objects.get(sensor=sensor)
+        self.assertEqual((restored.value, restored.timestamp),
+                         (latest.value, latest.timestamp))
+        # compressed data is still there, so moving it keeps the value
+        moved = set()
+        compress_history(latest.timestamp + timedelta(days=2),
+                         sensor_ids=[sensor.id], moved=moved)
+        self.assertEqual(moved, set([sensor.id]))
+        refresh_latest_values(moved)
+        self.assertFalse(sensor.scalar_data.exists())
+        self.assertEqual(LatestValue.objects.get(sensor=sensor).value,
+                         latest.value)
+        ScalarDataChunk.objects.filter(sensor=sensor).delete()
+        refresh_latest_values([sensor.id])
+        self.assertFalse(LatestValue.objects.filter(sensor=sensor).exists())
+
+    def test_deleting_sensor_should_not_load_its_data(self):
+        sensor = self.sensors[0]
+        start = now() - timedelta(days=1)
+        store_data([ScalarData(sensor=sensor, value=i,
+                               timestamp=start + timedelta(minutes=i))
+                    for i in range(200)])
+        with CaptureQueriesContext(connection) as queries:
+            sensor.delete()
+        self.assertLess(len(queries), 30)
+        self.assertFalse(LatestValue.objects.filter(
+            sensor_id=sensor.id).exists())
+
+    def test_sensor_without_data_should_have_no_value(self):
+        sensor = Sensor.objects.create(device=self.devices[0],
+                                       metric=Metric.objects.create(
+                                           name='humidity'),
+                                       unit=self.unit)
+        data = self.get_resource(BASE_API_URL + 'sensors/%d' % sensor.id)
+        self.assertNotIn('value', data)
+        self.assertNotIn('updated', data)
+
+
+class IngestPolicyTests(TestCase):
+    def setUp(self):
+        self.start = now()
+
+    def suppresses(self, policy, last_value, value, seconds=1):
+        return policy.suppresses(self.start, last_value,
+                                 self.start + timedelta(seconds=seconds),
+                                 value)
+
+    def test_duplicates_should_only_be_dropped_when_enabled(self):
+        self.assertFalse(self.suppresses(IngestPolicy(), 5, 5))
+        policy = IngestPolicy(drop_duplicates=True)
+        self.assertTrue(self.suppresses(policy, 5, 5))
+        self.assertFalse(self.suppresses(policy, 5, 5.1))
+
+    def test_points_within_deadband_should_be_dropped(self):
+        policy = IngestPolicy(deadband_abs=0.5, deadband_rel=0.1)
+        self.assertTrue(self.suppresses(policy, 2, 2.5))
+        self.assertFalse(self.suppresses(policy, 2, 2.6))
+        self.assertTrue(self.suppresses(policy, 100, 109))
+        self.assertFalse(self.suppresses(policy, 100, 111))
+
+    def test_old_and_overdue_points_should_be_kept(self):
+        policy = IngestPolicy(drop_duplicates=True, max_silence=60)
+        self.assertFalse(self.suppresses(policy, 5, 5, seconds=-1))
+        self.assertFalse(self.suppresses(policy, 5, 5, seconds=60))
+        self.assertTrue(self.suppresses(policy, 5, 5, seconds=59))
+
+
+class RollupTests(ChainTestCase):
+    def test_rollups_should_summarize_posted_data(self):
+        sensor = self.sensors[0]
+        start = datetime(2014, 4, 12, 15, 0, tzinfo=utc)
+        store_data([ScalarData(sensor=sensor, value=v,
+                               timestamp=start + timedelta(seconds=s))
+                    for s, v in [(30, 2), (0, 4), (90, -1)]])
+        minutes = sensor.rollups.filter(
+            resolution=60, start__gte=start,
+            start__lt=start + timedelta(hours=1)).order_by('start')
+        self.assertEqual([(r.count, r.min, r.max, r.sum, r.first, r.last)
+                          for r in minutes], [(2, 2, 4, 6, 4, 2),
+                                              (1, -1, -1, -1, -1, -1)])
+        # later data for the same hour is merged in
+        store_data([ScalarData(sensor=sensor, value=10,
+                               timestamp=start + timedelta(minutes=30))])
+        hour = sensor.rollups.get(resolution=3600, start=start)
+        self.assertEqual((hour.count, hour.min, hour.max, hour.last),
+                         (4, -1, 10, 10))
+        self.assertEqual(hour.mean, 3.75)
+
+    def test_backfill_should_only_lock_the_rollups_it_adds_to(self):
+        sensor = self.sensors[0]
+        start = datetime(2014, 4, 1, tzinfo=utc)
+        store_data([ScalarData(sensor=sensor, value=1,
+                               timestamp=start + timedelta(days=days))
+                    for days in [0, 5, 10]])
+        with CaptureQueriesContext(connection) as queries:
+            store_data([ScalarData(sensor=sensor, value=2,
+                                   timestamp=start + timedelta(days=days))
+                        for days in [0, 10]])
+        rollup_queries = [q['sql'] for q in queries.captured_queries
+                          if 'SELECT' in q['sql'] and
+                          'core_scalardatarollup' in q['sql']]
+        self.assertEqual(len(rollup_queries), 1)
+        self.assertIn('ORDER BY', rollup_queries[0])
+        self.assertNotIn('>=', rollup_queries[0])
+        self.assertEqual([r.count for r in sensor.rollups.filter(
+            resolution=86400, start__lt=start + timedelta(days=11)).order_by(
+                'start')], [2, 1, 2])
+
+    def get_aggregated(self, sensor, start, end, params):
+        return self.get_resource(
+            BASE_API_URL + 'sensordata/?sensor_id=%d&timestamp__gte=%d'
+            '&timestamp__lt=%d&%s' % (sensor.id, calendar.timegm(
+                start.utctimetuple()), calendar.timegm(end.utctimetuple()),
+                params))
+
+    def test_aggregated_data_should_match_at_every_resolution(self):
+        sensor = self.sensors[0]
+        start = datetime(2014, 4, 12, 15, 0, tzinfo=utc)
+        store_data([ScalarData(sensor=sensor, value=i,
+                               timestamp=start + timedelta(seconds=30 * i))
+                    for i in range(240)])
+        # hours come straight from the rollups, 15 minutes are merged from
+        # minute rollups, and 90 seconds are aggregated from the raw data
+        for resolution, seconds in [('1h', 3600), ('15m', 900),
+                                    ('90', 90), ('90s', 90)]:
+            data = self.get_aggregated(
+                sensor, start, start + timedelta(hours=2),
+                'resolution=%s&aggregate=mean,min,max,count' % resolution)
+            self.assertEqual(data.resolution, seconds)
+            self.assertEqual(len(data.data), 7200 / seconds)
+            per_bucket = seconds / 30
+            self.assertEqual(data.data[1]['count'], per_bucket)
+            self.assertEqual(data.data[1]['min'], per_bucket)
+            self.assertEqual(data.data[1]['max'], 2 * per_bucket - 1)
+            self.assertEqual(data.data[1]['mean'], 1.5 * per_bucket - 0.5)
+            self.assertIn('resolution=%s' % resolution,
+                          data.links.next.href)
+
+    def test_first_and_last_should_be_aggregated_from_raw_data(self):
+        sensor = self.sensors[0]
+        start = datetime(2014, 4, 12, 15, 0, tzinfo=utc)
+        store_data([ScalarData(sensor=sensor, value=i,
+                               timestamp=start + timedelta(seconds=10 * i))
+                    for i in range(9)])
+        data = self.get_aggregated(sensor, start, start + timedelta(hours=1),
+                                   'resolution=45s&aggregate=first,last')
+        self.assertEqual([(d['first'], d['last']) for d in data.data],
+                         [(0, 4), (5, 8)])
+
+    def test_longest_resolution_should_be_allowed(self):
+        response = self.client.get(
+            BASE_API_URL + 'sensordata/?sensor_id=%d&resolution=366d' %
+            self.sensors[0].id, HTTP_ACCEPT='application/hal+json')
+        self.assertEqual(response.status_code, HTTP_STATUS_SUCCESS)
+
+    def test_invalid_aggregation_should_be_rejected(self):
+        sensor = self.sensors[0]
+        for params in ['resolution=1w', 'resolution=0', 'aggregate=mean',
+                       'resolution=99999999d', 'resolution=367d',
+                       'resolution=1h&aggregate=median', 'max_points=2',
+                       'max_points=100&resolution=1h']:
+            response = self.client.get(
+                BASE_API_URL + 'sensordata/?sensor_id=%d&%s' % (sensor.id,
+                                                                 params),
+                HTTP_ACCEPT='application/hal+json')
+            self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+
+    def test_max_points_should_downsample_data(self):
+        sensor = self.sensors[0]
+        start = datetime(2014, 4, 12, 15, 0, tzinfo=utc)
+        values = [0] * 500
+        values[123] = 100
+        store_data([ScalarData(sensor=sensor, value=v,
+                               timestamp=start + timedelta(seconds=i))
+                    for i, v in enumerate(values)])
+        # a short window is downsampled from the raw data
+        data = self.get_aggregated(sensor, start, start + timedelta(hours=1),
+                                   'max_points=50')
+        self.assertEqual(data.maxPoints, 50)
+        self.assertEqual(len(data.data), 50)
+        self.assertIn(100, [d['value'] for d in data.data])
+        self.assertIn('max_points=50', data.links.next.href)
+        # with too many points to read, the rollups are used instead, and
+        # they still have the peak
+        old_limit = SensorDataResource.downsample_raw_limit
+        SensorDataResource.downsample_raw_limit = 100
+        try:
+            data = self.get_aggregated(sensor, start - timedelta(days=30),
+                                       start + timedelta(days=30),
+                                       'max_points=50')
+        finally:
+            SensorDataResource.downsample_raw_limit = old_limit
+        self.assertLessEqual(len(data.data), 50)
+        self.assertIn(100, [d['value'] for d in data.data])
+
+    def test_rebuilt_rollups_should_match_incremental_ones(self):
+        def summary():
+            return sorted((r.sensor_id, r.resolution, r.start, r.count,
+                           r.min, r.max, r.sum, r.first, r.last)
+                          for r in ScalarDataRollup.objects.all())
+        incremental = summary()
+        self.assertTrue(incremental)
+        ScalarDataRollup.objects.all().delete()
+        call_command('rebuild_rollups', all=True, stdout=StringIO())
+        self.assertEqual(summary(), incremental)
+
+
+class DownsampleTests(TestCase):
+    def test_lttb_should_keep_ends_and_peaks(self):
+        points = [(x, 0) for x in range(1000)]
+        points[500] = (500, -7)
+        sampled = lttb(points, 10)
+        self.assertEqual(len(sampled), 10)
+        self.assertEqual(sampled[0], (0, 0))
+        self.assertEqual(sampled[-1], (999, 0))
+        self.assertIn((500, -7), sampled)
+
+    def test_lttb_should_leave_short_series_alone(self):
+        points = [(x, x * x) for x in range(5)]
+        self.assertEqual(lttb(points, 10), points)
+
+
+class CompressionTests(ChainTestCase):
+    def test_points_should_round_trip(self):
+        start = datetime(2014, 4, 12, 15, 0, tzinfo=utc)
+        points = [(start, 22.5), (start + timedelta(seconds=10), 22.5),
+                  (start + timedelta(seconds=20), -1e-9),
+                  (start + timedelta(seconds=25, microseconds=7), 1e300),
+                  (start + timedelta(seconds=25, microseconds=7), 0.0)]
+        self.assertEqual(decode_points(encode_points(points)), points)
+        self.assertEqual(decode_points(encode_points([])), [])
+
+    def test_regular_data_should_compress_well(self):
+        start = datetime(2014, 4, 12, 0, 0, tzinfo=utc)
+        points = [(start + timedelta(seconds=10 * i),
+                   round(20 + math.sin(i / 500.0), 1)) for i in range(8640)]
+        # a raw row takes over 100 bytes with its indexes
+        self.assertLess(len(encode_points(points)), 8640 * 4)
+
+    def get_data(self, sensor, start, end, params=''):
+        return self.get_resource(
+            BASE_API_URL + 'sensordata/?sensor_id=%d&timestamp__gte=%d'
+            '&timestamp__lt=%d&%s' % (sensor.id, calendar.timegm(
+                start.utctimetuple()), calendar.timegm(end.utctimetuple()),
+                params))
+
+    def test_compressed_data_should_read_the_same(self):
+        sensor = self.sensors[0]
+        start = datetime(2014, 4, 12, 22, 0, tzinfo=utc)
+        store_data([ScalarData(sensor=sensor, value=i % 7,
+                               timestamp=start + timedelta(seconds=60 * i))
+                    for i in range(240)])
+        end = start + timedelta(hours=4)
+        requests = ['', 'resolution=1h&aggregate=mean,count',
+                    'resolution=90s&aggregate=sum,count',
+                    'resolution=45m&aggregate=first,last', 'max_points=20']
+        before = [self.get_data(sensor, start, end, params).data
+                  for params in requests]
+        # only whole days are compressed
+        self.assertEqual(compress_history(end, [sensor.id]), 120)
+        self.assertEqual(compress_history(end + timedelta(days=1),
+                                          [sensor.id]), 120)
+        # the data spans midnight, so it went in two chunks
+        self.assertEqual(ScalarDataChunk.objects.filter(
+            sensor=sensor).count(), 2)
+        self.assertFalse(sensor.scalar_data.filter(timestamp__lt=end))
+        after = [self.get_data(sensor, start, end, params).data
+                 for params in requests]
+        self.assertEqual(after, before)
+        # data arriving late is read alongside the chunk, then merged into it
+        store_data([ScalarData(sensor=sensor, value=100,
+                               timestamp=start + timedelta(seconds=30))])
+        values = [d['value'] for d in self.get_data(sensor, start, end).data]
+        self.assertEqual(values[:3], [0, 100, 1])
+        self.assertEqual(compress_history(end + timedelta(days=1),
+                                          [sensor.id]), 1)
+        self.assertEqual(ScalarDataChunk.objects.get(
+            sensor=sensor, start=datetime(2014, 4, 12, tzinfo=utc)).count,
+            121)
+        self.assertEqual(
+            [d['value'] for d in self.get_data(sensor, start, end).data],
+            values)
+
+    def test_rollups_should_rebuild_from_chunks(self):
+        sensor = self.sensors[0]
+        start = datetime(2014, 4, 12, 15, 0, tzinfo=utc)
+        store_data([ScalarData(sensor=sensor, value=i,
+                               timestamp=start + timedelta(seconds=30 * i))
+                    for i in range(10)])
+        compress_history(start + timedelta(days=1), [sensor.id])
+        sensor.rollups.all().delete()
+        call_command('rebuild_rollups', all=True, sensor=[sensor.id],
+                     stdout=StringIO())
+        hour = sensor.rollups.get(resolution=3600, start=start)
+        self.assertEqual((hour.count, hour.sum), (10, 45))
+
+    def test_sensor_should_show_compressed_value(self):
+        sensor = self.sensors[0]
+        compress_history(now() + timedelta(days=1), [sensor.id])
+        self.assertFalse(sensor.scalar_data.exists())
+        data = self.get_resource(BASE_API_URL + 'sensors/%d' % sensor.id)
+        self.assertEqual(data.value, 23.0)
+
+
+class ArchiveTests(ChainTestCase):
+    def test_sensor_policy_should_override_site_policy(self):
+        RetentionPolicy.objects.create(site=self.sites[0], keep_days=365)
+        RetentionPolicy.objects.create(sensor=self.sensors[0], keep_days=30)
+        site_sensors = Sensor.objects.filter(device__site=self.sites[0])
+        self.assertEqual(archive.get_retention(), dict(
+            [(sensor.id, 365) for sensor in site_sensors] +
+            [(self.sensors[0].id, 30)]))
+        self.assertEqual(archive.get_retention([self.sensors[0].id,
+                                                self.sensors[2].id]),
+                         {self.sensors[0].id: 30})
+        with self.assertRaises(ValidationError):
+            RetentionPolicy(keep_days=30).clean()
+
+    def test_archiving_should_need_configuring(self):
+        old_root = archive.ARCHIVE_ROOT
+        archive.ARCHIVE_ROOT = None
+        try:
+            with self.assertRaises(CommandError):
+                call_command('archive_history', stdout=StringIO())
+        finally:
+            archive.ARCHIVE_ROOT = old_root
+
+    def test_archived_data_should_read_the_same(self):
+        self.check_archived_data('chunks')
+
+    @unittest.skipIf(archive.pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_archived_data_should_read_the_same(self):
+        self.check_archived_data('parquet')
+
+    def check_archived_data(self, archive_format):
+        sensor = self.sensors[0]
+        start = datetime(2014, 4, 30, 12, 0, tzinfo=utc)
+        store_data([ScalarData(sensor=sensor, value=i % 5,
+                               timestamp=start + timedelta(hours=i))
+                    for i in range(48)])
+        end = start + timedelta(days=2)
+        url = BASE_API_URL + 'sensordata/?sensor_id=%d&timestamp__gte=%d' \
+            '&timestamp__lt=%d' % (sensor.id,
+                                   calendar.timegm(start.utctimetuple()),
+                                   calendar.timegm(end.utctimetuple()))
+        before = self.get_resource(url).data
+        # some of the data is compressed first, which is archived too
+        compress_history(datetime(2014, 5, 1, tzinfo=utc), [sensor.id])
+        RetentionPolicy.objects.create(sensor=sensor, keep_days=30)
+        old_root = archive.ARCHIVE_ROOT
+        old_format = archive.ARCHIVE_FORMAT
+        archive.ARCHIVE_ROOT = tempfile.mkdtemp()
+        archive.ARCHIVE_FORMAT = archive_format
+        try:
+            self.assertEqual(archive.archive_history(
+                now=end + timedelta(days=31)), 48)
+            # the data spans the end of a month, so it's in two files
+            files = ArchiveFile.objects.filter(sensor=sensor)
+            self.assertEqual(len(files), 2)
+            for archive_file in files:
+                self.assertTrue(archive_file.path.endswith(
+                    '.' + archive_format))
+            self.assertFalse(sensor.chunks.exists())
+            self.assertFalse(sensor.scalar_data.filter(timestamp__lt=end))
+            self.assertEqual(self.get_resource(url).data, before)
+            sensor.scalar_data.all().delete()
+            refresh_latest_values([sensor.id])
+            data = self.get_resource(BASE_API_URL + 'sensors/%d' % sensor.id)
+            self.assertEqual(data.value, 47 % 5)
+        finally:
+            shutil.rmtree(archive.ARCHIVE_ROOT)
+            archive.ARCHIVE_ROOT = old_root
+            archive.ARCHIVE_FORMAT = old_format
+
+
+class RecentDataTests(ChainTestCase):
+    def setUp(self):
+        self.old_dir = recent.RECENT_DATA_DIR
+        recent.RECENT_DATA_DIR = tempfile.mkdtemp()
+        recent._buffers.clear()
+        super(RecentDataTests, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(recent.RECENT_DATA_DIR)
+        recent.RECENT_DATA_DIR = self.old_dir
+        recent._buffers.clear()
+        super(RecentDataTests, self).tearDown()
+
+    def test_ring_buffer_should_track_what_it_covers(self):
+        ring = RingBuffer(os.path.join(recent.RECENT_DATA_DIR, 'test.ring'),
+                          4)
+        self.assertIsNone(ring.read(0, 1))
+        ring.append([(10 ** 16 + i, float(i)) for i in range(3)])
+        self.assertEqual(ring.read(10 ** 16, 10 ** 16 + 2),
+                         [(10 ** 16, 0.0), (10 ** 16 + 1, 1.0)])
+        # wrapping around overwrites the oldest points, which are then no
+        # longer covered
+        ring.append([(10 ** 16 + i, float(i)) for i in range(3, 6)])
+        self.assertIsNone(ring.read(10 ** 16 + 1, 10 ** 16 + 10))
+        self.assertEqual([value for _, value in
+                          ring.read(10 ** 16 + 2, 10 ** 16 + 10)],
+                         [2.0, 3.0, 4.0, 5.0])
+        # a point older than the newest can't be added, so the buffer stops
+        # covering the time before it
+        ring.append([(10 ** 16 + 4, 4.5)])
+        self.assertIsNone(ring.read(10 ** 16 + 3, 10 ** 16 + 10))
+        self.assertEqual(ring.read(10 ** 16 + 5, 10 ** 16 + 10),
+                         [(10 ** 16 + 5, 5.0)])
+
+    def get_data(self, sensor, start, end):
+        return self.get_resource(
+            BASE_API_URL + 'sensordata/?sensor_id=%d&timestamp__gte=%d'
+            '&timestamp__lt=%d' % (sensor.id, calendar.timegm(
+                start.utctimetuple()), calendar.timegm(end.utctimetuple())))
+
+    def test_recent_data_should_be_read_from_buffer(self):
+        sensor = self.sensors[0]
+        start = now().replace(microsecond=0) + timedelta(seconds=10)
+        store_data([ScalarData(sensor=sensor, value=i,
+                               timestamp=start + timedelta(seconds=i))
+                    for i in range(10)])
+        with CaptureQueriesContext(connection) as queries:
+            data = self.get_data(sensor, start, start + timedelta(hours=1))
+        self.assertEqual([d['value'] for d in data.data], range(10))
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'core_scalardata' in query['sql']])
+        # older data isn't in the buffer, so it comes from the database
+        data = self.get_data(sensor, start - timedelta(hours=1),
+                             start + timedelta(hours=1))
+        self.assertEqual([d['value'] for d in data.data],
+                         [22.0, 23.0] + range(10))
+
+    def test_rolled_back_data_should_not_be_buffered(self):
+        sensor = self.sensors[0]
+        start = now().replace(microsecond=0) + timedelta(seconds=10)
+        with self.assertRaises(ValueError):
+            with deferred_recent(), transaction.atomic():
+                store_data([ScalarData(sensor=sensor, value=1,
+                                       timestamp=start)])
+                raise ValueError
+        self.assertEqual(self.get_data(
+            sensor, start, start + timedelta(hours=1)).data, [])
+
+
+class ColumnarTests(ChainTestCase):
+    def setUp(self):
+        self.old_dir = columnar.COLUMNAR_DATA_DIR
+        columnar.COLUMNAR_DATA_DIR = tempfile.mkdtemp()
+        super(ColumnarTests, self).setUp()
+        self.sensor = self.sensors[0]
+        self.start = datetime(2014, 3, 1, 22, 0, tzinfo=utc)
+        store_data([ScalarData(sensor=self.sensor, value=i,
+                               timestamp=self.start + timedelta(minutes=30 * i))
+                    for i in range(8)])
+
+    def tearDown(self):
+        shutil.rmtree(columnar.COLUMNAR_DATA_DIR)
+        columnar.COLUMNAR_DATA_DIR = self.old_dir
+        super(ColumnarTests, self).tearDown()
+
+    def get_packed(self, start, end, **params):
+        url = BASE_API_URL + 'sensordata/?sensor_id=%d&timestamp__gte=%d' \
+            '&timestamp__lt=%d' % (self.sensor.id,
+                                   calendar.timegm(start.utctimetuple()),
+                                   calendar.timegm(end.utctimetuple()))
+        for key, value in params.items():
+            url += '&%s=%s' % (key, value)
+        response = self.client.get(url,
+                                   HTTP_ACCEPT=ingest.PACKED_DATA_MIME_TYPE)
+        if response.status_code != HTTP_STATUS_SUCCESS:
+            return response
+        self.assertEqual(response['Content-Type'],
+                         ingest.PACKED_DATA_MIME_TYPE)
+        flat = struct.unpack('<' + 'qd' * (len(response.content) // 16),
+                             response.content)
+        return zip(flat[::2], flat[1::2])
+
+    def test_finished_days_should_be_read_from_files(self):
+        end = self.start + timedelta(hours=4)
+        expected = [(calendar.timegm(self.start.utctimetuple()) * 1000 +
+                     i * 30 * 60 * 1000, float(i)) for i in range(8)]
+        self.assertEqual(self.get_packed(self.start, end), expected)
+        self.assertEqual(columnar.materialize_days(
+            sensor_ids=[self.sensor.id]), 2)
+        self.assertEqual(columnar.materialize_days(
+            sensor_ids=[self.sensor.id]), 0)
+        with CaptureQueriesContext(connection) as queries:
+            points = self.get_packed(self.start + timedelta(minutes=30), end)
+        self.assertEqual(points, expected[1:])
+        self.assertFalse([query for query in queries.captured_queries
+                          if '"core_scalardata"' in query['sql']])
+
+    def test_late_data_should_be_read_from_database(self):
+        columnar.materialize_days(sensor_ids=[self.sensor.id])
+        store_data([ScalarData(sensor=self.sensor, value=100,
+                               timestamp=self.start + timedelta(minutes=1))])
+        points = self.get_packed(self.start, self.start + timedelta(hours=1))
+        self.assertEqual([value for _, value in points], [0.0, 100.0, 1.0])
+        # only the day the data was added to is rewritten
+        self.assertEqual(columnar.materialize_days(
+            sensor_ids=[self.sensor.id]), 1)
+
+    def test_data_without_day_rollups_should_be_read_from_database(self):
+        end = self.start + timedelta(hours=4)
+        columnar.materialize_days(sensor_ids=[self.sensor.id])
+        # the first day has no rollup to check its file against
+        first_day = self.start.replace(hour=0)
+        ScalarDataRollup.objects.filter(sensor=self.sensor, resolution=86400,
+                                        start=first_day).delete()
+        self.assertEqual([value for _, value in self.get_packed(
+            self.start, end)], [float(i) for i in range(8)])
+        old_resolutions = columnar.ROLLUP_RESOLUTIONS
+        columnar.ROLLUP_RESOLUTIONS = [60]
+        try:
+            self.assertEqual([value for _, value in self.get_packed(
+                self.start, end)], [float(i) for i in range(8)])
+        finally:
+            columnar.ROLLUP_RESOLUTIONS = old_resolutions
+
+    def test_packed_data_should_only_be_filtered_by_time(self):
+        response = self.get_packed(self.start,
+                                   self.start + timedelta(hours=1),
+                                   value__gt=3)
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_files_should_be_mapped_as_arrays(self):
+        columnar.materialize_days(sensor_ids=[self.sensor.id])
+        data = columnar.open_day(self.sensor.id,
+                                 self.start.replace(hour=0))
+        timestamps, values = columnar.day_arrays(data)
+        self.assertEqual(list(values), [0.0, 1.0, 2.0, 3.0])
+        self.assertFalse(values.flags.owndata)
+        timestamps, values = columnar.load_columns(
+            self.sensor.id, self.start, self.start + timedelta(hours=4))
+        self.assertEqual(list(values), [float(i) for i in range(8)])
+
+
+class SiteDatabaseTests(ChainTestCase):
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        add_test_database('data')
+        super(SiteDatabaseTests, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(SiteDatabaseTests, cls).tearDownClass()
+        remove_test_database('data')
+
+    def setUp(self):
+        super(SiteDatabaseTests, self).setUp()
+        self.old_databases = routers.SITE_DATABASES
+        routers.SITE_DATABASES = {self.sites[0].id: 'data'}
+        call_command('mirror_metadata', stdout=StringIO())
+        # the sensor is on the first site and the other one on the second
+        self.sensor = self.sensors[0]
+        self.other_sensor = self.sensors[2]
+
+    def tearDown(self):
+        routers.SITE_DATABASES = self.old_databases
+        super(SiteDatabaseTests, self).tearDown()
+
+    def test_data_should_be_stored_in_site_database(self):
+        start = datetime(2014, 3, 1, tzinfo=utc)
+        store_data([ScalarData(sensor=sensor, value=i,
+                               timestamp=start + timedelta(minutes=i))
+                    for i in range(3)
+                    for sensor in [self.sensor, self.other_sensor]])
+        self.assertEqual(ScalarData.objects.using('data').filter(
+            sensor=self.sensor).count(), 3)
+        self.assertFalse(ScalarData.objects.using('data').filter(
+            sensor=self.other_sensor).exists())
+        self.assertEqual(ScalarData.objects.filter(
+            sensor=self.other_sensor).count(), 5)
+        self.assertTrue(ScalarDataRollup.objects.using('data').filter(
+            sensor=self.sensor).exists())
+        self.assertEqual(self.sensor.latest_value.value, 2.0)
+        data = self.get_resource(
+            BASE_API_URL + 'sensordata/?sensor_id=%d&timestamp__gte=%d'
+            '&timestamp__lt=%d' % (self.sensor.id,
+                                   calendar.timegm(start.utctimetuple()),
+                                   calendar.timegm(start.utctimetuple()) +
+                                   3600))
+        self.assertEqual([d['value'] for d in data.data], [0.0, 1.0, 2.0])
+
+    def test_posted_data_should_be_stored_in_site_database(self):
+        data_url = BASE_API_URL + 'sensordata/create?sensor_id=%d' % \
+            self.sensor.id
+        self.create_resource(data_url, {'value': 42})
+        self.assertEqual(ScalarData.objects.using('data').get(
+            sensor=self.sensor).value, 42)
+        self.assertEqual(LatestValue.objects.using('data').get(
+            sensor=self.sensor).value, 42)
+        summary = self.get_resource(
+            BASE_API_URL + 'sites/%d/summary' % self.sites[0].id)
+        sensor_data = [sensor for device in summary.devices
+                       for sensor in device['sensors']
+                       if sensor['href'].endswith('/%d' % self.sensor.id)]
+        self.assertEqual([d['value'] for d in sensor_data[0]['data']], [42])
+
+    def test_data_for_missing_sensor_should_be_rejected(self):
+        response = self.client.post(
+            BASE_API_URL + 'sensordata/create?sensor_id=99999',
+            json.dumps({'value': 42}), content_type='application/json',
+            HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, HTTP_STATUS_BAD_REQUEST)
+        with self.assertRaises(IntegrityError):
+            store_data([ScalarData(sensor_id=99999, value=1)])
+
+    def test_data_links_should_find_point_in_site_database(self):
+        data_url = BASE_API_URL + 'sensordata/create?sensor_id=%d' % \
+            self.sensor.id
+        point = self.create_resource(data_url, {'value': 42})
+        # the point's ID is also used by a point in the default database
+        stored = ScalarData.objects.using('data').get(sensor=self.sensor)
+        self.assertTrue(ScalarData.objects.filter(id=stored.id).exists())
+        self.assertEqual(self.get_resource(point.links.self.href).value, 42)
+        edit = self.client.post(point.links.editForm.href,
+                                json.dumps({'value': 43}),
+                                content_type='application/json',
+                                HTTP_HOST='localhost')
+        self.assertEqual(edit.status_code, HTTP_STATUS_SUCCESS)
+        self.assertEqual(ScalarData.objects.using('data').get(
+            id=stored.id).value, 43)
+
+    def test_metadata_should_be_copied_to_site_databases(self):
+        self.assertTrue(Sensor.objects.using('data').filter(
+            id=self.sensor.id).exists())
+        sensor = Sensor.objects.create(device=self.devices[0],
+                                       metric=Metric.objects.create(
+                                           name='humidity'),
+                                       unit=self.unit)
+        self.assertTrue(Sensor.objects.using('data').filter(
+            id=sensor.id).exists())
+        sensor.delete()
+        self.assertFalse(Sensor.objects.using('data').filter(
+            id=sensor.id).exists())
+
+
+class ReplicaTests(ChainTestCase):
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        # the replica starts out with just the metadata, so reads from it
+        # don't see any data
+        add_test_database('replica')
+        super(ReplicaTests, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ReplicaTests, cls).tearDownClass()
+        remove_test_database('replica')
+
+    def setUp(self):
+        super(ReplicaTests, self).setUp()
+        routers.mirror_metadata('replica')
+        self.old_replicas = replicas.DATABASE_REPLICAS
+        replicas.DATABASE_REPLICAS = {'default': ['replica']}
+        replicas._lags.clear()
+        get_cache(replicas.REPLICA_PIN_CACHE).clear()
+        self.sensor = self.sensors[0]
+        self.data_url = BASE_API_URL + 'sensordata/?sensor_id=%d' % \
+            self.sensor.id
+
+    def tearDown(self):
+        replicas.DATABASE_REPLICAS = self.old_replicas
+        super(ReplicaTests, self).tearDown()
+
+    def test_get_requests_should_read_from_replica(self):
+        self.assertEqual(self.get_resource(self.data_url).data, [])
+        # outside of requests everything reads from the primary
+        self.assertEqual(self.sensor.scalar_data.count(), 2)
+
+    def test_writes_should_pin_client_to_primary(self):
+        self.create_resource(BASE_API_URL + 'sensordata/create?sensor_id=%d'
+                             % self.sensor.id, {'value': 42})
+        self.assertIn(replicas.PIN_COOKIE, self.client.cookies)
+        self.assertEqual([d['value'] for d in
+                          self.get_resource(self.data_url).data],
+                         [22.0, 23.0, 42.0])
+        # clients that don't keep cookies are pinned by their address
+        del self.client.cookies[replicas.PIN_COOKIE]
+        self.assertEqual(len(self.get_resource(self.data_url).data), 3)
+        response = self.client.get(self.data_url,
+                                   HTTP_ACCEPT='application/json',
+                                   HTTP_HOST='localhost',
+                                   REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(json.loads(response.content)['data'], [])
+
+    def test_header_should_pin_request_to_primary(self):
+        response = self.client.get(self.data_url,
+                                   HTTP_ACCEPT='application/json',
+                                   HTTP_HOST='localhost',
+                                   HTTP_X_READ_PRIMARY='1')
+        self.assertEqual(len(json.loads(response.content)['data']), 2)
+
+    def test_lagging_replica_should_not_be_read(self):
+        replicas._lags.set('replica', replicas.REPLICA_MAX_LAG + 1)
+        self.assertEqual([d['value'] for d in
+                          self.get_resource(self.data_url).data],
+                         [22.0, 23.0])
+
+
+class PartitionTests(TestCase):
+    def test_months_should_wrap_around_years(self):
+        month = month_start(datetime(2014, 11, 30, 23, 0, tzinfo=utc))
+        self.assertEqual(month, datetime(2014, 11, 1, tzinfo=utc))
+        self.assertEqual(add_months(month, 2),
+                         datetime(2015, 1, 1, tzinfo=utc))
+        self.assertEqual(add_months(month, -11),
+                         datetime(2013, 12, 1, tzinfo=utc))
+        self.assertEqual(
+            months_between(datetime(2014, 12, 5, tzinfo=utc),
+                           datetime(2015, 2, 1, tzinfo=utc)),
+            [datetime(2014, 12, 1, tzinfo=utc),
+             datetime(2015, 1, 1, tzinfo=utc),
+             datetime(2015, 2, 1, tzinfo=utc)])
+
+    def test_partition_names_should_round_trip(self):
+        month = datetime(2014, 4, 1, tzinfo=utc)
+        self.assertEqual(partition_name(month), 'core_scalardata_y2014m04')
+        self.assertEqual(parse_partition_name(partition_name(month)), month)
+        self.assertIsNone(parse_partition_name('core_scalardata'))
+
+    def test_trigger_should_check_newest_partition_first(self):
+        sql = trigger_function_sql([datetime(2014, 4, 1, tzinfo=utc),
+                                    datetime(2014, 5, 1, tzinfo=utc)])
+        self.assertLess(sql.index('core_scalardata_y2014m05'),
+                        sql.index('core_scalardata_y2014m04'))
+        self.assertIn("'2014-06-01 00:00:00+00'", sql)
+        self.assertIn('RETURN NEW', trigger_function_sql([]))
+
+    def test_partitioning_should_need_postgres(self):
+        with self.assertRaises(CommandError):
+            call_command('partition_data')
+
+
+class TimestampParsingTests(TestCase):
+    def test_iso_timestamps_should_be_parsed(self):
+        expected = datetime(2014, 4, 12, 15, 0, 4, 123000, tzinfo=utc)
+        for timestamp in ['2014-04-12T15:00:04.123Z',
+                          '2014-04-12T15:00:04.123+00:00',
+                          '2014-04-12T11:00:04.123-04:00',
+                          '2014-04-12 20:30:04.123+0530']:
+            self.assertEqual(parse_timestamp(timestamp), expected)
+
+    def test_naive_timestamps_should_use_default_timezone(self):
+        timestamp = parse_timestamp('2014-04-12T15:00:04')
+        self.assertEqual(timestamp, make_aware(datetime(2014, 4, 12, 15, 0, 4),
+                                               get_default_timezone()))
+
+    def test_invalid_timestamps_should_be_rejected(self):
+        for timestamp in ['2014-13-12T15:00:04Z', 'yesterday', None, [], '']:
+            with self.assertRaises(ValidationError):
+                parse_timestamp(timestamp)
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.cache = get_cache(SHARED_TEST_CACHE)
+        self.cache.clear()
+
+    def test_limit_should_allow_burst_then_refuse(self):
+        limit = RateLimit('test', rate=1, burst=3, cache=self.cache)
+        now = 3000.5
+        self.assertEqual([limit.consume(now) for i in range(3)], [0, 0, 0])
+        self.assertEqual(limit.check(now), 2.5)
+        self.assertEqual(limit.consume(now), 2.5)
+        # the refused request wasn't counted, so the next window is empty
+        self.assertEqual(limit.consume(now + 2.5), 0)
+
+    def test_limits_should_be_independent(self):
+        RateLimit('test-1', rate=1, burst=1, cache=self.cache).consume(10)
+        self.assertEqual(RateLimit('test-2', rate=1, burst=1,
+                                   cache=self.cache).consume(10), 0)
+        self.assertNotEqual(RateLimit('test-1', rate=1, burst=1,
+                                      cache=self.cache).consume(10), 0)
+
+    def test_refused_request_should_not_use_other_limits(self):
+        request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.1')
+        old_limits = (ratelimit.INGEST_CLIENT_RATE_LIMIT,
+                      ratelimit.INGEST_SITE_RATE_LIMIT,
+                      ratelimit.RATE_LIMIT_CACHE)
+        ratelimit.INGEST_CLIENT_RATE_LIMIT = (0.01, 1)
+        ratelimit.INGEST_SITE_RATE_LIMIT = (0.01, 2)
+        ratelimit.RATE_LIMIT_CACHE = SHARED_TEST_CACHE
+        try:
+            self.assertEqual(ratelimit.check_ingest_rate(request, 1), 0)
+            self.assertNotEqual(ratelimit.check_ingest_rate(request, 1), 0)
+            # the site still has room for a request from another client
+            request.META['REMOTE_ADDR'] = '10.0.0.2'
+            self.assertEqual(ratelimit.check_ingest_rate(request, 1), 0)
+        finally:
+            (ratelimit.INGEST_CLIENT_RATE_LIMIT,
+             ratelimit.INGEST_SITE_RATE_LIMIT,
+             ratelimit.RATE_LIMIT_CACHE) = old_limits
+
+
+class JSONListStreamTests(TestCase):
+    def test_items_should_be_parsed_across_chunks(self):
+        doc = '[{"value": 1.5, "timestamp": "2013-01-01T00:00:00Z"}, 12345]'
+        for chunk_size in [1, 7, 1024]:
+            items = list(iter_json_list(StringIO(doc), chunk_size))
+            self.assertEqual(items, [{'value': 1.5,
+                                      'timestamp': '2013-01-01T00:00:00Z'},
+                                     12345])
+
+    def test_empty_list_should_have_no_items(self):
+        self.assertEqual(list(iter_json_list(StringIO(' [ ] '), 1)), [])
+
+    def test_malformed_lists_should_be_rejected(self):
+        for doc in ['[1, 2', '[1, 2] x', '{"value": 1}', '[1,, 2]', '[1 2]',
+                    '']:
+            with self.assertRaises(ValidationError):
+                list(iter_json_list(StringIO(doc), 3))
+
+
 # these tests are testing specific URL conventions within this application
 class CollectionFilteringTests(ChainTestCase):
     def test_devices_can_be_filtered_by_site(self):
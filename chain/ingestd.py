@@ -0,0 +1,203 @@
+'''ingestd
+
+Subscribes to the raw ZMQ stream of every site that has one and stores the
+reports it receives directly through the models, so a single process replaces
+the per-site tidpost collectors and their round trip through the REST API.
+Devices and sensors are created as they're first seen, like the site ingest
+resource does. Run with
+
+    python -m chain.ingestd
+
+Note that this doesn't import the API modules, as they bind the web server's
+ZMQ publishing address. Data is published on INGESTD_PUB_URL instead, which
+the websocket server also subscribes to.
+'''
+
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chain.settings")
+
+import atexit
+import json
+import logging
+import signal
+import sys
+import time
+import urlparse
+import zmq
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+from chain.core.models import Site, Sensor
+from chain.core.cache import get_sensor_tags
+from chain.core.ingest import flatten_metrics, build_scalar_data
+from chain.core.ingest import resolve_device, resolve_sensors
+from chain.core.ingest import WriteBehindBuffer, BufferFullError
+from chain.core.ingest import apply_ingest_policies, deferred_policies
+from chain.core.ingest import store_data
+from chain.core.recent import deferred_recent
+from chain.units import build_units
+from chain.settings import INGEST_BUFFER_MAX_SIZE, INGEST_FLUSH_SIZE
+from chain.settings import INGEST_FLUSH_INTERVAL
+from chain.settings import TIDMARSH_UNITS, INGESTD_UNITS
+from chain.settings import INGESTD_PUB_URL, INGESTD_API_URL
+from chain.settings import INGESTD_SITE_REFRESH
+
+logger = logging.getLogger(__name__)
+
+# the field of a raw report that names the device, and fields that are neither
+# the device name nor metrics
+DEVICE_NAME_FIELD = 'src'
+IGNORED_FIELDS = ['via']
+
+
+def parse_report(raw, units):
+    '''Parses a raw report from a site's ZMQ stream, e.g.
+
+        {"src": "0x8110", "via": "0x0000", "sht_humidity": 15.9,
+         "charge_flags": {"fault": false, "charge": false}}
+
+    into the device name, a flat dictionary of metric values and a dictionary
+    of their units, looked up in the given unit table. Raises ValidationError
+    if the report isn't valid'''
+    try:
+        report = json.loads(raw)
+    except ValueError:
+        raise ValidationError('Report is not valid JSON')
+    if not isinstance(report, dict) or not report.get(DEVICE_NAME_FIELD):
+        raise ValidationError('Report must be an object with a "%s" field' %
+                              DEVICE_NAME_FIELD)
+    report_metrics = {name: value for name, value in report.items()
+                      if name != DEVICE_NAME_FIELD and
+                      name not in IGNORED_FIELDS}
+    return (report[DEVICE_NAME_FIELD], flatten_metrics(report_metrics),
+            build_units(report_metrics, units))
+
+
+class IngestDaemon(object):
+    '''Stores reports from the sites' raw ZMQ streams. Data is buffered and
+    written in batches by a background thread, then published for realtime
+    clients on pub_socket'''
+
+    def __init__(self, pub_socket, background=True):
+        self.pub_socket = pub_socket
+        self.buffer = WriteBehindBuffer(INGEST_BUFFER_MAX_SIZE,
+                                        INGEST_FLUSH_SIZE,
+                                        INGEST_FLUSH_INTERVAL,
+                                        flush_func=self.store,
+                                        background=background)
+        # maps each SUB socket to the site it's subscribed to
+        self._subscriptions = {}
+
+    def handle_message(self, site, raw):
+        '''Builds the data for a raw report from the given site and queues it
+        to be stored'''
+        units = INGESTD_UNITS.get(site.id, TIDMARSH_UNITS)
+        try:
+            device_name, metrics, metric_units = parse_report(raw, units)
+            device, _ = resolve_device(site.id, {'name': device_name})
+            sensors, _ = resolve_sensors(device, metrics.keys(), metric_units)
+            objs = build_scalar_data(metrics, sensors,
+                                     timestamp=timezone.now())
+        except ValidationError as e:
+            logger.warning('Ignoring report from site %d: %s' % (
+                site.id, ' '.join(e.messages)))
+            return
+        try:
+            # a dropped report mustn't count as the last one kept
+            with deferred_policies():
+                self.buffer.put(apply_ingest_policies(objs))
+        except BufferFullError as e:
+            # there's no way to ask a ZMQ publisher to slow down
+            logger.error('Dropping report from site %d: %s' % (site.id, e))
+
+    def store(self, objs):
+        '''Writes a batch of data to the database and, once it's committed,
+        publishes the points that were stored. Returns them'''
+        close_old_connections()
+        with deferred_recent(), transaction.atomic():
+            stored = store_data(objs)
+        for obj in stored:
+            self.publish(obj)
+        return stored
+
+    def publish(self, obj):
+        '''Pushes a stored data point to the realtime streams, in the same
+        form the API uses'''
+        stream_data = json.dumps({
+            'timestamp': obj.timestamp.isoformat(),
+            'value': obj.value,
+            '_links': {
+                'ch:sensor': {'href': urlparse.urljoin(
+                    INGESTD_API_URL, 'sensors/%d' % obj.sensor_id)}
+            }
+        })
+        try:
+            # the metadata cache forgets sensors that have been moved or
+            # deleted, so the tags are looked up again each time
+            tags = get_sensor_tags(obj.sensor_id)
+        except Sensor.DoesNotExist:
+            return
+        for tag in tags:
+            self.pub_socket.send_string(tag + ' ' + stream_data)
+
+    def refresh_sites(self, zmq_ctx, poller):
+        '''Subscribes to the raw stream of any site we're not already
+        subscribed to, and drops subscriptions for sites whose stream has
+        been removed or changed'''
+        close_old_connections()
+        sites = {site.id: site
+                 for site in Site.objects.exclude(raw_zmq_stream='')}
+        for sock, site in self._subscriptions.items():
+            if site.id not in sites or \
+                    sites[site.id].raw_zmq_stream != site.raw_zmq_stream:
+                logger.info('Unsubscribing from %s' % site.raw_zmq_stream)
+                poller.unregister(sock)
+                sock.close()
+                del self._subscriptions[sock]
+        subscribed = set(site.id for site in self._subscriptions.values())
+        for site in sites.values():
+            if site.id in subscribed:
+                continue
+            logger.info('Subscribing to %s for site "%s"' % (
+                site.raw_zmq_stream, site.name))
+            sock = zmq_ctx.socket(zmq.SUB)
+            sock.connect(site.raw_zmq_stream)
+            sock.setsockopt(zmq.SUBSCRIBE, '')
+            poller.register(sock, zmq.POLLIN)
+            self._subscriptions[sock] = site
+
+    def run(self, zmq_ctx):
+        poller = zmq.Poller()
+        next_refresh = 0
+        while True:
+            if time.time() >= next_refresh:
+                try:
+                    self.refresh_sites(zmq_ctx, poller)
+                except DatabaseError:
+                    logger.exception('Failed to look up sites')
+                next_refresh = time.time() + INGESTD_SITE_REFRESH
+            for sock, _ in poller.poll(timeout=1000):
+                site = self._subscriptions[sock]
+                raw = sock.recv()
+                try:
+                    self.handle_message(site, raw)
+                except DatabaseError:
+                    logger.exception('Failed to handle report from site %d' %
+                                     site.id)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    zmq_ctx = zmq.Context()
+    pub_socket = zmq_ctx.socket(zmq.PUB)
+    pub_socket.bind(INGESTD_PUB_URL)
+    daemon = IngestDaemon(pub_socket)
+    # make sure nothing is left in the buffer when we're stopped. supervisor
+    # stops us with SIGTERM, which would otherwise skip the atexit handlers
+    atexit.register(daemon.buffer.flush)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    daemon.run(zmq_ctx)
+
+
+if __name__ == '__main__':
+    main()
@@ -65,6 +65,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'chain.core.replicas.ReplicaMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -131,5 +132,143 @@ LOGGING = {
     }
 }
 
+# Write-behind ingest for sensor data. When enabled, data POSTed to a sensor is
+# acknowledged as soon as it's validated and written to the database in batches
+# by a background thread in each worker, whenever INGEST_FLUSH_SIZE points are
+# waiting or the oldest has waited INGEST_FLUSH_INTERVAL seconds. Once
+# INGEST_BUFFER_MAX_SIZE points are waiting, new data is refused with a 503.
+INGEST_WRITE_BEHIND = False
+INGEST_BUFFER_MAX_SIZE = 50000
+INGEST_FLUSH_SIZE = 1000
+INGEST_FLUSH_INTERVAL = 2.0
+
+# The IDs of batches posted with an X-Batch-Id header are remembered so that
+# resending a batch doesn't store it twice. `manage.py expire_batches`, which
+# should be run regularly, e.g. daily from cron, forgets the ones older than
+# INGEST_BATCH_MAX_AGE_DAYS, after which a resent batch would be stored again.
+INGEST_BATCH_MAX_AGE_DAYS = 7
+
+# Lists of sensor data with a request body larger than INGEST_STREAMING_THRESHOLD
+# bytes are parsed incrementally as the body is read, and stored
+# INGEST_STREAMING_CHUNK_SIZE points at a time, so that large backfills don't
+# have to fit in memory.
+INGEST_STREAMING_THRESHOLD = 1024 * 1024
+INGEST_STREAMING_CHUNK_SIZE = 5000
+
+# Site, Device, Sensor, Metric and Unit lookups on the ingest path are cached in
+# each process, holding up to METADATA_CACHE_SIZE entries. Changes made in
+# other processes are seen after at most METADATA_CACHE_TTL seconds.
+METADATA_CACHE_SIZE = 10000
+METADATA_CACHE_TTL = 300
+
+# Rate limits for posting data, as (requests per second, burst size), or None
+# for no limit. Each site gets its own limit, which can be overridden for
+# particular sites in INGEST_SITE_RATE_LIMITS (keyed by site ID), and so does
+# each client. Clients that go over a limit get a 429 response. The limits are
+# tracked in the RATE_LIMIT_CACHE cache, which has to be shared between the
+# workers and have an atomic incr, i.e. memcached (see chain/core/ratelimit.py).
+# The default local memory cache is per-process, so with it the limits are
+# off and a warning is logged at startup. Each limit counts requests in fixed
+# windows of burst / rate seconds, so a client can briefly get up to twice the
+# burst through where two windows meet.
+INGEST_SITE_RATE_LIMIT = None
+INGEST_SITE_RATE_LIMITS = {}
+INGEST_CLIENT_RATE_LIMIT = None
+RATE_LIMIT_CACHE = 'default'
+
+# the Tidmarsh sensors don't self-describe their units, so we map them here.
+# Note that the charge_flags are unpacked
+TIDMARSH_UNITS = {
+    "sht_humidity": "percent",
+    "bmp_pressure": "hPa",
+    "battery_voltage": "volts",
+    "illuminance": "lux",
+    "sht_temperature": "celsius",
+    "bmp_temperature": "celsius",
+    "charge_flags_fault": "boolean",
+    "charge_flags_charge": "boolean",
+    "accel_x": "m/s^2",
+    "accel_y": "m/s^2",
+    "accel_z": "m/s^2",
+    "analog": "ADC units"
+}
+
+# The ingest daemon (python -m chain.ingestd) subscribes to the raw_zmq_stream
+# of every site and stores the reports it receives directly, batching writes
+# the same way as write-behind ingest. New metrics get their units from the
+# site's table in INGESTD_UNITS (keyed by site ID), or TIDMARSH_UNITS if the
+# site doesn't have one. The daemon publishes data for realtime clients on
+# INGESTD_PUB_URL, with links relative to INGESTD_API_URL, and checks for new
+# or changed sites every INGESTD_SITE_REFRESH seconds.
+INGESTD_UNITS = {}
+INGESTD_PUB_URL = 'tcp://127.0.0.1:31417'
+INGESTD_API_URL = 'http://localhost:8000/'
+INGESTD_SITE_REFRESH = 60
+
+# On PostgreSQL, sensor data can be stored in monthly partitions (see
+# chain/core/partitions.py). `manage.py partition_data` creates partitions for
+# the current month and the DATA_PARTITION_MONTHS_AHEAD months after it, and
+# should be run regularly, e.g. daily from cron.
+DATA_PARTITION_MONTHS_AHEAD = 2
+
+# Sensor data is summarized in rollups at each of these resolutions, in
+# seconds, as it's stored. Changing them needs the rollups rebuilding with
+# `manage.py rebuild_rollups --all`.
+ROLLUP_RESOLUTIONS = [60, 60 * 60, 24 * 60 * 60]
+
+# Sensor data older than this many days is moved into compressed chunks (see
+# chain/core/chunks.py) by `manage.py compress_history`, which should be run
+# regularly, e.g. daily from cron. Set it to None to keep all data as raw rows,
+# in which case compress_history needs to be given --days.
+COMPRESS_DATA_AFTER_DAYS = 30
+
+# Sites and sensors with a retention policy have data older than the policy
+# allows moved out of the database into files under ARCHIVE_ROOT (see
+# chain/core/archive.py) by `manage.py archive_history`, which should be run
+# regularly, e.g. daily from cron. The files are read back by the API, so the
+# server needs to be able to read them. ARCHIVE_FORMAT is "chunks" for the same
+# encoding as compressed chunks, or "parquet" for Parquet files that other
+# tools can read, which needs the pyarrow package.
+ARCHIVE_ROOT = None
+ARCHIVE_FORMAT = 'chunks'
+
+# If RECENT_DATA_DIR is set, the last RECENT_DATA_POINTS points of each sensor
+# are kept in a memory-mapped file there (see chain/core/recent.py), and
+# requests for recent data are answered from it. It should be on a tmpfs such
+# as /dev/shm, writable by the web server and the ingest daemon. Each sensor's
+# file takes 16 bytes per point.
+RECENT_DATA_DIR = None
+RECENT_DATA_POINTS = 8192
+
+# If COLUMNAR_DATA_DIR is set, the materialize_days management command writes
+# each finished day of every sensor's data to a flat columnar file in it, and
+# requests for packed binary data read those days from the files instead of
+# the database. This needs day rollups (86400 in ROLLUP_RESOLUTIONS).
+COLUMNAR_DATA_DIR = None
+
+# SITE_DATABASES maps site IDs to aliases in DATABASES, to store each of those
+# sites' sensor data in its own database (see chain/core/routers.py). Sites
+# that aren't listed keep their data in the default database. A data database
+# also holds a copy of the sites, devices and sensors, so after creating its
+# tables run `manage.py mirror_metadata` before pointing sites at it.
+SITE_DATABASES = {}
+DATABASE_ROUTERS = ['chain.core.routers.SiteRouter',
+                    'chain.core.replicas.ReplicaRouter']
+
+# DATABASE_REPLICAS maps aliases in DATABASES to lists of aliases of their read
+# replicas, e.g. {'default': ['replica1', 'replica2']}. Reads made while
+# handling GET requests go to the replicas (see chain/core/replicas.py),
+# except for REPLICA_PIN_SECONDS after the same client has written something.
+# Clients are pinned by a cookie and by their address, which is kept in the
+# REPLICA_PIN_CACHE cache, which should be shared between workers (e.g.
+# memcached) for the pin to hold across the whole server. Replicas more than
+# REPLICA_MAX_LAG seconds behind aren't used, which is checked every
+# REPLICA_LAG_CHECK_INTERVAL seconds.
+DATABASE_REPLICAS = {}
+REPLICA_PIN_SECONDS = 10
+REPLICA_PIN_CACHE = 'default'
+REPLICA_MAX_LAG = 5
+REPLICA_LAG_CHECK_INTERVAL = 5
+
 # import this at the end so we can override default settings
 from localsettings import *
@@ -0,0 +1,24 @@
+'''Unit naming for collectors' reports, shared by the ingest daemon and the
+standalone collectors. This doesn't import Django, so the collectors can use
+it without setting up the models or a database.'''
+
+
+def build_units(metrics, units, prefix=''):
+    '''Gives the unit for every metric in a possibly nested dictionary of
+    metric values, keyed by the names the server flattens them to (see
+    chain.core.ingest.flatten_metrics). Units are looked up by those names
+    in the given unit table, and metrics that aren't in it are given a unit
+    named after the metric itself, e.g.
+
+        {"charge_flags": {"fault": false}} -> {"charge_flags_fault":
+                                               "fault units"}
+    '''
+    metric_units = {}
+    for name, value in metrics.items():
+        if isinstance(value, dict):
+            metric_units.update(build_units(value, units,
+                                            prefix + name + '_'))
+        else:
+            metric_units[prefix + name] = units.get(prefix + name,
+                                                    name + ' units')
+    return metric_units
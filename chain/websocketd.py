@@ -8,7 +8,7 @@ import zmq.green as zmq
 from flask import Flask
 from flask_sockets import Sockets
 from geventwebsocket import WebSocketError
-from chain.settings import ZMQ_PUB_URL
+from chain.settings import ZMQ_PUB_URL, INGESTD_PUB_URL
 
 app = Flask(__name__)
 app.debug = True
@@ -20,7 +20,9 @@ websockets = Sockets(app)
 def site_socket(ws, tag):
     print('ws client connected for tag "%s"' % tag)
     zmq_sock = zmq_ctx.socket(zmq.SUB)
+    # data comes from the web server and the ingest daemon
     zmq_sock.connect(ZMQ_PUB_URL)
+    zmq_sock.connect(INGESTD_PUB_URL)
     # note that flask gives us tag as a unicode string
     zmq_sock.setsockopt_string(zmq.SUBSCRIBE, tag)
     while True:
@@ -35,3 +37,4 @@ def site_socket(ws, tag):
             print('Caught WebSocketError: %s' % e)
             break
     zmq_sock.disconnect(ZMQ_PUB_URL)
+    zmq_sock.disconnect(INGESTD_PUB_URL)